@@ -8,6 +8,7 @@ from deepforest.utilities import read_file
 import cv2
 import rasterio
 import glob
+from milliontrees.datasets.manifest import build_manifest, write_manifest
 
 def remove_alpha_channel(datasets):
     """Remove alpha channels from images in the dataset."""
@@ -108,6 +109,10 @@ def create_release_files(base_dir, dataset_type):
     with open(f"{base_dir}{dataset_type}_{version}/RELEASE_{version}.txt", "w") as outfile:
         outfile.write(f"Version: {version}")
 
+def create_manifest(folder_path):
+    """Write the per-file sizes and hashes used to verify installs and update them between versions."""
+    write_manifest(folder_path, build_manifest(folder_path))
+
 def zip_directory(folder_path, zip_path):
     """Zip the contents of a directory."""
     # Remove the existing zip file if it exists
@@ -329,6 +334,10 @@ def run(version, base_dir, debug=False):
     create_release_files(base_dir, "TreePoints")
     create_release_files(base_dir, "TreePolygons")
 
+    # Create manifests, after every other file is written
+    for dataset_type in ["TreeBoxes", "TreePoints", "TreePolygons", "MiniTreeBoxes", "MiniTreePoints", "MiniTreePolygons"]:
+        create_manifest(f"{base_dir}{dataset_type}_{version}")
+
     # Zip datasets
     zip_directory(f"{base_dir}TreeBoxes_{version}", f"{base_dir}TreeBoxes_{version}.zip")
     zip_directory(f"{base_dir}TreePoints_{version}", f"{base_dir}TreePoints_{version}.zip")
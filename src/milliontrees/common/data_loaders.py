@@ -1,5 +1,5 @@
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 from torch.utils.data.sampler import WeightedRandomSampler, SubsetRandomSampler
 from milliontrees.common.utils import get_counts, split_into_groups
 from milliontrees.datasets.milliontrees_dataset import MillionTreesDataset
@@ -37,6 +37,16 @@ def get_train_loader(loader,
         print(
             "Warning: You are loading the entire dataset. Consider using dataset.get_subset('train') for a portion of the dataset if intended."
         )
+    if isinstance(dataset, IterableDataset):
+        # Streaming datasets, e.g. ShardedDataset, shuffle and partition themselves
+        if loader != 'standard' or uniform_over_groups:
+            raise ValueError(
+                'Streaming datasets only support standard loaders without group sampling.'
+            )
+        return DataLoader(dataset,
+                          collate_fn=dataset.collate,
+                          batch_size=batch_size,
+                          **loader_kwargs)
     if loader == 'standard':
         if uniform_over_groups is None or not uniform_over_groups:
 
@@ -103,6 +113,11 @@ def get_eval_loader(loader, dataset, batch_size, grouper=None, **loader_kwargs):
     Output:
         - data loader (DataLoader): Data loader.
     """
+    if loader == 'standard' and isinstance(dataset, IterableDataset):
+        return DataLoader(dataset,
+                          collate_fn=dataset.collate,
+                          batch_size=batch_size,
+                          **loader_kwargs)
     if loader == 'standard':
         return DataLoader(
             dataset,
@@ -0,0 +1,195 @@
+"""Run-length encoding of binary instance masks.
+
+Masks are flattened in column-major (Fortran) order, as in the COCO mask API. The
+counts alternate between runs of background and foreground pixels and always start
+with a (possibly empty) background run.
+"""
+import numpy as np
+
+
+def rle_encode(masks):
+    """Run-length encodes a stack of binary masks.
+
+    Args:
+        masks (np.ndarray): Array of shape (N, H, W). Any non-zero pixel is foreground.
+    Returns:
+        list of np.ndarray: uint32 run lengths of each mask.
+    """
+    masks = np.asarray(masks)
+    n = masks.shape[0]
+    flat = (masks.transpose(0, 2, 1).reshape(n, -1) != 0).view(np.int8)
+    length = flat.shape[1]
+    encoded = []
+    for row in flat:
+        # Positions where the value changes, starting from an implicit background pixel
+        changes = np.flatnonzero(np.diff(row, prepend=0))
+        counts = np.diff(np.concatenate(([0], changes, [length])))
+        encoded.append(counts.astype(np.uint32))
+    return encoded
+
+
+def rle_decode(counts, shape, fill_value=1, dtype=np.uint8):
+    """Decodes run lengths produced by rle_encode.
+
+    Args:
+        counts (np.ndarray): Run lengths of one mask.
+        shape (tuple): (H, W) of the mask.
+        fill_value (int): Value written to foreground pixels.
+        dtype: dtype of the decoded mask.
+    Returns:
+        np.ndarray: Mask of shape (H, W).
+    """
+    height, width = shape
+    values = np.zeros(len(counts), dtype=dtype)
+    values[1::2] = fill_value
+    flat = np.repeat(values, np.asarray(counts, dtype=np.int64))
+    return np.ascontiguousarray(flat.reshape(width, height).T)
+
+
+def rle_area(counts):
+    """Number of foreground pixels of a run-length encoded mask."""
+    return int(np.asarray(counts[1::2], dtype=np.int64).sum())
+
+
+def rle_intervals(counts):
+    """Foreground runs of a run-length encoded mask, as [start, end) flat pixel indices.
+
+    Returns:
+        tuple of np.ndarray: int64 starts and ends of the non-empty foreground runs.
+    """
+    ends = np.cumsum(np.asarray(counts, dtype=np.int64))
+    starts = ends - np.asarray(counts, dtype=np.int64)
+    starts, ends = starts[1::2], ends[1::2]
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def rle_iou(src_counts, pred_counts):
+    """Pairwise intersection over union of run-length encoded masks of the same size.
+
+    Like maskUtils.iou of the COCO API, no mask is decoded: the work and memory scale with
+    the number of runs, i.e. with the length of the mask boundaries, instead of the number
+    of pixels. For each source mask, the number of its foreground pixels before any flat
+    index is a cumulative sum over its runs, so the overlap of every predicted run is the
+    difference of two lookups.
+
+    Args:
+        src_counts (list of np.ndarray): Run lengths of G masks.
+        pred_counts (list of np.ndarray): Run lengths of P masks.
+    Returns:
+        np.ndarray: float32 IoU matrix of shape (G, P). NaN where both masks are empty.
+    """
+    pred_runs = [rle_intervals(counts) for counts in pred_counts]
+    pred_starts = np.concatenate([s for s, _ in pred_runs] +
+                                 [np.zeros(0, np.int64)])
+    pred_ends = np.concatenate([e for _, e in pred_runs] +
+                               [np.zeros(0, np.int64)])
+    owner = np.repeat(np.arange(len(pred_runs)), [len(s) for s, _ in pred_runs])
+    pred_area = np.bincount(owner,
+                            pred_ends - pred_starts,
+                            minlength=len(pred_runs)).astype(np.int64)
+
+    intersection = np.zeros((len(src_counts), len(pred_runs)), dtype=np.int64)
+    src_area = np.zeros(len(src_counts), dtype=np.int64)
+    for i, counts in enumerate(src_counts):
+        starts, ends = rle_intervals(counts)
+        if len(starts) == 0:
+            continue
+        lengths = ends - starts
+        src_area[i] = lengths.sum()
+        before = np.concatenate(([0], np.cumsum(lengths)))
+        # Only the predicted runs within the extent of the source mask can overlap it
+        near = (pred_starts < ends[-1]) & (pred_ends > starts[0])
+
+        def covered(x):
+            # Foreground pixels of the source mask with a flat index below x
+            k = np.searchsorted(starts, x, side='right')
+            last = np.maximum(k - 1, 0)
+            return np.where(
+                k > 0, before[last] + np.minimum(x, ends[last]) - starts[last],
+                0)
+
+        overlap = covered(pred_ends[near]) - covered(pred_starts[near])
+        intersection[i] = np.bincount(owner[near],
+                                      overlap,
+                                      minlength=len(pred_runs)).astype(np.int64)
+
+    union = src_area[:, None] + pred_area[None, :] - intersection
+    with np.errstate(invalid='ignore'):
+        return intersection.astype(np.float32) / union.astype(np.float32)
+
+
+def rle_boxes(counts_list, shape):
+    """xyxy boxes of run-length encoded masks, like torchvision's masks_to_boxes.
+
+    Args:
+        counts_list (list of np.ndarray): Run lengths of N masks.
+        shape (tuple): (H, W) of the masks.
+    Returns:
+        np.ndarray: float32 boxes of shape (N, 4).
+    """
+    height = shape[0]
+    boxes = np.zeros((len(counts_list), 4), dtype=np.float32)
+    for i, counts in enumerate(counts_list):
+        starts, ends = rle_intervals(counts)
+        if len(starts) == 0:
+            continue
+        last = ends - 1
+        # A run spanning several columns covers the bottom and top rows
+        wraps = starts // height != last // height
+        boxes[i] = (starts[0] // height, np.where(wraps, 0,
+                                                  starts % height).min(),
+                    last[-1] // height,
+                    np.where(wraps, height - 1, last % height).max())
+    return boxes
+
+
+class RLEMasks:
+    """A stack of run-length encoded masks of the same size.
+
+    Stands in for an (N, H, W) mask tensor in the targets and predictions given to
+    MaskAccuracy: it has a length and a shape, and can be indexed with a boolean or
+    integer index, e.g. to keep the predictions above a score threshold.
+
+    Args:
+        counts (list of np.ndarray): Run lengths of each mask, see rle_encode.
+        image_shape (tuple): (H, W) of the masks.
+    """
+
+    def __init__(self, counts, image_shape):
+        self.counts = list(counts)
+        self.image_shape = tuple(int(d) for d in image_shape)
+
+    @classmethod
+    def from_masks(cls, masks):
+        """Encodes an (N, H, W) array or tensor of binary masks."""
+        masks = np.asarray(masks)
+        masks = masks.reshape(-1, *masks.shape[-2:])
+        return cls(rle_encode(masks), masks.shape[1:])
+
+    @property
+    def shape(self):
+        return (len(self.counts),) + self.image_shape
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RLEMasks(self.counts[idx], self.image_shape)
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return RLEMasks([self.counts[i] for i in idx.reshape(-1)],
+                        self.image_shape)
+
+    def decode(self, fill_value=1, dtype=np.uint8):
+        """The masks as an (N, H, W) array."""
+        masks = np.zeros(self.shape, dtype=dtype)
+        for i, counts in enumerate(self.counts):
+            masks[i] = rle_decode(counts, self.image_shape, fill_value, dtype)
+        return masks
+
+    def boxes(self):
+        """float32 xyxy boxes of the masks, see rle_boxes."""
+        return rle_boxes(self.counts, self.image_shape)
@@ -1,13 +1,15 @@
+import contextlib
 import copy
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torchvision.ops.boxes import box_iou
+from torchvision.ops.boxes import box_area, box_iou
 from torchvision.models.detection._utils import Matcher
 from torchvision.ops import nms, box_convert
 from milliontrees.common.metrics.metric import Metric, ElementwiseMetric, MultiTaskMetric
 from milliontrees.common.metrics.loss import ElementwiseLoss
 from milliontrees.common.utils import avg_over_groups, minimum, maximum, get_counts
+from milliontrees.common.mask_utils import RLEMasks, rle_iou
 import sklearn.metrics
 from scipy.stats import pearsonr
 
@@ -400,87 +402,418 @@ class DummyMetric(Metric):
         return minimum(metrics)
 
 
+class DetectionMatches:
+    """Matches the predictions of each image to its ground truth and counts the true
+    positives, false positives and false negatives.
+
+    Accuracy, recall and precision are all derived from these counts, so metric objects
+    sharing a DetectionMatches, like the "accuracy", "recall" and "precision" metrics of a
+    dataset, compute the match-quality matrix and run the Matcher once per image instead of
+    once per metric, when computed inside a reuse() block. Outside of one, counts are
+    always computed afresh.
+
+    Args:
+        - quality_fn (callable): Maps the (G, ...) ground truth and (P, ...) predicted
+          geometries of an image to their (G, P) match-quality matrix, e.g. box_iou
+    """
+
+    def __init__(self, quality_fn):
+        self.quality_fn = quality_fn
+        self._reusing = False
+        self._last = None
+
+    def counts(self, y_pred, y_true, geometry_name, iou_threshold,
+               score_threshold):
+        """
+        Args:
+            - y_pred (list of dict): Predictions, with geometries and "scores"
+            - y_true (list of dict): Ground truth of the same images
+            - geometry_name (str): Key of the geometries
+            - iou_threshold (float): Minimum match quality of a true positive
+            - score_threshold (float): Predictions with lower scores are discarded
+        Output:
+            - counts (Tensor): (N, 3) true positives, false positives and false negatives
+              of each image
+        """
+        key = (len(y_pred), len(y_true), geometry_name, iou_threshold,
+               score_threshold)
+        if self._reusing and self._last is not None:
+            last_pred, last_true, last_key, counts = self._last
+            if last_pred is y_pred and last_true is y_true and last_key == key:
+                return counts
+        counts = torch.tensor([
+            self._image_counts(
+                gt[geometry_name],
+                target[geometry_name][target["scores"] > score_threshold],
+                iou_threshold) for gt, target in zip(y_true, y_pred)
+        ],
+                              dtype=torch.int64).reshape(-1, 3)
+        if self._reusing:
+            self._last = (y_pred, y_true, key, counts)
+        return counts
+
+    @contextlib.contextmanager
+    def reuse(self):
+        """Within the block, counts of the same y_pred and y_true objects are computed once,
+        e.g. across the metrics of one dataset.eval call. The predictions and ground truth
+        are released when the block exits; y_pred and y_true must not be modified within
+        it."""
+        if self._reusing:
+            yield
+            return
+        self._reusing = True
+        try:
+            yield
+        finally:
+            self._reusing = False
+            self._last = None
+
+    def _image_counts(self, src, pred, iou_threshold):
+        total_gt = len(src)
+        total_pred = len(pred)
+        if total_gt == 0 or total_pred == 0:
+            return 0, total_pred, total_gt
+        results = self._match(src, pred, iou_threshold)
+        true_positive = torch.count_nonzero(results.unique() != -1).item()
+        matched_elements = results[results > -1]
+        # in Matcher, a pred element can be matched only twice
+        false_positive = (
+            torch.count_nonzero(results == -1).item() +
+            (len(matched_elements) - len(matched_elements.unique())))
+        return true_positive, false_positive, total_gt - true_positive
+
+    def _match(self, src, pred, iou_threshold):
+        """For each prediction, the index of the ground truth it matches, or -1."""
+        # Define the matcher and distance matrix based on iou
+        matcher = Matcher(iou_threshold,
+                          iou_threshold,
+                          allow_low_quality_matches=False)
+        return matcher(self.quality_fn(src, pred))
+
+    def best_matches(self, src, pred, min_threshold):
+        """The best match quality of each prediction, and the first ground truth reaching it.
+
+        A prediction matches at a threshold if its best quality reaches it, as in _match, so
+        the matches of every threshold follow from one call. Qualities below min_threshold
+        may be left out; their predictions then get -inf, or 0 for points, and index -1.
+
+        Args:
+            - src: (G, ...) ground truth geometries, G > 0
+            - pred: (P, ...) predicted geometries, P > 0
+            - min_threshold (float): Lowest threshold the matches will be compared with
+        Output:
+            - quality (Tensor): (P,) best match quality
+            - matches (Tensor): (P,) index of the ground truth of best quality
+        """
+        return self.quality_fn(src, pred).max(dim=0)
+
+
+def pairwise_box_iou(boxes1, boxes2):
+    """IoU of the pairs boxes1[i], boxes2[i], computed like box_iou."""
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[:, 0] * wh[:, 1]
+    return inter / (area1 + area2 - inter)
+
+
+def sparse_box_match(src_boxes, pred_boxes, iou_threshold):
+    """Matches boxes like Matcher(iou_threshold, iou_threshold) on their box_iou, without
+    building the dense IoU matrix.
+
+    An STR-tree over the ground truth boxes finds the pairs of boxes that overlap, and the
+    IoU is only computed for those pairs. Each prediction is assigned the ground truth box
+    of highest IoU, the first one in case of ties, if that IoU reaches iou_threshold.
+
+    Args:
+        - src_boxes (Tensor): (G, 4) xyxy ground truth boxes
+        - pred_boxes (Tensor): (P, 4) xyxy predicted boxes
+        - iou_threshold (float): Minimum IoU of a match, greater than 0
+    Output:
+        - matches (Tensor): (P,) index of the matched ground truth box, or -1
+    """
+    src_idx, pred_idx, iou = _overlapping_boxes(src_boxes, pred_boxes)
+    return _match_pairs(len(src_boxes), len(pred_boxes), src_idx, pred_idx, iou,
+                        iou_threshold)
+
+
+def _overlapping_boxes(src_boxes, pred_boxes):
+    """The overlapping (src, pred) pairs of boxes, found with an STR-tree, and their IoU."""
+    import shapely
+
+    tree = shapely.STRtree(shapely.box(*src_boxes.double().numpy().T))
+    pred_idx, src_idx = tree.query(shapely.box(*pred_boxes.double().numpy().T))
+    pred_idx = torch.from_numpy(pred_idx)
+    src_idx = torch.from_numpy(src_idx)
+    return src_idx, pred_idx, pairwise_box_iou(src_boxes[src_idx],
+                                               pred_boxes[pred_idx])
+
+
+def _best_pairs(n_src, n_pred, src_idx, pred_idx, iou):
+    """DetectionMatches.best_matches on a sparse IoU matrix, given by the IoU of the
+    (src_idx, pred_idx) pairs. Predictions without pairs get -inf and -1."""
+    # Highest IoU of each prediction, then the first ground truth reaching it
+    best_iou = torch.full((n_pred,), -float('inf'),
+                          dtype=iou.dtype).scatter_reduce(0,
+                                                          pred_idx,
+                                                          iou,
+                                                          'amax',
+                                                          include_self=False)
+    is_best = iou == best_iou[pred_idx]
+    best_src = torch.full(
+        (n_pred,), n_src).scatter_reduce(0, pred_idx[is_best], src_idx[is_best],
+                                         'amin')
+    return best_iou, torch.where(best_src < n_src, best_src, -1)
+
+
+def _match_pairs(n_src, n_pred, src_idx, pred_idx, iou, iou_threshold):
+    """Matcher(iou_threshold, iou_threshold) on a sparse IoU matrix, given by the IoU of
+    the (src_idx, pred_idx) pairs. Pairs left out never match."""
+    best_iou, best_src = _best_pairs(n_src, n_pred, src_idx, pred_idx, iou)
+    return torch.where(best_iou >= iou_threshold, best_src, -1)
+
+
+def _valid_polygons(polygons):
+    """Polygons as an array of valid shapely geometries."""
+    import shapely
+
+    polygons = np.asarray(polygons, dtype=object).reshape(-1)
+    invalid = ~shapely.is_valid(polygons)
+    if invalid.any():
+        polygons = polygons.copy()
+        polygons[invalid] = shapely.make_valid(polygons[invalid])
+    return polygons
+
+
+def _overlapping_polygons(src_polygons, pred_polygons):
+    """The intersecting (src, pred) pairs of polygons, found with an STR-tree, and their
+    IoU."""
+    import shapely
+
+    tree = shapely.STRtree(src_polygons)
+    pred_idx, src_idx = tree.query(pred_polygons, predicate='intersects')
+    src, pred = src_polygons[src_idx], pred_polygons[pred_idx]
+    intersection = shapely.area(shapely.intersection(src, pred))
+    union = shapely.area(src) + shapely.area(pred) - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        iou = intersection / union
+    return torch.from_numpy(src_idx), torch.from_numpy(
+        pred_idx), torch.from_numpy(iou)
+
+
+def polygon_iou(src_polygons, pred_polygons):
+    """(G, P) intersection over union of the areas of two sets of shapely polygons.
+
+    Only the pairs of polygons that intersect, found with an STR-tree, are intersected;
+    the others have an IoU of 0. Invalid polygons are repaired with make_valid first.
+    """
+    src_polygons = _valid_polygons(src_polygons)
+    pred_polygons = _valid_polygons(pred_polygons)
+    iou = torch.zeros(len(src_polygons),
+                      len(pred_polygons),
+                      dtype=torch.float64)
+    src_idx, pred_idx, pair_iou = _overlapping_polygons(src_polygons,
+                                                        pred_polygons)
+    iou[src_idx, pred_idx] = pair_iou
+    return iou
+
+
+class PolygonMatches(DetectionMatches):
+    """DetectionMatches of shapely polygons, compared by the IoU of their areas.
+
+    The IoU is only computed for the pairs of polygons that intersect, and the matching
+    runs on those pairs, so no mask and no dense IoU matrix is allocated.
+    """
+
+    def __init__(self):
+        super().__init__(polygon_iou)
+
+    def _match(self, src, pred, iou_threshold):
+        if iou_threshold <= 0:
+            return super()._match(src, pred, iou_threshold)
+        src_idx, pred_idx, iou = _overlapping_polygons(_valid_polygons(src),
+                                                       _valid_polygons(pred))
+        return _match_pairs(len(src), len(pred), src_idx, pred_idx, iou,
+                            iou_threshold)
+
+    def best_matches(self, src, pred, min_threshold):
+        if min_threshold <= 0:
+            return super().best_matches(src, pred, min_threshold)
+        src_idx, pred_idx, iou = _overlapping_polygons(_valid_polygons(src),
+                                                       _valid_polygons(pred))
+        return _best_pairs(len(src), len(pred), src_idx, pred_idx, iou)
+
+
+class BoxMatches(DetectionMatches):
+    """DetectionMatches of boxes, which only computes the IoU of overlapping boxes on
+    crowded images.
+
+    Dense tiles have thousands of crowns and tens of thousands of low-score predictions, and
+    their dense IoU matrix costs hundreds of MB. Images with more ground truth and
+    prediction pairs than dense_max_pairs are matched with sparse_box_match instead, which
+    gives the same matches.
+
+    Args:
+        - dense_max_pairs (int): Largest IoU matrix, in elements, computed densely
+    """
+
+    def __init__(self, dense_max_pairs=1000000):
+        super().__init__(box_iou)
+        self.dense_max_pairs = dense_max_pairs
+
+    def _match(self, src, pred, iou_threshold):
+        if len(src) * len(pred) <= self.dense_max_pairs or iou_threshold <= 0:
+            return super()._match(src, pred, iou_threshold)
+        return sparse_box_match(src, pred, iou_threshold)
+
+    def best_matches(self, src, pred, min_threshold):
+        if len(src) * len(pred) <= self.dense_max_pairs or min_threshold <= 0:
+            return super().best_matches(src, pred, min_threshold)
+        src_idx, pred_idx, iou = _overlapping_boxes(src, pred)
+        return _best_pairs(len(src), len(pred), src_idx, pred_idx, iou)
+
+
+def point_nearness(src_keypoints, pred_keypoints):
+    """(G, P) inverse of the euclidean distances between two sets of points."""
+    distance = torch.cdist(src_keypoints.float(), pred_keypoints.float(), p=2)
+
+    # Inverson of distance to get relative distance
+    return 1 / distance
+
+
+def sparse_point_match(src_keypoints, pred_keypoints, nearness_threshold):
+    """Matches points like Matcher(nearness_threshold, nearness_threshold) on their
+    point_nearness, without building the dense distance matrix.
+
+    A KD-tree query finds the pairs of points closer than 1 / nearness_threshold, and each
+    prediction is assigned its nearest ground truth point among them, the first one in case
+    of ties. Coincident points have a distance of 0 rather than an infinite nearness.
+
+    Args:
+        - src_keypoints (Tensor): (G, 2) ground truth points
+        - pred_keypoints (Tensor): (P, 2) predicted points
+        - nearness_threshold (float): Minimum inverse distance of a match, greater than 0
+    Output:
+        - matches (Tensor): (P,) index of the matched ground truth point, or -1
+    """
+    nearness, best_src = _nearest_points(src_keypoints, pred_keypoints,
+                                         1 / nearness_threshold)
+    return torch.where(nearness >= nearness_threshold, best_src, -1)
+
+
+def _nearest_points(src_keypoints, pred_keypoints, max_distance):
+    """DetectionMatches.best_matches of points on the pairs closer than max_distance,
+    found with a KD-tree. Predictions without pairs get a nearness of 0 and -1."""
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(src_keypoints.double().numpy()).sparse_distance_matrix(
+        cKDTree(pred_keypoints.double().numpy()),
+        max_distance,
+        output_type='ndarray')
+    # Nearest first: the negated distance is the match quality
+    best, best_src = _best_pairs(len(src_keypoints), len(pred_keypoints),
+                                 torch.from_numpy(pairs['i']),
+                                 torch.from_numpy(pairs['j']),
+                                 -torch.from_numpy(pairs['v']))
+    return 1 / -best, best_src
+
+
+class PointMatches(DetectionMatches):
+    """DetectionMatches of points, matched on the neighbour graph of a KD-tree.
+
+    TreePoints images can have thousands of stems, and their dense distance matrix is
+    quadratic in memory. Points are matched with sparse_point_match instead, whose cost is
+    near-linear in the number of points. A threshold of 0 or less matches every pair, and
+    falls back to the dense point_nearness matrix.
+    """
+
+    def __init__(self):
+        super().__init__(point_nearness)
+
+    def _match(self, src, pred, iou_threshold):
+        if iou_threshold <= 0:
+            return super()._match(src, pred, iou_threshold)
+        return sparse_point_match(src, pred, iou_threshold)
+
+    def best_matches(self, src, pred, min_threshold):
+        if min_threshold <= 0:
+            return super().best_matches(src, pred, min_threshold)
+        return _nearest_points(src, pred, 1 / min_threshold)
+
+
+def rates_from_counts(counts, metric):
+    """Per-image accuracy, recall or precision from DetectionMatches.counts.
+
+    Images without ground truth and predictions score 1. Otherwise a rate whose
+    denominator is 0, like the recall of an image without ground truth, is 0.
+
+    Args:
+        - counts (Tensor): (N, 3) true positives, false positives and false negatives
+        - metric (str): 'accuracy', 'recall' or 'precision'
+    Output:
+        - rates (Tensor): (N,) float tensor
+    """
+    true_positive, false_positive, false_negative = counts.unbind(1)
+    if metric == "accuracy":
+        denominator = true_positive + false_positive + false_negative
+    elif metric == "recall":
+        denominator = true_positive + false_negative
+    elif metric == "precision":
+        denominator = true_positive + false_positive
+    else:
+        raise ValueError(
+            f"metric must be 'accuracy', 'recall' or 'precision', not {metric}."
+        )
+    empty = (true_positive + false_positive + false_negative) == 0
+    return torch.where(denominator > 0,
+                       true_positive / denominator.clamp(min=1), empty.float())
+
+
+def _image_rate(matches, src, pred, threshold, metric):
+    """The rate of a single image, from geometries already filtered by score."""
+    counts = torch.tensor([matches._image_counts(src, pred, threshold)],
+                          dtype=torch.int64)
+    return rates_from_counts(counts, metric)[0]
+
+
 class DetectionAccuracy(ElementwiseMetric):
     """Given a specific Intersection over union threshold, determine the accuracy achieved for a
-    one-class detector."""
+    one-class detector.
+
+    metric selects the accuracy, recall or precision. Metrics given the same matches share
+    the matching of each image, see DetectionMatches.
+    """
 
     def __init__(self,
                  iou_threshold=0.3,
                  score_threshold=0.1,
                  name=None,
                  geometry_name="boxes",
-                 metric="accuracy"):
+                 metric="accuracy",
+                 matches=None):
         self.iou_threshold = iou_threshold
         self.score_threshold = score_threshold
         self.geometry_name = geometry_name
         self.metric = metric
+        self.matches = BoxMatches() if matches is None else matches
         if name is None:
             name = "detection_{}".format(metric)
         super().__init__(name=name)
 
     def _compute_element_wise(self, y_pred, y_true):
-        batch_results = []
-        for gt, target in zip(y_true, y_pred):
-            target_boxes = target[self.geometry_name]
-            target_scores = target["scores"]
-            gt_boxes = gt[self.geometry_name]
-            pred_boxes = target_boxes[target_scores > self.score_threshold]
-            if self.metric == "accuracy":
-                det_accuracy = self._accuracy(gt_boxes, pred_boxes,
-                                              self.iou_threshold)
-            elif self.metric == "recall":
-                det_accuracy = self._recall(gt_boxes, pred_boxes,
-                                            self.iou_threshold)
-            batch_results.append(det_accuracy)
-        return torch.tensor(batch_results)
+        counts = self.matches.counts(y_pred, y_true, self.geometry_name,
+                                     self.iou_threshold, self.score_threshold)
+        return rates_from_counts(counts, self.metric)
 
     def _recall(self, src_boxes, pred_boxes, iou_threshold):
-        total_gt = len(src_boxes)
-        total_pred = len(pred_boxes)
-        if total_gt > 0 and total_pred > 0:
-            # Define the matcher and distance matrix based on iou
-            matcher = Matcher(iou_threshold,
-                              iou_threshold,
-                              allow_low_quality_matches=False)
-            match_quality_matrix = box_iou(src_boxes, pred_boxes)
-            results = matcher(match_quality_matrix)
-            true_positive = torch.count_nonzero(results.unique() != -1)
-            return true_positive / total_gt
-        elif total_gt == 0:
-            if total_pred > 0:
-                return torch.tensor(0.)
-            else:
-                return torch.tensor(1.)
-        elif total_gt > 0 and total_pred == 0:
-            return torch.tensor(0.)
+        return _image_rate(self.matches, src_boxes, pred_boxes, iou_threshold,
+                           "recall")
 
     def _accuracy(self, src_boxes, pred_boxes, iou_threshold):
-        total_gt = len(src_boxes)
-        total_pred = len(pred_boxes)
-        if total_gt > 0 and total_pred > 0:
-            # Define the matcher and distance matrix based on iou
-            matcher = Matcher(iou_threshold,
-                              iou_threshold,
-                              allow_low_quality_matches=False)
-            match_quality_matrix = box_iou(src_boxes, pred_boxes)
-            results = matcher(match_quality_matrix)
-            true_positive = torch.count_nonzero(results.unique() != -1)
-            matched_elements = results[results > -1]
-            # in Matcher, a pred element can be matched only twice
-            false_positive = (
-                torch.count_nonzero(results == -1) +
-                (len(matched_elements) - len(matched_elements.unique())))
-            false_negative = total_gt - true_positive
-            acc = true_positive / (true_positive + false_positive +
-                                   false_negative)
-            return acc
-        elif total_gt == 0:
-            if total_pred > 0:
-                return torch.tensor(0.)
-            else:
-                return torch.tensor(1.)
-        elif total_gt > 0 and total_pred == 0:
-            return torch.tensor(0.)
+        return _image_rate(self.matches, src_boxes, pred_boxes, iou_threshold,
+                           "accuracy")
 
     def worst(self, metrics):
         return minimum(metrics)
@@ -488,158 +821,317 @@ class DetectionAccuracy(ElementwiseMetric):
 
 class KeypointAccuracy(ElementwiseMetric):
     """Given a specific Intersection over union threshold, determine the accuracy achieved for a
-    one-class detector."""
+    one-class detector.
+
+    Points match when their inverse distance reaches distance_threshold, i.e. when they are
+    at most 1 / distance_threshold apart. Points are matched with PointMatches by default.
+    """
 
     def __init__(self,
                  distance_threshold=0.1,
                  score_threshold=0.1,
                  name=None,
-                 geometry_name="y"):
+                 geometry_name="y",
+                 matches=None):
         self.distance_threshold = distance_threshold
         self.score_threshold = score_threshold
         self.geometry_name = geometry_name
+        self.matches = PointMatches() if matches is None else matches
         if name is None:
             name = "keypoint_acc"
         super().__init__(name=name)
 
     def _compute_element_wise(self, y_pred, y_true):
-        batch_results = []
-        for gt, target in zip(y_true, y_pred):
-            target_boxes = target[self.geometry_name]
-            target_scores = target["scores"]
-
-            gt_boxes = gt[self.geometry_name]
-            pred_boxes = target_boxes[target_scores > self.score_threshold]
-            det_accuracy = self._accuracy(gt_boxes, pred_boxes,
-                                          self.distance_threshold)
-            batch_results.append(det_accuracy)
-        return torch.tensor(batch_results)
+        counts = self.matches.counts(y_pred, y_true, self.geometry_name,
+                                     self.distance_threshold,
+                                     self.score_threshold)
+        return rates_from_counts(counts, "accuracy")
 
     def _point_nearness(self, src_keypoints, pred_keypoints):
-        distance = torch.cdist(src_keypoints.float(),
-                               pred_keypoints.float(),
-                               p=2)
-
-        # Inverson of distance to get relative distance
-        relative_distance = 1 / distance
-        return relative_distance
+        return point_nearness(src_keypoints, pred_keypoints)
 
     def _accuracy(self, src_keypoints, pred_keypoints, distance_threshold):
-        total_gt = len(src_keypoints)
-        total_pred = len(pred_keypoints)
-        if total_gt > 0 and total_pred > 0:
-            # Define the matcher and distance matrix based on iou
-            matcher = Matcher(distance_threshold,
-                              distance_threshold,
-                              allow_low_quality_matches=False)
-            match_quality_matrix = self._point_nearness(src_keypoints,
-                                                        pred_keypoints)
-            results = matcher(match_quality_matrix)
-            true_positive = torch.count_nonzero(results.unique() != -1)
-            matched_elements = results[results > -1]
-            # in Matcher, a pred element can be matched only twice
-            false_positive = (
-                torch.count_nonzero(results == -1) +
-                (len(matched_elements) - len(matched_elements.unique())))
-            false_negative = total_gt - true_positive
-            acc = true_positive / (true_positive + false_positive +
-                                   false_negative)
-            return acc
-        elif total_gt == 0:
-            if total_pred > 0:
-                return torch.round(torch.tensor(0.), decimals=3)
-            else:
-                return torch.round(torch.tensor(1.), decimals=3)
-        elif total_gt > 0 and total_pred == 0:
-            return torch.round(torch.tensor(0.), decimals=3)
+        return _image_rate(self.matches, src_keypoints, pred_keypoints,
+                           distance_threshold, "accuracy")
 
     def worst(self, metrics):
         return torch.round(minimum(metrics), decimals=3)
 
 
+def mask_iou(src_masks, pred_masks):
+    """(G, P) intersection over union of two sets of binary masks of the same size.
+
+    Masks are (N, H, W) tensors or arrays, or RLEMasks. Dense masks are run-length encoded
+    first and the IoU is computed on the runs with rle_iou, so memory scales with the mask
+    boundaries instead of G * P * H * W.
+    """
+    if not isinstance(src_masks, RLEMasks):
+        src_masks = RLEMasks.from_masks(src_masks)
+    if not isinstance(pred_masks, RLEMasks):
+        pred_masks = RLEMasks.from_masks(pred_masks)
+    return torch.from_numpy(rle_iou(src_masks.counts, pred_masks.counts))
+
+
 class MaskAccuracy(ElementwiseMetric):
     """Given a specific Intersection over union threshold, determine the accuracy achieved for a
-    Mask R-CNN detector."""
+    Mask R-CNN detector.
+
+    Masks of targets and predictions can be dense (N, H, W) tensors or RLEMasks.
+    metric selects the accuracy, recall or precision. Metrics given the same matches share
+    the matching of each image, see DetectionMatches.
+    """
 
     def __init__(self,
                  iou_threshold=0.5,
                  score_threshold=0.1,
                  name=None,
                  geometry_name="masks",
-                 metric="accuracy"):
+                 metric="accuracy",
+                 matches=None):
         self.iou_threshold = iou_threshold
         self.score_threshold = score_threshold
         self.geometry_name = geometry_name
+        self.metric = metric
+        self.matches = DetectionMatches(
+            mask_iou) if matches is None else matches
         if name is None:
-            name = "mask_acc"
+            name = "mask_acc" if metric == "accuracy" else f"mask_{metric}"
         super().__init__(name=name)
 
     def _compute_element_wise(self, y_pred, y_true):
-        batch_results = []
-        for gt, target in zip(y_true, y_pred):
-            target_masks = target[self.geometry_name]
-            target_scores = target["scores"]
-
-            gt_masks = gt[self.geometry_name]
-            pred_masks = target_masks[target_scores > self.score_threshold]
-            det_accuracy = self._accuracy(gt_masks, pred_masks,
-                                          self.iou_threshold)
-            batch_results.append(det_accuracy)
-        return torch.tensor(batch_results)
-
-    def _mask_iou(self, src_masks, pred_masks):
-        intersection = (src_masks & pred_masks).float().sum((1, 2))
-        union = (src_masks | pred_masks).float().sum((1, 2))
-        iou = intersection / union
-        return iou
+        counts = self.matches.counts(y_pred, y_true, self.geometry_name,
+                                     self.iou_threshold, self.score_threshold)
+        return rates_from_counts(counts, self.metric)
 
     def _recall(self, src_masks, pred_masks, iou_threshold):
-        total_gt = len(src_masks)
-        total_pred = len(pred_masks)
-        if total_gt > 0 and total_pred > 0:
-            # Define the matcher and distance matrix based on iou
-            matcher = Matcher(iou_threshold,
-                              iou_threshold,
-                              allow_low_quality_matches=False)
-            match_quality_matrix = self._mask_iou(src_masks, pred_masks)
-            results = matcher(match_quality_matrix)
-            true_positive = torch.count_nonzero(results.unique() != -1)
-            return true_positive / total_gt
-        elif total_gt == 0:
-            if total_pred > 0:
-                return torch.tensor(0.)
-            else:
-                return torch.tensor(1.)
-        elif total_gt > 0 and total_pred == 0:
-            return torch.tensor(0.)
+        return _image_rate(self.matches, src_masks, pred_masks, iou_threshold,
+                           "recall")
 
     def _accuracy(self, src_masks, pred_masks, iou_threshold):
-        total_gt = len(src_masks)
-        total_pred = len(pred_masks)
-        if total_gt > 0 and total_pred > 0:
-            # Define the matcher and distance matrix based on iou
-            matcher = Matcher(iou_threshold,
-                              iou_threshold,
-                              allow_low_quality_matches=False)
-            match_quality_matrix = self._mask_iou(src_masks, pred_masks)
-            results = matcher(match_quality_matrix)
-            true_positive = torch.count_nonzero(results.unique() != -1)
-            matched_elements = results[results > -1]
-            # in Matcher, a pred element can be matched only twice
-            false_positive = (
-                torch.count_nonzero(results == -1) +
-                (len(matched_elements) - len(matched_elements.unique())))
-            false_negative = total_gt - true_positive
-            acc = true_positive / (true_positive + false_positive +
-                                   false_negative)
-            return acc
-        elif total_gt == 0:
-            if total_pred > 0:
-                return torch.tensor(0.)
-            else:
-                return torch.tensor(1.)
-        elif total_gt > 0 and total_pred == 0:
-            return torch.tensor(0.)
+        return _image_rate(self.matches, src_masks, pred_masks, iou_threshold,
+                           "accuracy")
+
+    def worst(self, metrics):
+        return minimum(metrics)
+
+
+class PolygonAccuracy(ElementwiseMetric):
+    """Given a specific Intersection over union threshold, determine the accuracy achieved for a
+    one-class detector of polygons, comparing shapely geometries instead of masks.
+
+    Targets and predictions hold sequences of shapely polygons in the same coordinates.
+    metric selects the accuracy, recall or precision. Metrics given the same matches share
+    the matching of each image, see DetectionMatches.
+    """
+
+    def __init__(self,
+                 iou_threshold=0.5,
+                 score_threshold=0.1,
+                 name=None,
+                 geometry_name="y",
+                 metric="accuracy",
+                 matches=None):
+        self.iou_threshold = iou_threshold
+        self.score_threshold = score_threshold
+        self.geometry_name = geometry_name
+        self.metric = metric
+        self.matches = PolygonMatches() if matches is None else matches
+        if name is None:
+            name = "polygon_acc" if metric == "accuracy" else f"polygon_{metric}"
+        super().__init__(name=name)
+
+    def _compute_element_wise(self, y_pred, y_true):
+        counts = self.matches.counts(y_pred, y_true, self.geometry_name,
+                                     self.iou_threshold, self.score_threshold)
+        return rates_from_counts(counts, self.metric)
+
+    def _recall(self, src_polygons, pred_polygons, iou_threshold):
+        return _image_rate(self.matches, src_polygons, pred_polygons,
+                           iou_threshold, "recall")
+
+    def _accuracy(self, src_polygons, pred_polygons, iou_threshold):
+        return _image_rate(self.matches, src_polygons, pred_polygons,
+                           iou_threshold, "accuracy")
 
     def worst(self, metrics):
         return minimum(metrics)
+
+
+COCO_IOU_THRESHOLDS = tuple(np.arange(50, 100, 5) / 100)
+
+
+class DetectionSweep:
+    """Accuracy, recall and precision of a detector over a grid of score and match-quality
+    thresholds, and the average precision of each group, in a single pass over the data.
+
+    A DetectionAccuracy, KeypointAccuracy or MaskAccuracy is pinned to one score and one
+    IoU threshold, so curves over thresholds would take one evaluation per point. Here the
+    matches of each image are computed once, with DetectionMatches.best_matches, and
+    the true positives of every threshold pair are counted from the scores, sorted once.
+    The counts match those of the metrics evaluated at each pair of thresholds.
+
+    Accuracy, recall and precision are per-image rates averaged over the images of each
+    group, as in standard_group_eval. The average precision pools the counts of the
+    images of a group, and is the mean over 101 recall levels of the interpolated
+    precision, as in COCO, taken at the score thresholds of the grid.
+
+    Args:
+        - matches (DetectionMatches): Matches of the geometries, e.g. the dataset's
+        - grouper (CombinatorialGrouper): Grouper object that converts metadata into groups
+        - iou_thresholds (sequence of float): Match-quality thresholds: IoUs, or inverse
+          distances for points
+        - score_thresholds (sequence of float): Predictions with higher scores are kept
+        - geometry_name (str): Key of the geometries
+    """
+
+    def __init__(self,
+                 matches,
+                 grouper,
+                 iou_thresholds=COCO_IOU_THRESHOLDS,
+                 score_thresholds=tuple(np.arange(101) / 100),
+                 geometry_name="y"):
+        self.matches = matches
+        self.grouper = grouper
+        self.iou_thresholds = torch.as_tensor(iou_thresholds,
+                                              dtype=torch.float64)
+        self.score_thresholds = torch.as_tensor(score_thresholds,
+                                                dtype=torch.float64)
+        self.geometry_name = geometry_name
+        self.reset()
+
+    def reset(self):
+        """Forgets every batch seen so far."""
+        shape = (self.grouper.n_groups, len(self.score_thresholds),
+                 len(self.iou_thresholds))
+        self._rate_sums = {
+            metric: torch.zeros(shape, dtype=torch.float64)
+            for metric in ("accuracy", "recall", "precision")
+        }
+        self._counts = torch.zeros(shape + (3,), dtype=torch.int64)
+        self._group_counts = torch.zeros(self.grouper.n_groups,
+                                         dtype=torch.int64)
+
+    def image_counts(self, src, pred, scores):
+        """True positives, false positives and false negatives of an image at every pair
+        of thresholds.
+
+        Args:
+            - src: (G, ...) ground truth geometries
+            - pred: (P, ...) predicted geometries
+            - scores (Tensor): (P,) scores of the predictions
+        Output:
+            - counts (Tensor): (S, T, 3) counts by score and match-quality threshold
+        """
+        score_thresholds = self.score_thresholds.to(scores.dtype)
+        n_src = len(src)
+        # Predictions kept at each score threshold
+        kept = len(scores) - torch.searchsorted(
+            scores.sort().values, score_thresholds, right=True)
+        if n_src == 0 or len(pred) == 0:
+            true_positive = torch.zeros(len(score_thresholds),
+                                        len(self.iou_thresholds),
+                                        dtype=torch.int64)
+        else:
+            quality, best_src = self.matches.best_matches(
+                src, pred,
+                self.iou_thresholds.min().item())
+            iou_thresholds = self.iou_thresholds.to(quality.dtype)
+            matched = (quality[None] >= iou_thresholds[:, None]) & (best_src
+                                                                    >= 0)
+            # Highest score of the predictions matching each ground truth, which is a
+            # true positive as long as that prediction is kept
+            top_scores = torch.full(
+                (len(iou_thresholds), n_src), -float('inf'),
+                dtype=scores.dtype).scatter_reduce(
+                    1,
+                    best_src.clamp(min=0).expand(len(iou_thresholds), -1),
+                    torch.where(matched, scores, -float('inf')), 'amax')
+            true_positive = n_src - torch.searchsorted(
+                top_scores.sort(dim=1).values,
+                score_thresholds.expand(len(iou_thresholds), -1).contiguous(),
+                right=True).T
+        return torch.stack([
+            true_positive, kept[:, None] - true_positive, n_src - true_positive
+        ],
+                           dim=-1)
+
+    def update(self, y_pred, y_true, metadata):
+        """Adds a batch.
+
+        Args:
+            - y_pred (list of dict): Predictions, with geometries and "scores"
+            - y_true (list of dict): Ground truth of the same images
+            - metadata (Tensor): Metadata of the batch
+        """
+        g = self.grouper.metadata_to_group(metadata).cpu()
+        for group_idx, gt, target in zip(g.tolist(), y_true, y_pred):
+            counts = self.image_counts(gt[self.geometry_name],
+                                       target[self.geometry_name],
+                                       target["scores"])
+            for metric, rate_sum in self._rate_sums.items():
+                rate_sum[group_idx] += rates_from_counts(
+                    counts.reshape(-1, 3), metric).reshape(counts.shape[:2])
+            self._counts[group_idx] += counts
+            self._group_counts[group_idx] += 1
+
+    def average_precision(self, counts):
+        """(T,) interpolated average precision of pooled (S, T, 3) counts, NaN without any
+        ground truth."""
+        true_positive, false_positive, false_negative = counts.unbind(-1)
+        n_src = (true_positive + false_negative)[0]
+        recall = true_positive / n_src.clamp(min=1)
+        precision = true_positive / (true_positive +
+                                     false_positive).clamp(min=1)
+        # Points with predictions, whose precision is defined
+        defined = (true_positive + false_positive) > 0
+        recall_levels = torch.linspace(0, 1, 101, dtype=torch.float64)
+        # Interpolated precision: the highest precision at a recall of at least the level
+        reached = defined[None] & (recall[None] >= recall_levels[:, None, None])
+        interpolated = torch.where(reached, precision[None], 0).amax(dim=1)
+        ap = interpolated.mean(dim=0)
+        return torch.where(n_src > 0, ap, torch.nan)
+
+    def compute(self):
+        """
+        Output:
+            - results (dict): The score_thresholds (S,) and iou_thresholds (T,), and for
+              the whole data ('avg') and each group: (S, T) 'accuracy', 'recall' and
+              'precision', (T,) 'ap', and 'map', its mean over the iou thresholds
+            - results_str (str): Pretty print version of the average precisions
+        """
+        results = {
+            'score_thresholds': self.score_thresholds,
+            'iou_thresholds': self.iou_thresholds
+        }
+
+        def add(suffix, rate_sums, counts, n):
+            for metric, rate_sum in rate_sums.items():
+                results[f'{metric}_{suffix}'] = rate_sum / n if n > 0 else (
+                    torch.full_like(rate_sum, torch.nan))
+            ap = self.average_precision(counts)
+            results[f'ap_{suffix}'] = ap
+            results[f'map_{suffix}'] = ap.mean().item()
+
+        add('avg', {
+            metric: rate_sum.sum(0)
+            for metric, rate_sum in self._rate_sums.items()
+        }, self._counts.sum(0),
+            self._group_counts.sum().item())
+        thresholds = (f'{self.iou_thresholds[0]:.2f}:'
+                      f'{self.iou_thresholds[-1]:.2f}')
+        results_str = f"Average precision, iou {thresholds}: {results['map_avg']:.3f}\n"
+        for group_idx in range(self.grouper.n_groups):
+            group_str = self.grouper.group_field_str(group_idx)
+            n = self._group_counts[group_idx].item()
+            add(
+                group_str, {
+                    metric: rate_sum[group_idx]
+                    for metric, rate_sum in self._rate_sums.items()
+                }, self._counts[group_idx], n)
+            results[f'count_{group_str}'] = n
+            if n == 0:
+                continue
+            results_str += (f'  {self.grouper.group_str(group_idx)}  '
+                            f"[n = {n:6.0f}]:\t"
+                            f"ap = {results[f'map_{group_str}']:5.3f}\n")
+        return results, results_str
@@ -108,17 +108,22 @@ class Metric:
         group_metrics, group_counts, worst_group_metric = self._compute_group_wise(
             y_pred, y_true, g, n_groups)
         if return_dict:
-            results = {}
-            for group_idx in range(n_groups):
-                results[self.group_metric_field(
-                    group_idx)] = group_metrics[group_idx].item()
-                results[self.group_count_field(
-                    group_idx)] = group_counts[group_idx].item()
-            results[self.worst_group_metric_field] = worst_group_metric.item()
-            return results
+            return self._group_results(group_metrics, group_counts,
+                                       worst_group_metric)
         else:
             return group_metrics, group_counts, worst_group_metric
 
+    def _group_results(self, group_metrics, group_counts, worst_group_metric):
+        """The dictionary returned by compute_group_wise."""
+        results = {}
+        for group_idx in range(len(group_metrics)):
+            results[self.group_metric_field(
+                group_idx)] = group_metrics[group_idx].item()
+            results[self.group_count_field(
+                group_idx)] = group_counts[group_idx].item()
+        results[self.worst_group_metric_field] = worst_group_metric.item()
+        return results
+
     def _compute_group_wise(self, y_pred, y_true, g, n_groups):
         group_metrics = []
         group_counts = get_counts(g, n_groups)
@@ -136,9 +141,32 @@ class Metric:
         return group_metrics, group_counts, worst_group_metric
 
 
+class ElementValues:
+    """Element-wise metric values computed ahead of time, e.g. batch by batch while streaming
+    predictions from a file.
+
+    Pass the same ElementValues as y_pred and y_true to an ElementwiseMetric, or to a
+    dataset's eval, to aggregate the stored values instead of recomputing them.
+
+    Args:
+        - values (dict): ElementwiseMetric to its element-wise values (Tensor)
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def numel(self):
+        return min((len(v) for v in self.values.values()), default=0)
+
+
 class ElementwiseMetric(Metric):
     """Averages."""
 
+    def _element_values(self, y_pred, y_true):
+        if isinstance(y_pred, ElementValues):
+            return y_pred.values[self]
+        return self._compute_element_wise(y_pred, y_true)
+
     def _compute_element_wise(self, y_pred, y_true):
         """Helper for computing element-wise metric, implemented for each metric.
 
@@ -169,12 +197,12 @@ class ElementwiseMetric(Metric):
         Output:
             - avg_metric (0-dim tensor): average of element-wise metrics
         """
-        element_wise_metrics = self._compute_element_wise(y_pred, y_true)
+        element_wise_metrics = self._element_values(y_pred, y_true)
         avg_metric = element_wise_metrics.mean()
         return avg_metric
 
     def _compute_group_wise(self, y_pred, y_true, g, n_groups):
-        element_wise_metrics = self._compute_element_wise(y_pred, y_true)
+        element_wise_metrics = self._element_values(y_pred, y_true)
         group_metrics, group_counts = avg_over_groups(element_wise_metrics, g,
                                                       n_groups)
         worst_group_metric = self.worst(group_metrics[group_counts > 0])
@@ -217,6 +245,106 @@ class ElementwiseMetric(Metric):
         else:
             return flattened_metrics, index
 
+    def accumulator(self, grouper):
+        """A streaming evaluator of this metric, see ElementwiseAccumulator."""
+        return ElementwiseAccumulator(self, grouper)
+
+
+class ElementwiseAccumulator:
+    """Evaluates an ElementwiseMetric batch by batch, e.g. inside the loop over an eval
+    loader, with constant memory.
+
+    Only the running sum and count of the element-wise metric of each group are kept. Sums
+    are kept in double precision, so the results agree with those of
+    MillionTreesDataset.standard_group_eval on the whole split, which averages in single
+    precision, to within float32 rounding (a relative difference of about 1e-6),
+    however the data is batched.
+
+    Args:
+        - metric (ElementwiseMetric): Metric to compute
+        - grouper (CombinatorialGrouper): Grouper object that converts metadata into groups
+    """
+
+    def __init__(self, metric, grouper):
+        self.metric = metric
+        self.grouper = grouper
+        self.reset()
+
+    def reset(self):
+        """Forgets every batch seen so far."""
+        self._group_sums = torch.zeros(self.grouper.n_groups,
+                                       dtype=torch.float64)
+        self._group_counts = torch.zeros(self.grouper.n_groups)
+
+    def update(self, y_pred, y_true, metadata):
+        """Adds a batch.
+
+        Args:
+            - y_pred: Predicted targets of the batch
+            - y_true: True targets of the batch
+            - metadata (Tensor): Metadata of the batch
+        """
+        values = self.metric._element_values(y_pred, y_true).detach().cpu()
+        g = self.grouper.metadata_to_group(metadata).cpu()
+        self._group_sums.index_add_(0, g, values.double())
+        self._group_counts += get_counts(g, self.grouper.n_groups)
+
+    def compute(self, aggregate=True):
+        """
+        Args:
+            - aggregate (bool): Whether to include the metric over all groups
+        Output:
+            - results (dict): Dictionary of results
+            - results_str (str): Pretty print version of the results
+            Both as returned by MillionTreesDataset.standard_group_eval. Metrics of
+            empty groups, and the aggregate if there are no elements, are NaN.
+        """
+        results = {}
+        if aggregate:
+            agg_metric = (self._group_sums.sum() /
+                          self._group_counts.sum()).float()
+            results[self.metric.agg_metric_field] = agg_metric.item()
+        group_metrics = (self._group_sums / self._group_counts).float()
+        worst_group_metric = self.metric.worst(
+            group_metrics[self._group_counts > 0])
+        group_results = self.metric._group_results(group_metrics,
+                                                   self._group_counts,
+                                                   worst_group_metric)
+        return group_eval_results(self.metric, self.grouper, results,
+                                  group_results)
+
+
+def group_eval_results(metric, grouper, results, group_results):
+    """Names the group results of a metric by group and formats them.
+
+    Args:
+        - metric (Metric): Evaluated metric
+        - grouper (CombinatorialGrouper): Grouper the groups come from
+        - results (dict): Aggregate results, from metric.compute, or empty
+        - group_results (dict): Results of metric.compute_group_wise
+    Output:
+        - results (dict): Dictionary of results
+        - results_str (str): Pretty print version of the results
+    """
+    results, results_str = dict(results), ''
+    if metric.agg_metric_field in results:
+        results_str += f"Average {metric.name}: {results[metric.agg_metric_field]:.3f}\n"
+    for group_idx in range(grouper.n_groups):
+        group_str = grouper.group_field_str(group_idx)
+        group_metric = group_results[metric.group_metric_field(group_idx)]
+        group_counts = group_results[metric.group_count_field(group_idx)]
+        results[f'{metric.name}_{group_str}'] = group_metric
+        results[f'count_{group_str}'] = group_counts
+        if group_counts == 0:
+            continue
+        results_str += (f'  {grouper.group_str(group_idx)}  '
+                        f"[n = {group_counts:6.0f}]:\t"
+                        f"{metric.name} = {group_metric:5.3f}\n")
+    results[f'{metric.worst_group_metric_field}'] = group_results[
+        f'{metric.worst_group_metric_field}']
+    results_str += f"Worst-group {metric.name}: {group_results[metric.worst_group_metric_field]:.3f}\n"
+    return results, results_str
+
 
 class MultiTaskMetric(Metric):
 
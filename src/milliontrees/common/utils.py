@@ -148,10 +148,29 @@ def threshold_at_recall(y_pred, y_true, global_recall=60):
     return np.percentile(y_pred[y_true == 1], 100 - global_recall)
 
 
+def normalize_images(x):
+    """Converts a batch of uint8 images to float32 in [0, 1].
+
+    Datasets created with image_dtype='uint8' keep images as uint8 until collation, so
+    normalization runs once per batch instead of once per full-resolution image. Float
+    inputs are returned unchanged.
+
+    Args:
+        x (Tensor): Image batch, uint8 or float.
+    Returns:
+        Tensor: float image batch.
+    """
+    if x.dtype == torch.uint8:
+        return x.float().div_(255)
+    return x
+
+
 def numel(obj):
     if torch.is_tensor(obj):
         return obj.numel()
     elif isinstance(obj, list):
         return len(obj)
+    elif hasattr(obj, 'numel'):
+        return obj.numel()
     else:
         raise TypeError('Invalid type for numel')
@@ -1,17 +1,16 @@
 from datetime import datetime
 from pathlib import Path
-import os
 
-import pandas as pd
 import numpy as np
 import torch
 import albumentations as A
 import torchvision.transforms as T
 
 from milliontrees.datasets.milliontrees_dataset import MillionTreesDataset
+from milliontrees.datasets.annotation_index import load_annotation_index
 from milliontrees.common.grouper import CombinatorialGrouper
-from milliontrees.common.metrics.all_metrics import DetectionAccuracy
-from PIL import Image
+from milliontrees.common.utils import normalize_images
+from milliontrees.common.metrics.all_metrics import BoxMatches, DetectionAccuracy
 from albumentations.pytorch import ToTensorV2
 
 
@@ -74,10 +73,24 @@ class TreeBoxesDataset(MillionTreesDataset):
                  split_scheme='official',
                  geometry_name='y',
                  eval_score_threshold=0.1,
-                 image_size=448):
+                 image_size=448,
+                 image_dtype='float32',
+                 decode_backend='pil',
+                 reduced_decode=False,
+                 image_cache=None,
+                 shared_cache_bytes=None,
+                 from_zip=False,
+                 sources=None,
+                 splits=None):
 
         self._version = version
         self._split_scheme = split_scheme
+        self._image_dtype = image_dtype
+        self._decode_backend = decode_backend
+        self._reduced_decode = reduced_decode
+        self._from_zip = from_zip
+        self._sources = sources
+        self._splits = splits
         self.geometry_name = geometry_name
         self.eval_score_threshold = eval_score_threshold
         self.image_size = image_size
@@ -89,9 +102,6 @@ class TreeBoxesDataset(MillionTreesDataset):
         # path
         self._data_dir = Path(self.initialize_data_dir(root_dir, download))
 
-        # Load splits
-        df = pd.read_csv(self._data_dir / '{}.csv'.format(split_scheme))
-
         # Splits
         self._split_dict = {
             'train': 0,
@@ -104,20 +114,22 @@ class TreeBoxesDataset(MillionTreesDataset):
             'test': 'Test (OOD/Trans)',
         }
 
-        unique_files = df.drop_duplicates(subset=['filename'],
-                                          inplace=False).reset_index(drop=True)
-        unique_files['split_id'] = unique_files['split'].apply(
-            lambda x: self._split_dict[x])
-        self._split_array = unique_files['split_id'].values
+        # Load splits from the compiled annotation index
+        index = load_annotation_index(
+            self._data_dir / '{}.csv'.format(split_scheme),
+            value_columns=["xmin", "ymin", "xmax", "ymax"],
+            value_dtype="float32",
+            zip_archive=self.zip_archive)
+        index = self._init_from_index(index)
+        self._y_array = index.y
 
-        # Filenames
-        self._input_array = unique_files.filename
+        # Pre-resized images, see materialize_cache
+        if image_cache:
+            self.load_image_cache(None if image_cache is True else image_cache)
 
-        # Create lookup table for which index to select for each filename
-        self._input_lookup = df.groupby('filename').apply(
-            lambda x: x.index.values).to_dict()
-        self._y_array = df[["xmin", "ymin", "xmax",
-                            "ymax"]].values.astype("float32")
+        # Decoded images shared by DataLoader workers, see enable_shared_cache
+        if shared_cache_bytes:
+            self.enable_shared_cache(shared_cache_bytes)
 
         # Labels -> just 'Tree'
         self._n_classes = 1
@@ -126,41 +138,19 @@ class TreeBoxesDataset(MillionTreesDataset):
         self._y_size = 4
 
         # Class labels
-        self.labels = torch.zeros(df.shape[0])
-
-        # Create source locations with a numeric ID
-        df["source_id"] = df.source.astype('category').cat.codes
-
-        # Create filename numeric ID
-        df["filename_id"] = df.filename.astype('category').cat.codes
-
-        # Create dictionary for codes to names
-        self._source_id_to_code = df.set_index('source_id')['source'].to_dict()
-        self._filename_id_to_code = df.set_index(
-            'filename_id')['filename'].to_dict()
-
-        # Location/group info
-        n_groups = max(df['source_id']) + 1
-        self._n_groups = n_groups
-        assert len(np.unique(df['source_id'])) == self._n_groups
-
-        # Metadata is at the image level
-        unique_sources = df[['filename_id', 'source_id']].drop_duplicates(
-            subset="filename_id", inplace=False).reset_index(drop=True)
-        self._metadata_array = torch.tensor(unique_sources.values.astype('int'))
-        self._metadata_fields = ['filename_id', 'source_id']
+        self.labels = torch.zeros(index.n_annotations)
 
         self._collate = TreeBoxesDataset._collate_fn
 
+        # The metrics share the matching of the predictions of each image
+        self._matches = BoxMatches()
         self.metrics = {
-            "accuracy":
-                DetectionAccuracy(geometry_name=self.geometry_name,
-                                  score_threshold=self.eval_score_threshold,
-                                  metric="accuracy"),
-            "recall":
+            metric:
                 DetectionAccuracy(geometry_name=self.geometry_name,
                                   score_threshold=self.eval_score_threshold,
-                                  metric="recall"),
+                                  metric=metric,
+                                  matches=self._matches)
+            for metric in ("accuracy", "recall", "precision")
         }
 
         # eval grouper
@@ -179,12 +169,14 @@ class TreeBoxesDataset(MillionTreesDataset):
 
         results = {}
         results_str = ''
-        for metric in self.metrics:
-            result, result_str = self.standard_group_eval(
-                self.metrics[metric], self._eval_grouper, y_pred, y_true,
-                metadata)
-            results[metric] = result
-            results_str += result_str
+        # The metrics share the matching of each image
+        with self._matches.reuse():
+            for metric in self.metrics:
+                result, result_str = self.standard_group_eval(
+                    self.metrics[metric], self._eval_grouper, y_pred, y_true,
+                    metadata)
+                results[metric] = result
+                results_str += result_str
 
         detection_accs = []
         for k, v in results["accuracy"].items():
@@ -199,23 +191,21 @@ class TreeBoxesDataset(MillionTreesDataset):
 
         return results, results_str
 
-    def get_input(self, idx):
-        """Retrieves the input features (image) for a given data point.
-
-        Args:
-            idx (int): Index of a data point
-
-        Returns:
-            np.ndarray: Input features of the idx-th data point (image) as a normalized numpy array.
-        """
-        # All images are in the images folder
-        img_path = os.path.join(self._data_dir / 'images' /
-                                self._input_array[idx])
-        img = Image.open(img_path)
-        img = np.array(img.convert('RGB')) / 255
-        img = np.array(img, dtype=np.float32)
-
-        return img
+    def _eval_target(self, idx, scale):
+        """Boxes of the idx-th image resized by scale, clipped to the image like the
+        BboxParams(clip=True) of _transform_."""
+        targets = super()._eval_target(idx, scale)
+        targets[self.geometry_name] = targets[self.geometry_name].clamp(
+            0, self.image_size)
+        return targets
+
+    def _prediction_from_rows(self, rows):
+        boxes = rows[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(np.float32)
+        return {
+            self.geometry_name: torch.from_numpy(boxes.reshape(-1, 4)),
+            "scores": torch.from_numpy(rows['score'].to_numpy(np.float32)),
+            "labels": torch.zeros(len(rows), dtype=torch.int64)
+        }
 
     @staticmethod
     def _collate_fn(batch):
@@ -234,7 +224,7 @@ class TreeBoxesDataset(MillionTreesDataset):
                 - Stacked `metadata`.
         """
         batch = list(zip(*batch))
-        batch[1] = torch.stack(batch[1])
+        batch[1] = normalize_images(torch.stack(batch[1]))
         batch[0] = torch.stack(batch[0])
         batch[2] = list(batch[2])
 
@@ -1,15 +1,14 @@
 from datetime import datetime
 from pathlib import Path
-import os
 
-import pandas as pd
 import numpy as np
 import torch
 
 from milliontrees.datasets.milliontrees_dataset import MillionTreesDataset
+from milliontrees.datasets.annotation_index import load_annotation_index
 from milliontrees.common.grouper import CombinatorialGrouper
-from milliontrees.common.metrics.all_metrics import KeypointAccuracy
-from PIL import Image
+from milliontrees.common.utils import normalize_images
+from milliontrees.common.metrics.all_metrics import KeypointAccuracy, PointMatches
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 
@@ -53,6 +52,8 @@ class TreePointsDataset(MillionTreesDataset):
                 1459676926
         }
     }
+    # Inverse distances of sweep: matches within 40 down to 2 pixels
+    _sweep_iou_thresholds = tuple(1 / np.array([40, 30, 20, 15, 10, 5, 2]))
 
     def __init__(self,
                  version=None,
@@ -60,12 +61,28 @@ class TreePointsDataset(MillionTreesDataset):
                  download=False,
                  split_scheme='official',
                  geometry_name='y',
-                 distance_threshold=0.1):
+                 distance_threshold=0.1,
+                 image_size=448,
+                 image_dtype='float32',
+                 decode_backend='pil',
+                 reduced_decode=False,
+                 image_cache=None,
+                 shared_cache_bytes=None,
+                 from_zip=False,
+                 sources=None,
+                 splits=None):
 
         self._version = version
         self._split_scheme = split_scheme
+        self._image_dtype = image_dtype
+        self._decode_backend = decode_backend
+        self._reduced_decode = reduced_decode
+        self._from_zip = from_zip
+        self._sources = sources
+        self._splits = splits
         self.geometry_name = geometry_name
         self.distance_threshold = distance_threshold
+        self.image_size = image_size
 
         if self._split_scheme not in ['official', 'crossgeometry', 'zeroshot']:
             raise ValueError(
@@ -74,9 +91,6 @@ class TreePointsDataset(MillionTreesDataset):
         # path
         self._data_dir = Path(self.initialize_data_dir(root_dir, download))
 
-        # Load splits
-        self.df = pd.read_csv(self._data_dir / '{}.csv'.format(split_scheme))
-
         # Splits
         self._split_dict = {
             'train': 0,
@@ -89,21 +103,24 @@ class TreePointsDataset(MillionTreesDataset):
             'test': 'Test',
         }
 
-        unique_files = self.df.drop_duplicates(
-            subset=['filename'], inplace=False).reset_index(drop=True)
-        unique_files['split_id'] = unique_files['split'].apply(
-            lambda x: self._split_dict[x])
-        self._split_array = unique_files['split_id'].values
+        # Load splits from the compiled annotation index
+        index = load_annotation_index(self._data_dir /
+                                      '{}.csv'.format(split_scheme),
+                                      value_columns=["x", "y"],
+                                      value_dtype="int64",
+                                      zip_archive=self.zip_archive)
+        index = self._init_from_index(index)
 
-        # Filenames
-        self._input_array = unique_files.filename
+        # Point labels
+        self._y_array = index.y
 
-        # Create lookup table for which index to select for each filename
-        self._input_lookup = self.df.groupby('filename').apply(
-            lambda x: x.index.values).to_dict()
+        # Pre-resized images, see materialize_cache
+        if image_cache:
+            self.load_image_cache(None if image_cache is True else image_cache)
 
-        # Point labels
-        self._y_array = self.df[["x", "y"]].values.astype(int)
+        # Decoded images shared by DataLoader workers, see enable_shared_cache
+        if shared_cache_bytes:
+            self.enable_shared_cache(shared_cache_bytes)
 
         # Labels -> just 'Tree'
         self._n_classes = 1
@@ -112,31 +129,11 @@ class TreePointsDataset(MillionTreesDataset):
         self._y_size = 4
 
         # Class labels
-        self.labels = np.zeros(self.df.shape[0])
-
-        # Create dictionary for codes to names
-        # Create source locations with a numeric ID
-        self.df["source_id"] = self.df.source.astype('category').cat.codes
-
-        # Create filename numeric ID
-        self.df["filename_id"] = self.df.filename.astype('category').cat.codes
-        self._source_id_to_code = self.df.set_index(
-            'source_id')['source'].to_dict()
-        self._filename_id_to_code = self.df.set_index(
-            'filename_id')['filename'].to_dict()
-
-        # Location/group info
-        n_groups = max(self.df['source_id']) + 1
-        self._n_groups = n_groups
-        assert len(np.unique(self.df['source_id'])) == self._n_groups
-
-        # Metadata is at the image level
-        unique_sources = self.df[['filename_id', 'source_id']].drop_duplicates(
-            subset="filename_id", inplace=False).reset_index(drop=True)
-        self._metadata_array = torch.tensor(unique_sources.values.astype('int'))
-        self._metadata_fields = ['filename_id', 'source_id']
-
-        self._metric = KeypointAccuracy(distance_threshold=distance_threshold)
+        self.labels = np.zeros(index.n_annotations)
+
+        self._matches = PointMatches()
+        self._metric = KeypointAccuracy(distance_threshold=distance_threshold,
+                                        matches=self._matches)
         self._collate = TreePointsDataset._collate_fn
 
         # eval grouper
@@ -146,10 +143,6 @@ class TreePointsDataset(MillionTreesDataset):
 
         super().__init__(root_dir, download, split_scheme)
 
-    def get_annotation_from_filename(self, filename):
-        indices = self._input_lookup[filename]
-        return self._y_array[indices]
-
     def eval(self, y_pred, y_true, metadata):
         """The main evaluation metric, detection_acc_avg_dom, measures the simple average of the
         detection accuracies of each domain."""
@@ -171,21 +164,13 @@ class TreePointsDataset(MillionTreesDataset):
 
         return results, results_str
 
-    def get_input(self, idx):
-        """
-        Args:
-            - idx (int): Index of a data point
-        Output:
-            - x (np.ndarray): Input features of the idx-th data point
-        """
-        # All images are in the images folder
-        img_path = os.path.join(self._data_dir / 'images' /
-                                self._input_array[idx])
-        img = Image.open(img_path)
-        img = np.array(img.convert('RGB')) / 255
-        img = np.array(img, dtype=np.float32)
-
-        return img
+    def _prediction_from_rows(self, rows):
+        points = rows[['x', 'y']].to_numpy(np.float32)
+        return {
+            self.geometry_name: torch.from_numpy(points.reshape(-1, 2)),
+            "scores": torch.from_numpy(rows['score'].to_numpy(np.float32)),
+            "labels": torch.zeros(len(rows), dtype=torch.int64)
+        }
 
     @staticmethod
     def _collate_fn(batch):
@@ -195,18 +180,20 @@ class TreePointsDataset(MillionTreesDataset):
         ..), ..]
         """
         batch = list(zip(*batch))
-        batch[1] = torch.stack(batch[1])
+        batch[1] = normalize_images(torch.stack(batch[1]))
         batch[0] = torch.stack(batch[0])
         batch[2] = list(batch[2])
 
         return tuple(batch)
 
     def _transform_(self):
-        self.transform = A.Compose(
-            [A.Resize(height=448, width=448, p=1.0),
-             ToTensorV2()],
-            keypoint_params=A.KeypointParams(format='xy',
-                                             label_fields=['labels'],
-                                             remove_invisible=False))
+        self.transform = A.Compose([
+            A.Resize(height=self.image_size, width=self.image_size, p=1.0),
+            ToTensorV2()
+        ],
+                                   keypoint_params=A.KeypointParams(
+                                       format='xy',
+                                       label_fields=['labels'],
+                                       remove_invisible=False))
 
         return self.transform
@@ -3,17 +3,24 @@ from pathlib import Path
 import os
 
 from PIL import Image, ImageDraw
-import pandas as pd
 import numpy as np
-from shapely import from_wkt
 from milliontrees.datasets.milliontrees_dataset import MillionTreesDataset
+from milliontrees.datasets.annotation_index import load_annotation_index, WKBArray
+from milliontrees.datasets.mask_store import MaskStore, write_mask_store
+from milliontrees.common.mask_utils import RLEMasks, rle_encode
+from milliontrees.datasets.image_io import read_image_size
 from milliontrees.common.grouper import CombinatorialGrouper
-from milliontrees.common.metrics.all_metrics import MaskAccuracy
+from milliontrees.common.utils import normalize_images
+from milliontrees.common.metrics.all_metrics import DetectionMatches, MaskAccuracy, PolygonAccuracy, PolygonMatches, mask_iou
 from torchvision.tv_tensors import BoundingBoxes, Mask
 from torchvision.ops import masks_to_boxes
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import torch
+import torch.nn.functional as F
+import shapely
+from shapely import affinity, wkt
+from torch.utils.data import default_collate
 
 
 class TreePolygonsDataset(MillionTreesDataset):
@@ -70,23 +77,42 @@ class TreePolygonsDataset(MillionTreesDataset):
                  split_scheme='official',
                  geometry_name='y',
                  eval_score_threshold=0.5,
-                 image_size=448):
+                 image_size=448,
+                 geometry_cache_size=10000,
+                 mask_store=None,
+                 image_dtype='float32',
+                 decode_backend='pil',
+                 reduced_decode=False,
+                 image_cache=None,
+                 shared_cache_bytes=None,
+                 from_zip=False,
+                 sources=None,
+                 splits=None,
+                 eval_geometry='masks'):
 
         self._version = version
         self._split_scheme = split_scheme
+        self._image_dtype = image_dtype
+        self._decode_backend = decode_backend
+        self._reduced_decode = reduced_decode
+        self._from_zip = from_zip
+        self._sources = sources
+        self._splits = splits
         self.geometry_name = geometry_name
         self.image_size = image_size
         self.eval_score_threshold = eval_score_threshold
+        self._eval_geometry = eval_geometry
 
+        if eval_geometry not in ('masks', 'polygons'):
+            raise ValueError(
+                f"eval_geometry must be 'masks' or 'polygons', got {eval_geometry}"
+            )
         if self._split_scheme != 'official':
             raise ValueError(
                 f'Split scheme {self._split_scheme} not recognized')
         # path
         self._data_dir = Path(self.initialize_data_dir(root_dir, download))
 
-        # Load splits
-        df = pd.read_csv(self._data_dir / '{}.csv'.format(split_scheme))
-
         # Splits
         self._split_dict = {
             'train': 0,
@@ -99,26 +125,30 @@ class TreePolygonsDataset(MillionTreesDataset):
             'test': 'Test (OOD/Trans)',
         }
 
-        unique_files = df.drop_duplicates(subset=['filename'],
-                                          inplace=False).reset_index(drop=True)
-        unique_files['split_id'] = unique_files['split'].apply(
-            lambda x: self._split_dict[x])
-        self._split_array = unique_files['split_id'].values
+        # Load splits from the compiled annotation index
+        index = load_annotation_index(self._data_dir /
+                                      '{}.csv'.format(split_scheme),
+                                      wkt_column='polygon',
+                                      zip_archive=self.zip_archive)
+        index = self._init_from_index(index)
 
-        df['split_id'] = df['split'].apply(lambda x: self._split_dict[x])
-        self._split_array = df['split_id'].values
+        # Polygons stay WKB encoded until __getitem__ needs them
+        self._y_array = WKBArray(index.wkb,
+                                 index.wkb_offsets,
+                                 cache_size=geometry_cache_size)
 
-        # Filenames
-        self._input_array = unique_files.filename
+        # Precomputed masks, see build_mask_store
+        self._mask_store = None
+        if mask_store:
+            self.load_mask_store(None if mask_store is True else mask_store)
 
-        # Create lookup table for which index to select for each filename
-        self._input_lookup = df.groupby('filename').apply(
-            lambda x: x.index.values).to_dict()
+        # Pre-resized images, see materialize_cache
+        if image_cache:
+            self.load_image_cache(None if image_cache is True else image_cache)
 
-        # Convert each polygon to shapely objects
-        df['polygon'] = df['polygon'].apply(from_wkt)
-
-        self._y_array = list(df['polygon'].values)
+        # Decoded images shared by DataLoader workers, see enable_shared_cache
+        if shared_cache_bytes:
+            self.enable_shared_cache(shared_cache_bytes)
 
         # Labels -> just 'Tree'
         self._n_classes = 1
@@ -126,39 +156,23 @@ class TreePolygonsDataset(MillionTreesDataset):
         # Not clear what this is, since we have a polygon, unknown size
         self._y_size = 4
 
-        # Create source locations with a numeric ID
-        df["source_id"] = df.source.astype('category').cat.codes
-
-        # Create filename numeric ID
-        df["filename_id"] = df.filename.astype('category').cat.codes
-
-        # Create dictionary for codes to names
-        self._source_id_to_code = df.set_index('source_id')['source'].to_dict()
-        self._filename_id_to_code = df.set_index(
-            'filename_id')['filename'].to_dict()
-
-        # Location/group info
-        n_groups = max(df['source_id']) + 1
-        self._n_groups = n_groups
-        assert len(np.unique(df['source_id'])) == self._n_groups
-
-        # Metadata is at the image level
-        unique_sources = df[['filename_id', 'source_id']].drop_duplicates(
-            subset="filename_id", inplace=False).reset_index(drop=True)
-        self._metadata_array = torch.tensor(unique_sources.values.astype('int'))
-        self._metadata_fields = ['filename_id', 'source_id']
-
-        # eval grouper
+        # The metrics share the matching of the predictions of each image.
+        # eval_geometry='polygons' scores shapely polygons without rasterizing them.
+        if eval_geometry == 'polygons':
+            self._matches = PolygonMatches()
+            accuracy = PolygonAccuracy
+        else:
+            self._matches = DetectionMatches(mask_iou)
+            accuracy = MaskAccuracy
         self.metrics = {
-            "accuracy":
-                MaskAccuracy(geometry_name=self.geometry_name,
-                             score_threshold=self.eval_score_threshold,
-                             metric="accuracy"),
-            "recall":
-                MaskAccuracy(geometry_name=self.geometry_name,
-                             score_threshold=self.eval_score_threshold,
-                             metric="recall"),
+            metric:
+                accuracy(geometry_name=self.geometry_name,
+                         score_threshold=self.eval_score_threshold,
+                         metric=metric,
+                         matches=self._matches)
+            for metric in ("accuracy", "recall", "precision")
         }
+        self._collate = TreePolygonsDataset._collate_fn
         self._eval_grouper = CombinatorialGrouper(dataset=self,
                                                   groupby_fields=(['source_id'
                                                                   ]))
@@ -178,20 +192,34 @@ class TreePolygonsDataset(MillionTreesDataset):
                 - "bboxes" (BoundingBoxes): Bounding boxes of the polygons
                 - "labels" (np.ndarray): Labels for each mask (all zeros in this case)
         """
-        x = self.get_input(idx)
-        y_indices = self._input_lookup[self._input_array[idx]]
-        y_polygons = [self._y_array[i] for i in y_indices]
-        mask_imgs = [
-            self.create_polygon_mask(x.shape[:2], y_polygon)
-            for y_polygon in y_polygons
-        ]
-        masks = torch.stack([Mask(mask_img) for mask_img in mask_imgs])
-        bboxes = BoundingBoxes(data=masks_to_boxes(masks),
+        if self.image_cache is not None:
+            x = self.image_cache.image(idx, self.image_dtype)
+            masks, boxes = self.image_cache.masks[idx]
+        elif self._mask_store is not None:
+            x, scale = self._load_input(idx)
+            masks, boxes = self._mask_store[idx]
+            if tuple(scale) != (1.0, 1.0):
+                masks = F.interpolate(torch.from_numpy(masks)[None],
+                                      size=x.shape[:2],
+                                      mode='nearest')[0].numpy()
+                boxes = self._rescale(boxes, scale)
+        else:
+            x, scale = self._load_input(idx)
+            return self._item_from_annotations(
+                self._metadata_array[idx], x,
+                self._y_array[self._annotation_slice(idx)], scale)
+
+        return self._item_from_masks(self._metadata_array[idx], x, masks, boxes)
+
+    def _item_from_annotations(self, metadata, x, y, scale):
+        """Builds a data point from a decoded image and its polygons, see __getitem__."""
+        masks, boxes = self._rasterize_polygons(y, x.shape[:2], scale)
+        return self._item_from_masks(metadata, x, masks, boxes)
+
+    def _item_from_masks(self, metadata, x, masks, boxes):
+        bboxes = BoundingBoxes(data=boxes,
                                format='xyxy',
                                canvas_size=x.shape[:2])
-        masks = np.stack([mask.numpy() for mask in masks])
-
-        metadata = self._metadata_array[idx]
         targets = {
             "y": masks,
             "bboxes": bboxes,
@@ -200,6 +228,152 @@ class TreePolygonsDataset(MillionTreesDataset):
 
         return metadata, x, targets
 
+    def _rasterize(self, idx, image_shape, scale=(1.0, 1.0)):
+        """Rasterizes the polygons of the idx-th image.
+
+        Args:
+            - idx (int): Index of an image
+            - image_shape (tuple): (H, W) of the masks
+            - scale (tuple): (sx, sy) applied to the polygon coordinates first
+        Returns:
+            - masks (np.ndarray): uint8 masks of shape (N, H, W)
+            - boxes (Tensor): xyxy boxes of the masks
+        """
+        return self._rasterize_polygons(
+            self._y_array[self._annotation_slice(idx)], image_shape, scale)
+
+    def _rasterize_polygons(self, y_polygons, image_shape, scale=(1.0, 1.0)):
+        """Rasterizes a sequence of shapely polygons, see _rasterize."""
+        if len(y_polygons) == 0:
+            return np.zeros((0, *image_shape),
+                            dtype=np.uint8), torch.zeros(0, 4)
+        if tuple(scale) != (1.0, 1.0):
+            y_polygons = [
+                affinity.scale(polygon,
+                               xfact=scale[0],
+                               yfact=scale[1],
+                               origin=(0, 0)) for polygon in y_polygons
+            ]
+        height, width = image_shape
+        mask_imgs = [
+            self.create_polygon_mask((width, height), y_polygon)
+            for y_polygon in y_polygons
+        ]
+        masks = torch.stack([Mask(mask_img) for mask_img in mask_imgs])
+        boxes = masks_to_boxes(masks)
+        masks = np.stack([mask.numpy() for mask in masks])
+        return masks, boxes
+
+    def _rasterize_rle(self, y_polygons, image_shape, scale=(1.0, 1.0)):
+        """Rasterizes polygons one at a time into run-length encoded masks, so only one
+        dense mask is held at once.
+
+        Returns:
+            - masks (RLEMasks): Masks of shape (N, H, W)
+        """
+        if tuple(scale) != (1.0, 1.0):
+            y_polygons = [
+                affinity.scale(polygon,
+                               xfact=scale[0],
+                               yfact=scale[1],
+                               origin=(0, 0)) for polygon in y_polygons
+            ]
+        height, width = image_shape
+        counts = [
+            rle_encode(
+                self.create_polygon_mask((width, height), y_polygon)[None])[0]
+            for y_polygon in y_polygons
+        ]
+        return RLEMasks(counts, image_shape)
+
+    def _eval_target(self, idx, scale):
+        """Run-length encoded masks of the idx-th image, rasterized directly at image_size
+        from the scaled polygons instead of resized from full-size masks, so edge pixels
+        may differ. With eval_geometry='polygons', the scaled polygons themselves."""
+        if self._eval_geometry == 'polygons':
+            polygons = shapely.transform(
+                np.asarray(self._y_array[self._annotation_slice(idx)],
+                           dtype=object).reshape(-1),
+                lambda coords: coords * np.asarray(scale))
+            return {
+                self.geometry_name:
+                    polygons,
+                "labels":
+                    torch.zeros(len(polygons), dtype=torch.int64),
+                "bboxes":
+                    torch.from_numpy(shapely.bounds(polygons).reshape(-1, 4)
+                                    ).float()
+            }
+        size = (self.image_size, self.image_size)
+        masks = self._rasterize_rle(self._y_array[self._annotation_slice(idx)],
+                                    size, scale)
+        return {
+            self.geometry_name: masks,
+            "labels": torch.zeros(len(masks), dtype=torch.int64),
+            "bboxes": torch.from_numpy(masks.boxes())
+        }
+
+    def _prediction_from_rows(self, rows):
+        polygons = shapely.from_wkt(rows['polygon'].to_numpy(dtype=object))
+        if self._eval_geometry == 'polygons':
+            geometries = polygons
+        else:
+            size = (self.image_size, self.image_size)
+            geometries = self._rasterize_rle(polygons, size)
+        return {
+            self.geometry_name: geometries,
+            "scores": torch.from_numpy(rows['score'].to_numpy(np.float32)),
+            "labels": torch.zeros(len(rows), dtype=torch.int64)
+        }
+
+    def _mask_store_dir(self, store_dir=None):
+        if store_dir is None:
+            store_dir = self._data_dir / f'{self._split_scheme}.masks'
+        return str(store_dir)
+
+    def build_mask_store(self, store_dir=None):
+        """Rasterizes the masks of every image once and writes them, run-length encoded, to
+        store_dir.
+
+        This is an offline step; afterwards construct the dataset with mask_store=True (or
+        the path) to serve masks from the store instead of rasterizing polygons on every
+        access. Image sizes are read from the image headers, so no image is decoded.
+
+        Args:
+            store_dir (str): Defaults to '<split_scheme>.masks' in the data directory.
+        Returns:
+            str: The store directory.
+        """
+        store_dir = self._mask_store_dir(store_dir)
+
+        def items():
+            for idx in range(len(self)):
+                width, height = read_image_size(self._image_source(idx))
+                masks, boxes = self._rasterize(idx, (height, width))
+                yield masks, boxes.numpy()
+
+        write_mask_store(store_dir,
+                         items(),
+                         stamp={'annotations': self._annotation_index.stamp})
+        self.load_mask_store(store_dir)
+        return store_dir
+
+    def load_mask_store(self, store_dir=None):
+        """Serves masks from a store written by build_mask_store."""
+        store_dir = self._mask_store_dir(store_dir)
+        if not os.path.exists(store_dir):
+            raise FileNotFoundError(
+                f'No mask store found at {store_dir}. Run dataset.build_mask_store() first.'
+            )
+        store = MaskStore.load(store_dir)
+        if (store.stamp or
+            {}).get('annotations') != self._annotation_index.stamp:
+            raise ValueError(
+                f'The mask store at {store_dir} was built from a different version of '
+                f'{self._split_scheme}.csv. Rebuild it with dataset.build_mask_store().'
+            )
+        self._mask_store = store
+
     def create_polygon_mask(self, image_size, vertices):
         """Create a grayscale image with a white polygonal area on a black background.
 
@@ -232,12 +406,14 @@ class TreePolygonsDataset(MillionTreesDataset):
 
         results = {}
         results_str = ''
-        for metric in self.metrics:
-            result, result_str = self.standard_group_eval(
-                self.metrics[metric], self._eval_grouper, y_pred, y_true,
-                metadata)
-            results[metric] = result
-            results_str += result_str
+        # The metrics share the matching of each image
+        with self._matches.reuse():
+            for metric in self.metrics:
+                result, result_str = self.standard_group_eval(
+                    self.metrics[metric], self._eval_grouper, y_pred, y_true,
+                    metadata)
+                results[metric] = result
+                results_str += result_str
 
         detection_accs = []
         for k, v in results["accuracy"].items():
@@ -252,21 +428,20 @@ class TreePolygonsDataset(MillionTreesDataset):
 
         return results, results_str
 
-    def get_input(self, idx):
-        """
+    @staticmethod
+    def _collate_fn(batch):
+        """Collates with the default torch collate, then converts uint8 images to float32.
+
         Args:
-            - idx (int): Index of a data point
-        Output:
-            - x (np.ndarray): Input features of the idx-th data point
+            batch (list): A batch of data points, where each data point is a tuple (metadata, x, y).
+
+        Returns:
+            list: Stacked metadata, stacked x and a dictionary of stacked targets.
         """
-        # All images are in the images folder
-        img_path = os.path.join(self._data_dir / 'images' /
-                                self._input_array[idx])
-        img = Image.open(img_path)
-        img = np.array(img.convert('RGB')) / 255
-        img = np.array(img, dtype=np.float32)
-
-        return img
+        batch = default_collate(batch)
+        batch[1] = normalize_images(batch[1])
+
+        return batch
 
     def _transform_(self):
         transform = A.Compose([
@@ -0,0 +1,446 @@
+"""Compiled, memory-mapped annotation index for the MillionTrees split files.
+
+Parsing a split csv (``official.csv``, ``zeroshot.csv``, ...) and regrouping
+millions of annotation rows by image dominates dataset construction time. The
+first time a split file is loaded, the parsed columns are written next to it as
+a directory of ``.npy`` files (``official.index/``). Later loads memory-map
+those arrays, so construction time no longer grows with the number of
+annotations. The index is rebuilt whenever the size or modification time of the
+csv changes, under a lock file, so concurrent first loads of a shared data
+directory build it once.
+
+Annotation rows are stored sorted by image: the rows of image ``i`` are
+``offsets[i]:offsets[i + 1]``. Images are kept in order of first appearance in
+the csv.
+"""
+from collections import OrderedDict
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from milliontrees.datasets.file_lock import FileLock
+
+# Bump when the on-disk layout changes so stale indices are rebuilt.
+INDEX_FORMAT_VERSION = 1
+
+
+class AnnotationIndex:
+    """Columnar annotations of one split file, grouped by image.
+
+    Attributes:
+        filenames (np.ndarray): Unique image filenames, in order of first appearance.
+        split (np.ndarray): Split name ('train', 'val', 'test') of each image.
+        filename_id (np.ndarray): Alphabetical rank of each image filename.
+        source_id (np.ndarray): Source id of each image.
+        sources (np.ndarray): Source names, indexed by source id.
+        offsets (np.ndarray): int64 array of length n_images + 1.
+        y (np.ndarray): Annotation coordinates sorted by image, or None.
+        wkb (np.ndarray): Concatenated WKB geometries sorted by image, or None.
+        wkb_offsets (np.ndarray): Byte offsets of each geometry in wkb, or None.
+    """
+
+    _array_names = [
+        'filenames', 'split', 'filename_id', 'source_id', 'sources', 'offsets',
+        'y', 'wkb', 'wkb_offsets'
+    ]
+
+    def __init__(self, stamp=None, **arrays):
+        self.stamp = stamp
+        for name in self._array_names:
+            setattr(self, name, arrays.get(name))
+
+    def __getstate__(self):
+        return pack_memmaps(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(unpack_memmaps(state))
+
+    @property
+    def n_images(self):
+        return len(self.filenames)
+
+    @property
+    def n_annotations(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def from_dataframe(cls,
+                       df,
+                       value_columns=None,
+                       value_dtype='float32',
+                       wkt_column=None):
+        """Groups the rows of a split dataframe by image.
+
+        Args:
+            df (pd.DataFrame): Split file with 'filename', 'split' and 'source' columns.
+            value_columns (list of str): Coordinate columns copied into y.
+            value_dtype (str): dtype of y.
+            wkt_column (str): Column of WKT geometries, stored as WKB.
+        Returns:
+            AnnotationIndex
+        """
+        image_codes, filenames = pd.factorize(df['filename'])
+        filenames = np.asarray(filenames).astype(str)
+        n_images = len(filenames)
+
+        # Stable sort keeps the csv order of rows within each image
+        order = np.argsort(image_codes, kind='stable')
+        offsets = np.zeros(n_images + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(image_codes, minlength=n_images))
+        first_row = order[offsets[:-1]]
+
+        # Ids follow pandas category codes, i.e. the sorted unique values
+        filename_id = np.argsort(np.argsort(filenames, kind='stable'),
+                                 kind='stable')
+        sources, source_codes = np.unique(df['source'].to_numpy(),
+                                          return_inverse=True)
+        if sources.dtype == object:
+            sources = sources.astype(str)
+
+        arrays = {
+            'filenames': filenames,
+            'split': df['split'].to_numpy()[first_row].astype(str),
+            'filename_id': filename_id.astype(np.int64),
+            'source_id': source_codes[first_row].astype(np.int64),
+            'sources': sources,
+            'offsets': offsets,
+        }
+        if value_columns is not None:
+            arrays['y'] = np.ascontiguousarray(
+                df[value_columns].to_numpy().astype(value_dtype)[order])
+        if wkt_column is not None:
+            from shapely import from_wkt, to_wkb
+            wkb = to_wkb(from_wkt(df[wkt_column].to_numpy()[order]))
+            lengths = np.fromiter((len(b) for b in wkb),
+                                  dtype=np.int64,
+                                  count=len(wkb))
+            wkb_offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+            wkb_offsets[1:] = np.cumsum(lengths)
+            arrays['wkb'] = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+            arrays['wkb_offsets'] = wkb_offsets
+        return cls(**arrays)
+
+    def select(self, images, **selection):
+        """An in-memory index restricted to some images.
+
+        Filename and source ids are kept, so metadata stays comparable with the full index.
+
+        Args:
+            images (np.ndarray): Boolean mask over images, or image indices in order.
+            selection: JSON-serializable description of the subset, added to the stamp.
+        Returns:
+            AnnotationIndex
+        """
+        images = np.asarray(images)
+        if images.dtype == bool:
+            images = np.flatnonzero(images)
+        starts, ends = self.offsets[images], self.offsets[images + 1]
+        rows = _ranges(starts, ends)
+        offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(ends - starts)
+        arrays = {
+            'filenames': self.filenames[images],
+            'split': self.split[images],
+            'filename_id': self.filename_id[images],
+            'source_id': self.source_id[images],
+            'sources': self.sources,
+            'offsets': offsets,
+        }
+        if self.y is not None:
+            arrays['y'] = self.y[rows]
+        if self.wkb is not None:
+            byte_starts = self.wkb_offsets[starts]
+            byte_ends = self.wkb_offsets[ends]
+            arrays['wkb'] = self.wkb[_ranges(byte_starts, byte_ends)]
+            lengths = self.wkb_offsets[rows + 1] - self.wkb_offsets[rows]
+            wkb_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            wkb_offsets[1:] = np.cumsum(lengths)
+            arrays['wkb_offsets'] = wkb_offsets
+        stamp = None if self.stamp is None else dict(self.stamp, **selection)
+        return AnnotationIndex(stamp=stamp, **arrays)
+
+    def save(self, index_dir, stamp):
+        """Writes the index atomically to index_dir."""
+        arrays = {name: getattr(self, name) for name in self._array_names}
+        save_arrays(index_dir, arrays, stamp)
+
+    @classmethod
+    def load(cls, index_dir):
+        """Memory-maps a saved index."""
+        return cls(**load_arrays(index_dir, cls._array_names))
+
+
+def _ranges(starts, ends):
+    """Concatenation of np.arange(start, end) for each pair, without a Python loop."""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Offset of each position from the start of its range
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+def save_arrays(out_dir, arrays, stamp):
+    """Atomically writes a directory of .npy arrays plus an 'index.json' stamp.
+
+    Args:
+        out_dir (str): Directory to create or replace.
+        arrays (dict): Name to np.ndarray. None values are skipped.
+        stamp (dict): JSON-serializable description used to detect stale files.
+    """
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    tmp_dir = tempfile.mkdtemp(prefix='.index-', dir=parent)
+    try:
+        saved = [name for name, value in arrays.items() if value is not None]
+        for name in saved:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), arrays[name])
+        with open(os.path.join(tmp_dir, 'arrays.json'), 'w') as f:
+            json.dump(saved, f)
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            json.dump(stamp, f)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_arrays(in_dir, names):
+    """Memory-maps the arrays written by save_arrays.
+
+    Arrays that were None when saved are omitted. Raises FileNotFoundError if any other
+    array, or the list of saved arrays, is missing, e.g. when the directory was deleted or
+    is incomplete.
+    """
+    with open(os.path.join(in_dir, 'arrays.json')) as f:
+        saved = set(json.load(f))
+    return {
+        name: np.load(os.path.join(in_dir, f'{name}.npy'), mmap_mode='r')
+        for name in names
+        if name in saved
+    }
+
+
+def _load_current(in_dir, names, stamp):
+    """The arrays of in_dir if they were saved with stamp, otherwise None."""
+    if read_stamp(in_dir) != stamp:
+        return None
+    try:
+        return load_arrays(in_dir, names)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load_or_build_arrays(out_dir, names, stamp, build):
+    """Memory-maps the arrays of out_dir if they were saved with stamp, otherwise builds
+    and saves them.
+
+    Arrays are built under a lock file shared by every process, so concurrent first loads
+    of a shared data directory build them once and never replace arrays that another
+    process has just written. Read-only directories get the built arrays, without the
+    cache.
+
+    Args:
+        out_dir (str): Directory of the saved arrays
+        names (list of str): Names of the arrays
+        stamp (dict): JSON-serializable description of the current source files
+        build (callable): Returns the dict of arrays, as passed to save_arrays
+    Returns:
+        dict: Name to array
+    """
+    arrays = _load_current(out_dir, names, stamp)
+    if arrays is not None:
+        return arrays
+    parent, name = os.path.split(os.path.abspath(out_dir))
+    lock = FileLock(os.path.join(parent, f'.{name}.lock'))
+    try:
+        lock.acquire()
+    except OSError:
+        # Read-only data directories still work, just without the cache
+        return build()
+    try:
+        # Another process may have built them while this one waited
+        arrays = _load_current(out_dir, names, stamp)
+        if arrays is None:
+            arrays = build()
+            try:
+                save_arrays(out_dir, arrays, stamp)
+                arrays = load_arrays(out_dir, names)
+            except OSError:
+                pass
+        return arrays
+    finally:
+        lock.release()
+
+
+class WKBArray:
+    """A read-only sequence of geometries stored as concatenated WKB buffers.
+
+    Geometries are parsed only when accessed. A bounded LRU cache keeps the most
+    recently decoded geometries, and slices or take() decode all uncached rows with a
+    single vectorized shapely.from_wkb call.
+
+    Args:
+        wkb (np.ndarray): uint8 buffer of concatenated WKB geometries.
+        offsets (np.ndarray): Byte offset of each geometry, of length n + 1.
+        cache_size (int): Maximum number of decoded geometries kept in memory.
+    """
+
+    def __init__(self, wkb, offsets, cache_size=10000):
+        self.wkb = wkb
+        self.offsets = offsets
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        # Every worker keeps its own cache
+        state = pack_memmaps(self.__dict__)
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(unpack_memmaps(state))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self.take(range(*key.indices(len(self)))))
+        return self.take([key])[0]
+
+    def wkb_at(self, i):
+        """Raw WKB bytes of the i-th geometry."""
+        return self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def take(self, indices):
+        """
+        Args:
+            - indices (array-like): Rows to decode
+        Output:
+            - geometries (np.ndarray): Object array of shapely geometries
+        """
+        from shapely import from_wkb
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('WKBArray index out of range')
+        geometries = np.empty(len(indices), dtype=object)
+        missing = []
+        for j, i in enumerate(indices.tolist()):
+            geometry = self._cache.get(i)
+            if geometry is None:
+                missing.append(j)
+            else:
+                self._cache.move_to_end(i)
+                geometries[j] = geometry
+        if missing:
+            rows = indices[missing]
+            geometries[missing] = from_wkb([self.wkb_at(i) for i in rows])
+            if self.cache_size > 0:
+                for i, geometry in zip(rows.tolist(), geometries[missing]):
+                    self._cache[i] = geometry
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return geometries
+
+
+class _MemmapFile:
+    """Placeholder for a memory-mapped .npy file in a pickled object."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def pack_memmaps(state):
+    """Replaces memory-mapped arrays in an object's __dict__ by their file paths.
+
+    Without this, pickling a dataset (e.g. for spawned DataLoader workers) copies
+    every annotation array into each worker instead of mapping the same pages.
+    """
+    packed = {}
+    for key, value in state.items():
+        # Views of a memmap share its filename, only whole files can be reopened
+        if (isinstance(value, np.memmap) and value.filename is not None and
+                isinstance(value.base, mmap.mmap)):
+            value = _MemmapFile(value.filename)
+        packed[key] = value
+    return packed
+
+
+def unpack_memmaps(state):
+    """Inverse of pack_memmaps."""
+    return {
+        key: (np.load(value.filename, mmap_mode='r') if isinstance(
+            value, _MemmapFile) else value) for key, value in state.items()
+    }
+
+
+def read_stamp(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_annotation_index(csv_file,
+                          value_columns=None,
+                          value_dtype='float32',
+                          wkt_column=None,
+                          index_dir=None,
+                          zip_archive=None):
+    """Loads the compiled index of a split csv, building it on first use.
+
+    Args:
+        csv_file (str or Path): Split file, e.g. data_dir / 'official.csv'.
+        value_columns (list of str): Coordinate columns, e.g. ['x', 'y'].
+        value_dtype (str): dtype of the coordinate array.
+        wkt_column (str): Name of a column of WKT geometries.
+        index_dir (str): Where to cache the index. Defaults to the csv path
+            with an '.index' suffix.
+        zip_archive (ZipArchive): If given, the csv is read from this archive, as
+            the member named like the basename of csv_file.
+    Returns:
+        AnnotationIndex
+    """
+    csv_file = str(csv_file)
+    if index_dir is None:
+        index_dir = os.path.splitext(csv_file)[0] + '.index'
+    if zip_archive is None:
+        st = os.stat(csv_file)
+        source = {'csv_size': st.st_size, 'csv_mtime_ns': st.st_mtime_ns}
+    else:
+        member = os.path.basename(csv_file)
+        info = zip_archive.info(member)
+        source = {'csv_size': info['file_size'], 'csv_crc': info['crc']}
+    stamp = {
+        'format_version': INDEX_FORMAT_VERSION,
+        **source,
+        'value_columns': value_columns,
+        'value_dtype': value_dtype,
+        'wkt_column': wkt_column,
+    }
+
+    def build():
+        df = pd.read_csv(csv_file if zip_archive is
+                         None else zip_archive.open(member))
+        index = AnnotationIndex.from_dataframe(df,
+                                               value_columns=value_columns,
+                                               value_dtype=value_dtype,
+                                               wkt_column=wkt_column)
+        return {
+            name: getattr(index, name) for name in AnnotationIndex._array_names
+        }
+
+    return AnnotationIndex(stamp=stamp,
+                           **load_or_build_arrays(index_dir,
+                                                  AnnotationIndex._array_names,
+                                                  stamp, build))
@@ -36,14 +36,23 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import contextlib
 import os
 import os.path
 import hashlib
 import gzip
 import errno
+import http.client
+import io
+import json
+import struct
 import tarfile
-from typing import Any, Callable, List, Iterable, Optional, TypeVar
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Iterable, Optional, Tuple, TypeVar
 import zipfile
+import zlib
 
 import torch
 from torch.utils.model_zoo import tqdm
@@ -81,18 +90,570 @@ def check_integrity(fpath: str, md5: Optional[str] = None) -> bool:
     return check_md5(fpath, md5)
 
 
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+_LOCAL_HEADER_SIZE = 30
+
+
+def _urlopen(url: str,
+             headers: Optional[Dict[str, str]] = None,
+             timeout: float = 60):
+    import urllib.request
+    request = urllib.request.Request(url, headers=headers or {})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def _probe(url: str) -> Dict[str, Any]:
+    """Size, range support and validators of a remote file, from a one-byte range request.
+
+    A ranged GET is used rather than HEAD, which some file servers reject.
+    """
+    with _urlopen(url, {'Range': 'bytes=0-0'}) as response:
+        headers = response.headers
+        accept_ranges = response.status == 206
+        size = None
+        if accept_ranges:
+            content_range = headers.get('Content-Range', '')
+            total = content_range.rsplit('/', 1)[-1]
+            size = int(total) if total.isdigit() else None
+        elif headers.get('Content-Length') is not None:
+            size = int(headers['Content-Length'])
+    return {
+        'size': size,
+        'accept_ranges': accept_ranges and size is not None,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+
+
+def _progress_bar(total: Optional[int],
+                  initial: int = 0) -> Callable[[int], None]:
+    pbar = tqdm(total=total, initial=initial, unit='B', unit_scale=True)
+    return pbar.update
+
+
+class TransferLimits:
+    """Bandwidth and disk limits shared by concurrent downloads.
+
+    Args:
+        max_bytes_per_second (int, optional): Combined download rate of every transfer
+            using these limits. None for no limit.
+        disk_jobs (int, optional): Maximum number of archives or streamed members
+            decompressed and written at the same time. None for no limit.
+    """
+
+    def __init__(self,
+                 max_bytes_per_second: Optional[float] = None,
+                 disk_jobs: Optional[int] = None) -> None:
+        self.max_bytes_per_second = max_bytes_per_second
+        self.disk_jobs = disk_jobs
+        self._disk = threading.BoundedSemaphore(
+            disk_jobs) if disk_jobs else None
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def throttle(self, n_bytes: int) -> None:
+        """Waits until n_bytes more received bytes fit in the bandwidth budget."""
+        if not self.max_bytes_per_second or n_bytes <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Every transfer books the next free slot of n_bytes / rate seconds
+            self._next_time = max(self._next_time,
+                                  now) + n_bytes / self.max_bytes_per_second
+            wait = self._next_time - now
+        time.sleep(wait)
+
+    @contextlib.contextmanager
+    def disk(self):
+        """Holds one of the disk_jobs slots."""
+        if self._disk is None:
+            yield
+            return
+        with self._disk:
+            yield
+
+
+_NO_LIMITS = TransferLimits()
+_transfer_settings = threading.local()
+
+
+@contextlib.contextmanager
+def transfer_settings(limits: Optional[TransferLimits] = None,
+                      progress: Optional[Callable[[int], None]] = None):
+    """Default limits and progress callback of the downloads started by this thread.
+
+    Lets a caller that only reaches the downloads through dataset constructors, like
+    the download_datasets scheduler, share limits and a progress display between them.
+    """
+    previous = getattr(_transfer_settings, 'value', (None, None))
+    _transfer_settings.value = (limits, progress)
+    try:
+        yield
+    finally:
+        _transfer_settings.value = previous
+
+
+def _settings(
+    limits: Optional[TransferLimits], progress: Optional[Callable[[int], None]]
+) -> Tuple[TransferLimits, Optional[Callable[[int], None]]]:
+    default_limits, default_progress = getattr(_transfer_settings, 'value',
+                                               (None, None))
+    return (limits or default_limits or _NO_LIMITS, progress or
+            default_progress)
+
+
+def _read_state(state_file: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_state(state_file: str, state: Dict[str, Any]) -> None:
+    # Replace atomically so an interrupted write never loses completed chunks
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def _chunk_md5(f,
+               start: int,
+               length: int,
+               block_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    f.seek(start)
+    while length > 0:
+        block = f.read(min(block_size, length))
+        if not block:
+            break
+        md5.update(block)
+        length -= len(block)
+    return md5.hexdigest()
+
+
+def _download_stream(url: str, fpath: str, progress: Callable[[int], None],
+                     limits: TransferLimits) -> None:
+    """Single-stream download for servers without range support."""
+    part_file = fpath + '.part'
+    with _urlopen(url) as response, open(part_file, 'wb') as f:
+        for block in iter(lambda: response.read(1024 * 1024), b''):
+            f.write(block)
+            progress(len(block))
+            limits.throttle(len(block))
+    os.replace(part_file, fpath)
+
+
+def download_file_parallel(url: str,
+                           fpath: str,
+                           num_workers: int = 8,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           max_retries: int = 3,
+                           progress: Optional[Callable[[int], None]] = None,
+                           size: Optional[int] = None,
+                           limits: Optional[TransferLimits] = None) -> None:
+    """Downloads a file with concurrent HTTP range requests, resuming earlier attempts.
+
+    The file is split into chunks of chunk_size bytes that a thread pool fetches into
+    '<fpath>.part'. Each chunk is hashed as it arrives, and its md5 is recorded in the
+    sidecar state file '<fpath>.part.json' once it is complete. If the download is
+    interrupted, the next call verifies the recorded chunks against the partial file and
+    fetches only the missing ones, as long as the remote file (size, ETag and
+    Last-Modified) is unchanged. Servers without range support are downloaded in a
+    single stream, without resume.
+
+    Args:
+        url (str): URL to download
+        fpath (str): Destination file. Only written once the download is complete.
+        num_workers (int): Number of concurrent range requests
+        chunk_size (int): Bytes per range request
+        max_retries (int): Attempts per chunk before giving up
+        progress (callable, optional): Called with the number of newly downloaded bytes,
+            including those of a resumed download's completed chunks. Defaults to a
+            progress bar.
+        size (int, optional): Expected size, used for the progress bar if the server does
+            not report one
+        limits (TransferLimits, optional): Limits shared with other downloads
+    """
+    limits, progress = _settings(limits, progress)
+    remote = _probe(url)
+    total = remote['size'] if remote['size'] is not None else size
+    if not remote['accept_ranges']:
+        _download_stream(url, fpath, progress or _progress_bar(total), limits)
+        return
+
+    part_file = fpath + '.part'
+    state_file = fpath + '.part.json'
+    n_chunks = max(1, -(-total // chunk_size))
+    state = {
+        'url': url,
+        'size': total,
+        'etag': remote['etag'],
+        'last_modified': remote['last_modified'],
+        'chunk_size': chunk_size,
+        'chunks': {},
+    }
+
+    def chunk_range(i):
+        start = i * chunk_size
+        return start, min(total, start + chunk_size) - start
+
+    previous = _read_state(state_file)
+    if (previous is not None and os.path.exists(part_file) and
+            os.path.getsize(part_file) == total and all(
+                previous.get(key) == state[key]
+                for key in ('url', 'size', 'etag', 'last_modified',
+                            'chunk_size'))):
+        # Keep only the recorded chunks whose bytes on disk still match their hash
+        with open(part_file, 'rb') as f:
+            for i, md5 in previous['chunks'].items():
+                if _chunk_md5(f, *chunk_range(int(i))) == md5:
+                    state['chunks'][i] = md5
+    else:
+        with open(part_file, 'wb') as f:
+            f.truncate(total)
+    _write_state(state_file, state)
+
+    missing = [i for i in range(n_chunks) if str(i) not in state['chunks']]
+    completed = sum(chunk_range(int(i))[1] for i in state['chunks'])
+    if progress is None:
+        progress = _progress_bar(total, completed)
+    elif completed:
+        progress(completed)
+    lock = threading.Lock()
+
+    def fetch(i):
+        start, length = chunk_range(i)
+        headers = {'Range': f'bytes={start}-{start + length - 1}'}
+        # Fail instead of mixing bytes from two versions of the file
+        validator = _strong_validator(remote)
+        if validator:
+            headers['If-Range'] = validator
+        for attempt in range(max_retries):
+            received = 0
+            try:
+                md5 = hashlib.md5()
+                with _urlopen(url, headers) as response, open(part_file,
+                                                              'r+b') as f:
+                    if response.status != 206:
+                        raise IOError(
+                            f'{url} changed or ignored the range request during the download.'
+                        )
+                    f.seek(start)
+                    for block in iter(lambda: response.read(1024 * 1024), b''):
+                        f.write(block)
+                        md5.update(block)
+                        received += len(block)
+                        with lock:
+                            progress(len(block))
+                        limits.throttle(len(block))
+                if received != length:
+                    raise IOError(
+                        f'Received {received} of {length} bytes for chunk {i}.')
+                with lock:
+                    state['chunks'][str(i)] = md5.hexdigest()
+                    _write_state(state_file, state)
+                return
+            except (OSError, http.client.HTTPException) as e:
+                with lock:
+                    progress(-received)
+                if attempt == max_retries - 1:
+                    raise
+                time.sleep(min(2**attempt, 10))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(fetch, i) for i in missing]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    os.replace(part_file, fpath)
+    os.remove(state_file)
+
+
+def _fetch_range(url: str,
+                 start: int,
+                 length: int,
+                 validator: Optional[str] = None,
+                 limits: TransferLimits = _NO_LIMITS,
+                 max_retries: int = 3) -> bytes:
+    """Bytes start:start + length of a remote file, retrying dropped requests."""
+    headers = {'Range': f'bytes={start}-{start + length - 1}'}
+    if validator:
+        headers['If-Range'] = validator
+    for attempt in range(max_retries):
+        try:
+            with _urlopen(url, headers) as response:
+                if response.status != 206:
+                    raise IOError(
+                        f'{url} changed or ignored the range request during the download.'
+                    )
+                data = response.read()
+            if len(data) != length:
+                raise IOError(
+                    f'Received {len(data)} of {length} bytes from {url}.')
+            break
+        except (OSError, http.client.HTTPException):
+            if attempt == max_retries - 1:
+                raise
+            time.sleep(min(2**attempt, 10))
+    limits.throttle(length)
+    return data
+
+
+def _strong_validator(remote: Dict[str, Any]) -> Optional[str]:
+    # If-Range needs a strong validator
+    validator = remote['etag']
+    if not validator or validator.startswith('W/'):
+        validator = remote['last_modified']
+    return validator
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """Read-only, seekable file object over a remote file, backed by range requests.
+
+    Reads are served from the last fetched block, and each fetch reads at least
+    block_size bytes, so zipfile can parse a remote central directory with a handful of
+    requests.
+
+    Args:
+        url (str): URL of a file on a server that supports range requests
+        block_size (int): Minimum number of bytes per request
+    """
+
+    def __init__(self, url: str, block_size: int = 64 * 1024) -> None:
+        super().__init__()
+        remote = _probe(url)
+        if not remote['accept_ranges']:
+            raise IOError(f'{url} does not support range requests.')
+        self.url = url
+        self.size = remote['size']
+        self.validator = _strong_validator(remote)
+        self.block_size = block_size
+        self._pos = 0
+        self._block_start = 0
+        self._block = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size - self._pos
+        n = min(n, self.size - self._pos)
+        if n <= 0:
+            return b''
+        start = self._pos - self._block_start
+        if start < 0 or start + n > len(self._block):
+            length = min(max(n, self.block_size), self.size - self._pos)
+            self._block = _fetch_range(self.url, self._pos, length,
+                                       self.validator)
+            self._block_start, start = self._pos, 0
+        self._pos += n
+        return self._block[start:start + n]
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _member_path(extract_root: str, info: zipfile.ZipInfo) -> str:
+    """Destination of a member, with absolute paths and '..' removed like zipfile."""
+    parts = [
+        part for part in info.filename.replace('\\', '/').split('/')
+        if part not in ('', '.', '..')
+    ]
+    return os.path.join(extract_root, *parts)
+
+
+def remote_zip_members(url: str) -> List[zipfile.ZipInfo]:
+    """Reads the central directory of a remote zip archive with range requests."""
+    with zipfile.ZipFile(HTTPRangeFile(url)) as z:
+        return z.infolist()
+
+
+def stream_extract_archive(url: str,
+                           extract_root: str,
+                           members: Optional[List[zipfile.ZipInfo]] = None,
+                           num_workers: int = 8,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           size: Optional[int] = None,
+                           progress: Optional[Callable[[int], None]] = None,
+                           limits: Optional[TransferLimits] = None,
+                           max_retries: int = 3) -> None:
+    """Extracts a remote zip archive without downloading it first.
+
+    The central directory is read with range requests. Members are then grouped into
+    contiguous byte ranges of about chunk_size bytes, which a thread pool fetches,
+    decompresses, checks against their CRC and writes to extract_root, so extraction
+    overlaps with the download and the archive itself never touches the disk. Members
+    are written to a temporary name and renamed when complete; members already
+    extracted with the right size are skipped, so an interrupted extraction resumes.
+    Dropped range requests are retried. The top-level RELEASE files, which mark a data
+    directory as complete, are only written once every other member is.
+
+    Args:
+        url (str): URL of a zip archive on a server that supports range requests
+        extract_root (str): Directory to extract to
+        members (list of ZipInfo, optional): Members to extract, from
+            remote_zip_members. Defaults to all of them.
+        num_workers (int): Number of concurrent range requests
+        chunk_size (int): Approximate number of bytes per request
+        size (int, optional): Compressed size of the archive, e.g. the dataset's
+            'compressed_size', used as the progress total when extracting all members
+        progress (callable, optional): Called with the number of newly processed
+            compressed bytes, including those of members extracted earlier. Defaults to
+            a progress bar.
+        limits (TransferLimits, optional): Limits shared with other downloads. Fetched
+            bytes count against the bandwidth, and writing a member holds a disk slot.
+        max_retries (int): Attempts per range request before giving up
+    """
+    limits, progress = _settings(limits, progress)
+    remote_file = HTTPRangeFile(url)
+    if members is None:
+        with zipfile.ZipFile(remote_file) as z:
+            members = z.infolist()
+        total = size
+    else:
+        total = None
+    for info in members:
+        if info.flag_bits & 0x1 or info.compress_type not in (
+                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(
+                f'{info.filename} is encrypted or uses an unsupported compression method.'
+            )
+
+    files = []
+    for info in members:
+        path = _member_path(extract_root, info)
+        if info.is_dir():
+            os.makedirs(path, exist_ok=True)
+        elif not (os.path.isfile(path) and
+                  os.path.getsize(path) == info.file_size):
+            files.append(info)
+    files.sort(key=lambda info: info.header_offset)
+    if total is None:
+        total = sum(info.compress_size for info in members)
+    remaining = sum(info.compress_size for info in files)
+    if progress is None:
+        progress = _progress_bar(total, max(0, total - remaining))
+    elif total - remaining > 0:
+        progress(total - remaining)
+
+    def member_end(info):
+        # The local header repeats the name; its extra field is usually no longer than
+        # the central directory's, otherwise the member is fetched again on its own
+        return min(
+            remote_file.size, info.header_offset + _LOCAL_HEADER_SIZE +
+            len(info.orig_filename.encode('utf-8')) + len(info.extra) + 256 +
+            info.compress_size)
+
+    # Completion markers are extracted last, on their own
+    markers = [info for info in files if _is_release_marker(info)]
+    files = [info for info in files if not _is_release_marker(info)]
+
+    # Group members stored next to each other into one request
+    groups, group = [], []
+    for info in files:
+        if group and (member_end(info) - group[0].header_offset > chunk_size or
+                      info.header_offset - member_end(group[-1]) > 64 * 1024):
+            groups.append(group)
+            group = []
+        group.append(info)
+    if group:
+        groups.append(group)
+
+    lock = threading.Lock()
+
+    def extract(group):
+        start = group[0].header_offset
+        data = _fetch_range(url, start,
+                            member_end(group[-1]) - start,
+                            remote_file.validator, limits, max_retries)
+        for info in group:
+            offset = info.header_offset - start
+            header = data[offset:offset + _LOCAL_HEADER_SIZE]
+            if header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(
+                    f'Bad local file header for {info.filename}')
+            name_length, extra_length = struct.unpack('<2H', header[26:30])
+            data_start = offset + _LOCAL_HEADER_SIZE + name_length + extra_length
+            raw = data[data_start:data_start + info.compress_size]
+            if len(raw) < info.compress_size:
+                raw = _fetch_range(url, start + data_start, info.compress_size,
+                                   remote_file.validator, limits, max_retries)
+            with limits.disk():
+                if info.compress_type == zipfile.ZIP_DEFLATED:
+                    raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+                if zlib.crc32(raw) != info.CRC:
+                    raise zipfile.BadZipFile(f'Bad CRC for {info.filename}')
+                path = _member_path(extract_root, info)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + '.part'
+                with open(tmp_path, 'wb') as f:
+                    f.write(raw)
+                os.replace(tmp_path, path)
+            with lock:
+                progress(info.compress_size)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(extract, group) for group in groups]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    for info in markers:
+        extract([info])
+
+
+def _is_release_marker(info: zipfile.ZipInfo) -> bool:
+    """Whether a member is a top-level RELEASE_v*.txt file."""
+    name = info.filename.replace('\\', '/')
+    return '/' not in name and name.startswith('RELEASE_v')
+
+
 def download_url(url: str,
                  root: str,
                  filename: Optional[str] = None,
                  md5: Optional[str] = None,
-                 size: Optional[int] = None) -> None:
+                 size: Optional[int] = None,
+                 num_workers: int = 8,
+                 limits: Optional[TransferLimits] = None) -> None:
     """Download a file from a url and place it in root.
 
+    Interrupted downloads are resumed, see download_file_parallel.
+
     Args:
         url (str): URL to download file from
         root (str): Directory to place downloaded file in
         filename (str, optional): Name to save the file under. If None, use the basename of the URL
         md5 (str, optional): MD5 checksum of the download. If None, do not check
+        size (int, optional): Expected size of the file, for progress reporting
+        num_workers (int): Number of concurrent range requests
+        limits (TransferLimits, optional): Limits shared with other downloads
     """
     import urllib
 
@@ -109,18 +670,22 @@ def download_url(url: str,
     else:  # download the file
         try:
             print('Downloading ' + url + ' to ' + fpath)
-            urllib.request.urlretrieve(url,
-                                       fpath,
-                                       reporthook=gen_bar_updater(size))
+            download_file_parallel(url,
+                                   fpath,
+                                   num_workers=num_workers,
+                                   size=size,
+                                   limits=limits)
         except (urllib.error.URLError,
                 IOError) as e:  # type: ignore[attr-defined]
             if url[:5] == 'https':
                 url = url.replace('https:', 'http:')
                 print('Failed download. Trying https -> http instead.'
                       ' Downloading ' + url + ' to ' + fpath)
-                urllib.request.urlretrieve(url,
-                                           fpath,
-                                           reporthook=gen_bar_updater(size))
+                download_file_parallel(url,
+                                       fpath,
+                                       num_workers=num_workers,
+                                       size=size,
+                                       limits=limits)
             else:
                 raise e
         # check integrity of downloaded file
@@ -295,24 +860,51 @@ def extract_archive(from_path: str,
         os.remove(from_path)
 
 
-def download_and_extract_archive(url: str,
-                                 download_root: str,
-                                 extract_root: Optional[str] = None,
-                                 filename: Optional[str] = None,
-                                 md5: Optional[str] = None,
-                                 remove_finished: bool = False,
-                                 size: Optional[int] = None) -> None:
+def download_and_extract_archive(
+        url: str,
+        download_root: str,
+        extract_root: Optional[str] = None,
+        filename: Optional[str] = None,
+        md5: Optional[str] = None,
+        remove_finished: bool = False,
+        size: Optional[int] = None,
+        num_workers: int = 8,
+        streaming: bool = False,
+        limits: Optional[TransferLimits] = None) -> None:
+    """Downloads an archive and extracts it.
+
+    With streaming=True, zip archives on servers that support range requests are
+    extracted while they download (see stream_extract_archive) and never written to
+    disk as a whole. Members are checked against their CRC instead of md5.
+
+    Extracting a downloaded archive holds one of the disk slots of limits, so
+    concurrent downloads keep using the network meanwhile.
+    """
+    limits, _ = _settings(limits, None)
     download_root = os.path.expanduser(download_root)
     if extract_root is None:
         extract_root = download_root
     if not filename:
         filename = os.path.basename(url)
 
-    download_url(url, download_root, filename, md5, size)
+    if streaming and md5 is None and _is_zip(filename):
+        if _probe(url)['accept_ranges']:
+            print("Streaming {} to {}".format(url, extract_root))
+            stream_extract_archive(url,
+                                   extract_root,
+                                   num_workers=num_workers,
+                                   size=size,
+                                   limits=limits)
+            return
+        print("{} does not support range requests, downloading it first".format(
+            url))
+
+    download_url(url, download_root, filename, md5, size, num_workers, limits)
 
     archive = os.path.join(download_root, filename)
-    print("Extracting {} to {}".format(archive, extract_root))
-    extract_archive(archive, extract_root, remove_finished)
+    with limits.disk():
+        print("Extracting {} to {}".format(archive, extract_root))
+        extract_archive(archive, extract_root, remove_finished)
 
 
 def iterable_to_str(iterable: Iterable) -> str:
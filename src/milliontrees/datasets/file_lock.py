@@ -0,0 +1,81 @@
+"""Cross-process lock serializing downloads into a shared root directory.
+
+Many jobs, e.g. the tasks of a cluster array, may construct the same dataset with
+download=True at the same moment. The first one to take the lock downloads the dataset,
+the others wait, then find the completed copy. The lock is an advisory lock on a file
+(flock on POSIX, msvcrt.locking on Windows), which the operating system releases when
+the process holding it exits, so a crashed job never leaves a stale lock behind.
+"""
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Exclusive lock on a lock file, held across processes. Not reentrant.
+
+    Args:
+        path (str): Lock file, created if needed. It is never deleted.
+        timeout (float): Seconds to wait for the lock, or None to wait indefinitely.
+        poll_interval (float): Seconds between attempts to take the lock.
+    """
+
+    def __init__(self, path, timeout=None, poll_interval=0.5):
+        self.path = str(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self, fd):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, on_wait=None):
+        """Takes the lock, waiting for other processes to release it.
+
+        Args:
+            - on_wait (callable): Called once if the lock is held by another process
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        deadline = None if self.timeout is None else time.monotonic(
+        ) + self.timeout
+        waited = False
+        while not self._try_lock(fd):
+            if deadline is not None and time.monotonic() >= deadline:
+                os.close(fd)
+                raise TimeoutError(f'Could not acquire the lock {self.path}.')
+            if not waited and on_wait is not None:
+                on_wait()
+            waited = True
+            time.sleep(self.poll_interval)
+        self._fd = fd
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,139 @@
+"""Pre-resized image cache for training at a fixed image size.
+
+Training transforms always resize images to ``image_size``, so every epoch decodes
+large source images only to discard most of their pixels. An image cache stores every
+image of a dataset once, already resized, in a single memory-mapped uint8 array of
+shape (N, image_size, image_size, 3), together with the annotations rescaled to match.
+Serving a sample from the cache is a slice of the memory map, without any decoding.
+"""
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import albumentations as A
+
+from milliontrees.datasets.annotation_index import read_stamp
+from milliontrees.datasets.image_io import decode_image
+from milliontrees.datasets.mask_store import MaskStore, write_mask_store
+
+# Bump when the on-disk layout changes.
+IMAGE_CACHE_FORMAT_VERSION = 1
+
+
+class ImageCache:
+    """A materialized image cache, see materialize_image_cache.
+
+    Attributes:
+        images (np.ndarray): Copy-on-write memory map of shape (N, S, S, 3), uint8.
+        y (np.ndarray): Annotations rescaled to S x S, or None for polygon datasets.
+        masks (MaskStore): S x S masks of each image, or None.
+        image_size (int): S.
+        stamp (dict): Information the cache was built with.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = str(cache_dir)
+        self.stamp = read_stamp(self.cache_dir)
+        if self.stamp is None:
+            raise FileNotFoundError(f'No image cache found at {cache_dir}.')
+        self.image_size = self.stamp['image_size']
+        # Copy-on-write keeps slices writable for the transforms without copying
+        self.images = np.load(os.path.join(self.cache_dir, 'images.npy'),
+                              mmap_mode='c')
+        y_file = os.path.join(self.cache_dir, 'y.npy')
+        self.y = np.load(y_file,
+                         mmap_mode='r') if os.path.exists(y_file) else None
+        masks_dir = os.path.join(self.cache_dir, 'masks')
+        self.masks = MaskStore.load(masks_dir) if os.path.exists(
+            masks_dir) else None
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def __len__(self):
+        return len(self.images)
+
+    def image(self, idx, image_dtype='float32'):
+        """The cached image of the idx-th data point, in the same format as get_input."""
+        img = self.images[idx]
+        if image_dtype == 'uint8':
+            return img
+        return np.array(img / 255, dtype=np.float32)
+
+
+def materialize_image_cache(dataset, cache_dir, image_size, num_workers=0):
+    """Writes the resized images and rescaled targets of a dataset.
+
+    Args:
+        dataset (MillionTreesDataset): Full dataset to cache.
+        cache_dir (str): Directory to create or replace.
+        image_size (int): Side of the cached square images.
+        num_workers (int): Threads used to decode and resize images.
+    Returns:
+        ImageCache
+    """
+    cache_dir = str(cache_dir)
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.cache-', dir=parent)
+    resize = A.Resize(height=image_size, width=image_size, p=1.0)
+    n = len(dataset)
+    try:
+        images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'),
+                                           mode='w+',
+                                           dtype=np.uint8,
+                                           shape=(n, image_size, image_size, 3))
+        scales = np.zeros((n, 2), dtype=np.float32)
+
+        def fill(idx):
+            img, decode_scale = decode_image(dataset._image_source(idx),
+                                             backend=dataset.decode_backend,
+                                             target_size=image_size)
+            images[idx] = resize(image=img)['image']
+            # Scale from the stored image to the cached one
+            scales[idx] = (decode_scale[0] * image_size / img.shape[1],
+                           decode_scale[1] * image_size / img.shape[0])
+
+        if num_workers > 0:
+            with ThreadPoolExecutor(num_workers) as executor:
+                list(executor.map(fill, range(n)))
+        else:
+            for idx in range(n):
+                fill(idx)
+        images.flush()
+        del images
+
+        if dataset.dataset_name == 'TreePolygons':
+            write_mask_store(os.path.join(
+                tmp_dir, 'masks'), ((masks, boxes.numpy()) for masks, boxes in (
+                    dataset._rasterize(idx, (image_size,
+                                             image_size), tuple(scales[idx]))
+                    for idx in range(n))))
+        else:
+            y = np.array(dataset._y_array, dtype=np.float32)
+            counts = np.diff(dataset._offsets)
+            factors = np.tile(np.repeat(scales, counts, axis=0),
+                              y.shape[1] // 2)
+            np.save(os.path.join(tmp_dir, 'y.npy'), y * factors)
+
+        stamp = {
+            'format_version': IMAGE_CACHE_FORMAT_VERSION,
+            'image_size': image_size,
+            'n_images': n,
+            'annotations': dataset._annotation_index.stamp,
+        }
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            json.dump(stamp, f)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(tmp_dir, cache_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return ImageCache(cache_dir)
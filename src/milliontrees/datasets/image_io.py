@@ -0,0 +1,113 @@
+"""Image decoding backends for MillionTrees datasets.
+
+Every backend returns an HxWx3 uint8 RGB array together with the scale of the decoded
+image relative to the stored one. When a target size is given, JPEGs are decoded at a
+reduced resolution in the DCT domain (PIL ``draft`` or OpenCV ``IMREAD_REDUCED_*``),
+never smaller than the target size, so the full-resolution image is never materialized.
+Annotations must be multiplied by the returned scale to stay aligned.
+
+Backends:
+    - 'pil': PIL, the default. Supports reduced decoding of JPEGs.
+    - 'torchvision': torchvision.io.decode_image (libjpeg-turbo / libpng). Always
+      decodes at full resolution.
+    - 'opencv': cv2.imdecode. Supports reduced decoding of JPEGs. Requires opencv-python.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+DECODE_BACKENDS = ('pil', 'torchvision', 'opencv')
+
+
+def _read_bytes(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def _open(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+
+def _reduction_factor(size, target_size):
+    """Largest JPEG reduction (1, 2, 4 or 8) that keeps both sides >= target_size."""
+    factor = 1
+    while factor < 8 and min(size) // (factor * 2) >= target_size:
+        factor *= 2
+    return factor
+
+
+def _decode_pil(source, target_size):
+    with _open(source) as img:
+        width, height = img.size
+        if target_size is not None and img.format == 'JPEG':
+            img.draft('RGB', (target_size, target_size))
+        img = np.array(img.convert('RGB'))
+    return img, (width, height)
+
+
+def _decode_torchvision(source, target_size):
+    import torch
+    from torchvision.io import decode_image, ImageReadMode
+    data = torch.frombuffer(bytearray(_read_bytes(source)), dtype=torch.uint8)
+    img = decode_image(data, mode=ImageReadMode.RGB)
+    img = img.permute(1, 2, 0).numpy()
+    return img, (img.shape[1], img.shape[0])
+
+
+def _decode_opencv(source, target_size):
+    import cv2
+    data = _read_bytes(source)
+    with _open(data) as header:
+        width, height = header.size
+        is_jpeg = header.format == 'JPEG'
+    flag = cv2.IMREAD_COLOR
+    if target_size is not None and is_jpeg:
+        flag = {
+            1: cv2.IMREAD_COLOR,
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8,
+        }[_reduction_factor((width, height), target_size)]
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise ValueError('OpenCV could not decode the image.')
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img, (width, height)
+
+
+def read_image_size(source):
+    """(width, height) of an image, read from its header without decoding it."""
+    with _open(source) as img:
+        return img.size
+
+
+def decode_image(source, backend='pil', target_size=None):
+    """Decodes an image to an RGB uint8 array.
+
+    Args:
+        source (str, Path or bytes): Image file or its encoded bytes.
+        backend (str): One of DECODE_BACKENDS.
+        target_size (int): If given, JPEGs may be decoded at a reduced resolution whose
+            sides are no smaller than target_size.
+    Returns:
+        tuple:
+            - img (np.ndarray): HxWx3 uint8 image.
+            - scale (tuple): (sx, sy), decoded size divided by stored size.
+    """
+    if backend == 'pil':
+        img, (width, height) = _decode_pil(source, target_size)
+    elif backend == 'torchvision':
+        img, (width, height) = _decode_torchvision(source, target_size)
+    elif backend == 'opencv':
+        img, (width, height) = _decode_opencv(source, target_size)
+    else:
+        raise ValueError(
+            f'Decode backend {backend} not recognized. Must be one of {DECODE_BACKENDS}.'
+        )
+    scale = (img.shape[1] / width, img.shape[0] / height)
+    return img, scale
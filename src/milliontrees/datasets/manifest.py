@@ -0,0 +1,228 @@
+"""Per-file manifests of dataset releases, and delta updates between versions.
+
+A manifest maps every file of a release, relative to the data directory, to its size
+and content hashes (md5 and crc32). Releases ship one as ``manifest.json`` inside the
+archive. For older archives, the sizes and CRC-32s of the zip's central directory
+serve as the manifest.
+
+Hashes of installed files are cached in ``manifest.cache.json``, together with the
+size and modification time each file had when it was hashed, so verifying a data
+directory again only hashes the files that changed since. Files are hashed by a thread
+pool; hashlib and zlib release the GIL on large buffers.
+
+update_from_version builds the data directory of a new version from an installed one.
+Files whose content did not change are hard-linked from the old directory, or copied
+where hard links are not supported, and only the other members are fetched from the
+remote archive with range requests.
+"""
+import hashlib
+import json
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from milliontrees.datasets.download_utils import remote_zip_members, stream_extract_archive
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_CACHE_FILE = 'manifest.cache.json'
+# Bump when the manifest layout changes.
+MANIFEST_FORMAT_VERSION = 1
+
+_HASHES = ('md5', 'crc32')
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Size, md5 and crc32 of a file, computed in a single pass."""
+    md5 = hashlib.md5()
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return {'size': size, 'md5': md5.hexdigest(), 'crc32': crc}
+
+
+def same_content(a, b):
+    """Whether two manifest entries describe the same file contents.
+
+    Entries match if their sizes match and they agree on every hash both of them have.
+    """
+    if a is None or b is None or a['size'] != b['size']:
+        return False
+    shared = [key for key in _HASHES if key in a and key in b]
+    return bool(shared) and all(a[key] == b[key] for key in shared)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, content):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(root):
+    """The files of the release manifest shipped in root, or None."""
+    manifest = _read_json(os.path.join(root, MANIFEST_FILE))
+    return None if manifest is None else manifest['files']
+
+
+def write_manifest(root, files):
+    """Writes the release manifest of root, e.g. before packaging a release."""
+    _write_json(os.path.join(root, MANIFEST_FILE), {
+        'format_version': MANIFEST_FORMAT_VERSION,
+        'files': files
+    })
+
+
+def _list_files(root):
+    names = []
+    for dir_path, _, files in os.walk(root):
+        for file in files:
+            names.append(
+                os.path.relpath(os.path.join(dir_path, file),
+                                root).replace(os.sep, '/'))
+    return sorted(name for name in names
+                  if name not in (MANIFEST_FILE, MANIFEST_CACHE_FILE))
+
+
+def build_manifest(root, num_workers=8):
+    """Hashes every file under root.
+
+    Output:
+        - files (dict): Relative path to {'size', 'md5', 'crc32'}
+    """
+    return file_hashes(root, _list_files(root), num_workers=num_workers)
+
+
+def file_hashes(root, names, num_workers=8):
+    """Hashes of some files under root, reusing the cache for unchanged files.
+
+    Args:
+        - root (str): Data directory
+        - names (list of str): Paths relative to root. Missing files are left out.
+        - num_workers (int): Number of threads hashing files
+    Output:
+        - files (dict): Relative path to {'size', 'md5', 'crc32'}
+    """
+    cache_file = os.path.join(root, MANIFEST_CACHE_FILE)
+    cache = (_read_json(cache_file) or {}).get('files', {})
+    hashes, stale = {}, []
+    for name in names:
+        try:
+            st = os.stat(os.path.join(root, name))
+        except FileNotFoundError:
+            continue
+        cached = cache.get(name)
+        if (cached is not None and cached['size'] == st.st_size and
+                cached['mtime_ns'] == st.st_mtime_ns):
+            hashes[name] = cached
+        else:
+            stale.append((name, st.st_mtime_ns))
+
+    def compute(item):
+        name, mtime_ns = item
+        return dict(hash_file(os.path.join(root, name)), mtime_ns=mtime_ns)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for (name, _), entry in zip(stale, executor.map(compute, stale)):
+                hashes[name] = cache[name] = entry
+        try:
+            _write_json(cache_file, {'files': cache})
+        except OSError:
+            # Read-only data directories are verified without the cache
+            pass
+    return {
+        name: {
+            key: entry[key] for key in ('size',) + _HASHES
+        } for name, entry in hashes.items()
+    }
+
+
+def verify_manifest(root, files=None, num_workers=8):
+    """Files of a data directory that are missing or differ from the manifest.
+
+    Args:
+        - root (str): Data directory
+        - files (dict): Manifest to check against. Defaults to the one shipped in root.
+        - num_workers (int): Number of threads hashing files
+    Output:
+        - names (list of str): Relative paths of the missing or corrupted files
+    """
+    if files is None:
+        files = read_manifest(root)
+        if files is None:
+            raise FileNotFoundError(f'No {MANIFEST_FILE} found in {root}.')
+    hashes = file_hashes(root, list(files), num_workers=num_workers)
+    return sorted(name for name, entry in files.items()
+                  if not same_content(entry, hashes.get(name)))
+
+
+def _link(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Other filesystem, or no hard link support
+        shutil.copy2(src, dst)
+
+
+def update_from_version(url, old_dir, data_dir, num_workers=8):
+    """Installs a new release in data_dir, reusing the unchanged files of old_dir.
+
+    Args:
+        - url (str): URL of the new release archive, on a server supporting range requests
+        - old_dir (str): Data directory of an installed version
+        - data_dir (str): Data directory of the new version
+        - num_workers (int): Number of concurrent range requests and hashing threads
+    Output:
+        - stats (dict): Number of 'linked' and 'fetched' files
+    """
+    members = [info for info in remote_zip_members(url) if not info.is_dir()]
+    os.makedirs(data_dir, exist_ok=True)
+    shipped = [info for info in members if info.filename == MANIFEST_FILE]
+    if shipped:
+        stream_extract_archive(url,
+                               data_dir,
+                               members=shipped,
+                               num_workers=num_workers)
+        files = read_manifest(data_dir)
+    else:
+        files = {
+            info.filename: {
+                'size': info.file_size,
+                'crc32': info.CRC
+            } for info in members
+        }
+
+    old_hashes = file_hashes(old_dir, list(files), num_workers=num_workers)
+    unchanged = [
+        name for name, entry in files.items()
+        if same_content(entry, old_hashes.get(name))
+    ]
+    for name in unchanged:
+        _link(os.path.join(old_dir, name), os.path.join(data_dir, name))
+    unchanged = set(unchanged)
+    changed = [
+        info for info in members
+        if info.filename not in unchanged and info.filename != MANIFEST_FILE
+    ]
+    stream_extract_archive(url,
+                           data_dir,
+                           members=changed,
+                           num_workers=num_workers)
+    if not shipped:
+        write_manifest(data_dir, files)
+    return {'linked': len(unchanged), 'fetched': len(changed)}
@@ -0,0 +1,109 @@
+"""On-disk store of rasterized instance masks.
+
+Rasterizing every polygon of an image on each access dominates TreePolygons loading.
+A mask store holds the masks of every image once, run-length encoded (see
+milliontrees.common.mask_utils), together with the bounding box of each mask. The
+arrays are memory-mapped and decoded on demand.
+"""
+import numpy as np
+
+from milliontrees.common.mask_utils import rle_encode, rle_decode
+from milliontrees.datasets.annotation_index import save_arrays, load_arrays, read_stamp
+
+# Bump when the on-disk layout changes.
+MASK_STORE_FORMAT_VERSION = 1
+
+
+class MaskStore:
+    """Run-length encoded masks keyed by image index.
+
+    Attributes:
+        counts (np.ndarray): uint32 run lengths of every mask, concatenated.
+        count_offsets (np.ndarray): Start of each mask in counts, of length n_masks + 1.
+        mask_offsets (np.ndarray): Masks of image i are mask_offsets[i]:mask_offsets[i + 1].
+        shapes (np.ndarray): (H, W) of the masks of each image.
+        boxes (np.ndarray): float32 xyxy box of each mask.
+    """
+
+    _array_names = [
+        'counts', 'count_offsets', 'mask_offsets', 'shapes', 'boxes'
+    ]
+
+    def __init__(self, stamp=None, **arrays):
+        self.stamp = stamp
+        for name in self._array_names:
+            setattr(self, name, arrays.get(name))
+
+    def __len__(self):
+        return len(self.mask_offsets) - 1
+
+    def __getitem__(self, idx):
+        """
+        Args:
+            - idx (int): Index of an image
+        Output:
+            - masks (np.ndarray): uint8 masks of shape (N, H, W) with values 0 or 255
+            - boxes (np.ndarray): float32 boxes of shape (N, 4)
+        """
+        start, end = self.mask_offsets[idx], self.mask_offsets[idx + 1]
+        shape = tuple(self.shapes[idx])
+        masks = np.zeros((end - start,) + shape, dtype=np.uint8)
+        for j, i in enumerate(range(start, end)):
+            counts = self.counts[self.count_offsets[i]:self.count_offsets[i +
+                                                                          1]]
+            masks[j] = rle_decode(counts, shape, fill_value=255)
+        return masks, np.array(self.boxes[start:end])
+
+    def rle(self, idx):
+        """Run lengths of every mask of the idx-th image, without decoding them."""
+        start, end = self.mask_offsets[idx], self.mask_offsets[idx + 1]
+        return [
+            self.counts[self.count_offsets[i]:self.count_offsets[i + 1]]
+            for i in range(start, end)
+        ]
+
+    @classmethod
+    def load(cls, store_dir):
+        """Memory-maps a store written by write_mask_store."""
+        return cls(stamp=read_stamp(store_dir),
+                   **load_arrays(store_dir, cls._array_names))
+
+
+def write_mask_store(store_dir, items, stamp=None):
+    """Encodes and writes the masks of every image.
+
+    Args:
+        store_dir (str): Directory to create or replace.
+        items (iterable): (masks, boxes) per image, in image order. masks is an
+            (N, H, W) array and boxes an (N, 4) array.
+        stamp (dict): Extra JSON-serializable information stored with the masks.
+    """
+    counts, count_lengths, masks_per_image, shapes, boxes = [], [], [], [], []
+    for masks, image_boxes in items:
+        masks = np.asarray(masks)
+        encoded = rle_encode(masks)
+        counts.extend(encoded)
+        count_lengths.extend(len(c) for c in encoded)
+        masks_per_image.append(len(encoded))
+        shapes.append(masks.shape[1:])
+        boxes.append(np.asarray(image_boxes, dtype=np.float32).reshape(-1, 4))
+
+    count_offsets = np.zeros(len(count_lengths) + 1, dtype=np.int64)
+    count_offsets[1:] = np.cumsum(count_lengths)
+    mask_offsets = np.zeros(len(masks_per_image) + 1, dtype=np.int64)
+    mask_offsets[1:] = np.cumsum(masks_per_image)
+    arrays = {
+        'counts':
+            np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32),
+        'count_offsets':
+            count_offsets,
+        'mask_offsets':
+            mask_offsets,
+        'shapes':
+            np.array(shapes, dtype=np.int64).reshape(-1, 2),
+        'boxes':
+            np.concatenate(boxes) if boxes else np.zeros(
+                (0, 4), dtype=np.float32),
+    }
+    stamp = dict(stamp or {}, format_version=MASK_STORE_FORMAT_VERSION)
+    save_arrays(store_dir, arrays, stamp)
@@ -1,8 +1,21 @@
+import contextlib
 import os
 import time
 
 import torch
 import numpy as np
+import pandas as pd
+
+from milliontrees.common.metrics.metric import group_eval_results
+from milliontrees.common.metrics.all_metrics import COCO_IOU_THRESHOLDS, DetectionSweep
+from milliontrees.datasets.file_lock import FileLock
+from milliontrees.datasets.annotation_index import WKBArray, pack_memmaps, unpack_memmaps
+from milliontrees.datasets.image_io import DECODE_BACKENDS, decode_image, read_image_size
+from milliontrees.datasets.image_cache import ImageCache, materialize_image_cache
+from milliontrees.datasets.manifest import update_from_version, verify_manifest
+from milliontrees.datasets.partial_download import clear_partial_install, covers, download_subset, make_selection, read_partial_install
+from milliontrees.datasets.shared_cache import SharedImageCache
+from milliontrees.datasets.zip_archive import ZipArchive
 
 
 class MillionTreesDataset:
@@ -29,15 +42,40 @@ class MillionTreesDataset:
         self.check_init()
 
     def __len__(self):
-        return len(self.y_array)
+        return len(self._input_array)
+
+    def __getstate__(self):
+        # Memory-mapped annotation arrays are sent to DataLoader workers as file paths
+        return pack_memmaps(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(unpack_memmaps(state))
 
     def __getitem__(self, idx):
         # Any transformations are handled by the WILDSSubset
         # since different subsets (e.g., train vs test) might have different transforms
-        x = self.get_input(idx)
-        y_indices = self._input_lookup[self._input_array[idx]]
-        y = torch.tensor(self.y_array[y_indices])
         metadata = torch.tensor(self.metadata_array[idx])
+        if self.image_cache is not None:
+            x = self.image_cache.image(idx, self.image_dtype)
+            y = self.image_cache.y[self._annotation_slice(idx)]
+            return self._item_from_annotations(metadata, x, np.array(y),
+                                               (1.0, 1.0))
+        x, scale = self._load_input(idx)
+        return self._item_from_annotations(
+            metadata, x, self.y_array[self._annotation_slice(idx)], scale)
+
+    def _item_from_annotations(self, metadata, x, y, scale):
+        """Builds a data point from a decoded image and its rows of y_array.
+
+        Args:
+            - metadata (Tensor): Metadata of the image
+            - x (np.ndarray): Decoded image, see get_input
+            - y: Annotations of the image, in stored image coordinates
+            - scale (tuple): (sx, sy) size of x relative to the stored image
+        Output:
+            - metadata, x, targets: The data point, see __getitem__
+        """
+        y = torch.tensor(self._rescale(y, scale))
         targets = {self.geometry_name: y, "labels": np.zeros(len(y), dtype=int)}
 
         return metadata, x, targets
@@ -47,9 +85,231 @@ class MillionTreesDataset:
         Args:
             - idx (int): Index of a data point
         Output:
-            - x (Tensor): Input features of the idx-th data point
+            - x (np.ndarray): HxWx3 image of the idx-th data point. float32 in [0, 1] by
+              default, or uint8 in [0, 255] if the dataset was created with
+              image_dtype='uint8', in which case normalization is left to the collate function.
+              If an image cache is attached, the cached, resized image.
         """
-        raise NotImplementedError
+        if self.image_cache is not None:
+            return self.image_cache.image(idx, self.image_dtype)
+        return self._load_input(idx)[0]
+
+    def _image_path(self, idx):
+        # All images are in the images folder
+        return os.path.join(self._data_dir / 'images' / self._input_array[idx])
+
+    def _image_source(self, idx):
+        """Path of the idx-th image, or its encoded bytes when reading from the archive."""
+        if self.zip_archive is not None:
+            return self.zip_archive.read(f'images/{self._input_array[idx]}')
+        return self._image_path(idx)
+
+    def _load_input(self, idx):
+        """Decodes the idx-th image with the configured decode backend.
+
+        Output:
+            - x (np.ndarray): Image, see get_input
+            - scale (tuple): (sx, sy) size of x relative to the stored image. Not (1, 1)
+              only when reduced_decode is set; annotations must be multiplied by it.
+        """
+        cache = self.shared_cache
+        decoded = cache.get(idx) if cache is not None else None
+        if decoded is None:
+            target_size = self.image_size if self.reduced_decode else None
+            decoded = decode_image(self._image_source(idx),
+                                   backend=self.decode_backend,
+                                   target_size=target_size)
+            if cache is not None:
+                cache.put(idx, *decoded)
+        img, scale = decoded
+        return self._convert_input(img), scale
+
+    def _convert_input(self, img):
+        """Converts a decoded uint8 image to the configured image_dtype."""
+        if self.image_dtype != 'uint8':
+            img = np.array(img / 255, dtype=np.float32)
+        return img
+
+    @staticmethod
+    def _rescale(y, scale):
+        """Scales an array of (x, y) coordinate pairs, e.g. boxes or points, by scale."""
+        if tuple(scale) == (1.0, 1.0):
+            return y
+        factors = np.tile(np.asarray(scale, dtype=np.float32), y.shape[1] // 2)
+        return (y * factors).astype(np.float32)
+
+    def _init_from_index(self, index):
+        """Sets the image-level arrays shared by all MillionTrees datasets from a compiled
+        annotation index.
+
+        Images outside the selected sources and splits are dropped first.
+
+        Args:
+            - index (AnnotationIndex): Compiled annotations of the split file
+        Output:
+            - index (AnnotationIndex): The index restricted to the selected images
+        """
+        selected = np.ones(index.n_images, dtype=bool)
+        if self.sources is not None:
+            names = index.sources.astype(str)
+            unknown = sorted(set(self.sources) - set(names.tolist()))
+            if unknown:
+                raise ValueError(
+                    f'Sources {unknown} not found. Must be in {names.tolist()}.'
+                )
+            selected &= np.isin(names[index.source_id], self.sources)
+        if self.splits is not None:
+            unknown = sorted(set(self.splits) - set(self._split_dict))
+            if unknown:
+                raise ValueError(
+                    f'Splits {unknown} not found. Must be in {list(self._split_dict)}.'
+                )
+            selected &= np.isin(index.split, self.splits)
+        if not selected.all():
+            index = index.select(selected,
+                                 sources=self.sources,
+                                 splits=self.splits)
+
+        self._annotation_index = index
+        self._split_array = np.array(
+            [self._split_dict[split] for split in index.split])
+
+        # Filenames
+        self._input_array = index.filenames
+
+        # Annotations of image i are rows _offsets[i]:_offsets[i + 1] of _y_array
+        self._offsets = index.offsets
+
+        # filename_id is the alphabetical rank of each filename, so filenames can be
+        # looked up with a binary search instead of a dictionary
+        self._filename_id_to_idx = np.argsort(index.filename_id)
+        self._sorted_filenames = index.filenames[self._filename_id_to_idx]
+
+        # Create dictionary for codes to names
+        self._source_id_to_code = dict(enumerate(index.sources.tolist()))
+        self._filename_id_to_code = dict(
+            zip(index.filename_id.tolist(), index.filenames.tolist()))
+
+        # Location/group info
+        self._n_groups = len(index.sources)
+
+        # Metadata is at the image level
+        self._metadata_array = torch.tensor(
+            np.stack([index.filename_id, index.source_id], axis=1))
+        self._metadata_fields = ['filename_id', 'source_id']
+        return index
+
+    def _annotation_slice(self, idx):
+        """The rows of the annotation arrays belonging to the idx-th image."""
+        return slice(self._offsets[idx], self._offsets[idx + 1])
+
+    def get_image_index(self, filename):
+        """
+        Args:
+            - filename (str): Image filename, relative to the images folder
+        Output:
+            - idx (int): Index of the image in the dataset
+        """
+        filename_id = np.searchsorted(self._sorted_filenames, filename)
+        if (filename_id == len(self._sorted_filenames) or
+                self._sorted_filenames[filename_id] != filename):
+            raise KeyError(filename)
+        return int(self._filename_id_to_idx[filename_id])
+
+    def get_annotation_from_filename(self, filename):
+        """
+        Args:
+            - filename (str): Image filename, relative to the images folder
+        Output:
+            - y: Annotations of the image
+        """
+        return self._y_array[self._annotation_slice(
+            self.get_image_index(filename))]
+
+    def _image_cache_dir(self, cache_dir, image_size):
+        if cache_dir is None:
+            cache_dir = self._data_dir / f'{self._split_scheme}.images{image_size}'
+        return str(cache_dir)
+
+    def materialize_cache(self, image_size=None, dir=None, num_workers=0):
+        """Resizes every image once and writes it, with its rescaled targets, to a single
+        memory-mapped uint8 array of shape (N, image_size, image_size, 3).
+
+        This is an offline step; afterwards __getitem__ serves images and targets from the
+        cache without decoding. Later constructions pick the cache up with image_cache=True
+        (or the path).
+
+        Args:
+            image_size (int): Side of the cached images. Defaults to self.image_size.
+            dir (str): Defaults to '<split_scheme>.images<image_size>' in the data directory.
+            num_workers (int): Threads used to decode and resize images.
+        Returns:
+            str: The cache directory.
+        """
+        if image_size is None:
+            image_size = self.image_size
+        cache_dir = self._image_cache_dir(dir, image_size)
+        materialize_image_cache(self,
+                                cache_dir,
+                                image_size,
+                                num_workers=num_workers)
+        self.load_image_cache(cache_dir)
+        return cache_dir
+
+    def load_image_cache(self, dir=None):
+        """Serves __getitem__ from a cache written by materialize_cache."""
+        cache_dir = self._image_cache_dir(dir, self.image_size)
+        if not os.path.exists(cache_dir):
+            raise FileNotFoundError(
+                f'No image cache found at {cache_dir}. Run dataset.materialize_cache() first.'
+            )
+        cache = ImageCache(cache_dir)
+        if (cache.stamp.get('annotations') != self._annotation_index.stamp or
+                len(cache) != len(self)):
+            raise ValueError(
+                f'The image cache at {cache_dir} was built from a different version of '
+                f'{self._split_scheme}.csv. Rebuild it with dataset.materialize_cache().'
+            )
+        self._image_cache = cache
+
+    def enable_shared_cache(self, budget_bytes):
+        """Caches decoded images in shared memory, shared by every DataLoader worker.
+
+        Create the cache before building the loaders; workers attach to it when they
+        receive the dataset. Least recently used images are evicted once budget_bytes is
+        reached. Use shared_cache.stats() for hit/miss counts.
+
+        Args:
+            - budget_bytes (int): Maximum size of the decoded images kept in memory
+        Output:
+            - cache (SharedImageCache): The new cache
+        """
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+        self._shared_cache = SharedImageCache(len(self), budget_bytes)
+        return self._shared_cache
+
+    @property
+    def df(self):
+        """The split file as a pandas DataFrame, with 'source_id' and 'filename_id' columns.
+
+        Constructing a dataset only reads the compiled annotation index, so the csv is parsed
+        the first time this is accessed.
+        """
+        if getattr(self, '_df', None) is None:
+            csv_name = f'{self._split_scheme}.csv'
+            if self.zip_archive is not None:
+                df = pd.read_csv(self.zip_archive.open(csv_name))
+            else:
+                df = pd.read_csv(self._data_dir / csv_name)
+            df['source_id'] = df.source.astype('category').cat.codes
+            df['filename_id'] = df.filename.astype('category').cat.codes
+            if self.sources is not None or self.splits is not None:
+                # Ids are computed first, so they match metadata_array
+                df = df[df.filename.isin(
+                    self._input_array)].reset_index(drop=True)
+            self._df = df
+        return self._df
 
     def eval(self, y_pred, y_true, metadata):
         """
@@ -63,6 +323,47 @@ class MillionTreesDataset:
         """
         raise NotImplementedError
 
+    # Match-quality thresholds of sweep
+    _sweep_iou_thresholds = COCO_IOU_THRESHOLDS
+
+    def sweep(self, iou_thresholds=None, score_thresholds=None):
+        """An evaluator of the predictions over a grid of score and IoU thresholds.
+
+        Call its update method on each batch, e.g. in the loop over the eval loader, then
+        compute. See DetectionSweep.
+
+        Args:
+            - iou_thresholds (sequence of float): Match-quality thresholds, IoUs or inverse
+              distances for points. Defaults to those of the dataset, 0.5:0.95 for IoUs.
+            - score_thresholds (sequence of float): Defaults to 0, 0.01, ..., 1
+        Output:
+            - sweep (DetectionSweep): Evaluator sharing the matching of the dataset metrics
+        """
+        kwargs = {}
+        if score_thresholds is not None:
+            kwargs['score_thresholds'] = score_thresholds
+        return DetectionSweep(self._matches,
+                              self._eval_grouper,
+                              iou_thresholds=self._sweep_iou_thresholds
+                              if iou_thresholds is None else iou_thresholds,
+                              geometry_name=self.geometry_name,
+                              **kwargs)
+
+    def eval_sweep(self,
+                   y_pred,
+                   y_true,
+                   metadata,
+                   iou_thresholds=None,
+                   score_thresholds=None):
+        """Evaluates the predictions of eval at every pair of thresholds, see sweep.
+
+        Output:
+            - results (dict), results_str (str): As returned by DetectionSweep.compute
+        """
+        sweep = self.sweep(iou_thresholds, score_thresholds)
+        sweep.update(y_pred, y_true, metadata)
+        return sweep.compute()
+
     def get_subset(self, split, frac=1.0, transform=None):
         """
         Args:
@@ -90,8 +391,80 @@ class MillionTreesDataset:
         return MillionTreesSubset(self, split_idx, transform,
                                   self.geometry_name)
 
+    def get_eval_targets(self, split):
+        """Ground truth of a split, read from the annotations without decoding any image.
+
+        Args:
+            - split (str): Split identifier, e.g. 'test'
+        Output:
+            - y_true (list of dict): Targets of every image of the split, as the eval loader
+              of get_subset(split) yields them, i.e. rescaled to image_size
+            - metadata (Tensor): Metadata of the images, get_subset(split).metadata_array
+        """
+        return self.get_subset(split).get_eval_targets()
+
+    def _eval_targets(self, indices):
+        """Evaluation targets of some images, see get_eval_targets."""
+        y_true = []
+        for idx in indices:
+            # Only the image header is read, to get the resize factors
+            width, height = read_image_size(self._image_source(idx))
+            y_true.append(
+                self._eval_target(
+                    idx, (self.image_size / width, self.image_size / height)))
+        return y_true, self._metadata_array[indices]
+
+    def _eval_target(self, idx, scale):
+        """Targets of the idx-th image resized by scale, as _transform_ produces them."""
+        y = self._rescale(self._y_array[self._annotation_slice(idx)], scale)
+        y = torch.from_numpy(np.asarray(y, dtype=np.float32))
+        return {
+            self.geometry_name: y,
+            "labels": torch.zeros(len(y), dtype=torch.int64)
+        }
+
+    def _prediction_from_rows(self, rows):
+        """Converts the rows of a prediction file for one image to a y_pred entry."""
+        raise NotImplementedError
+
+    def eval_predictions(self, pred_file, split='test'):
+        """Scores a prediction file against a split, without decoding any image.
+
+        Unlike milliontrees.evaluate.evaluate, every prediction and target of the split is
+        held in memory.
+
+        Args:
+            - pred_file (str): Parquet, Arrow IPC or csv file with one row per predicted
+              geometry, see milliontrees.evaluate for its columns. The rows of an image
+              must be contiguous.
+            - split (str): Split the predictions were made on
+        Output:
+            - results (dict), results_str (str): See eval
+        """
+        from milliontrees.evaluate import join_predictions
+
+        y_true, metadata = self.get_eval_targets(split)
+        no_predictions, runs = join_predictions(self, pred_file, split)
+        y_pred = [None] * len(y_true)
+        for i, rows in runs:
+            y_pred[i] = self._prediction_from_rows(rows)
+        # Images without predictions
+        y_pred = [
+            self._prediction_from_rows(no_predictions) if pred is None else pred
+            for pred in y_pred
+        ]
+        return self.eval(y_pred, y_true, metadata)
+
     def check_init(self):
         """Convenience function to check that the WILDSDataset is properly configured."""
+        if self.image_dtype not in ('float32', 'uint8'):
+            raise ValueError(
+                f"image_dtype must be 'float32' or 'uint8', got {self.image_dtype}."
+            )
+        if self.decode_backend not in DECODE_BACKENDS:
+            raise ValueError(
+                f'decode_backend must be one of {DECODE_BACKENDS}, got {self.decode_backend}.'
+            )
         required_attrs = [
             '_dataset_name', '_data_dir', '_split_scheme', '_split_array',
             '_y_array', '_y_size', '_metadata_fields', '_metadata_array'
@@ -112,8 +485,10 @@ class MillionTreesDataset:
         assert 'val' in self.split_dict
 
         # Check the form of the required arrays
-        assert isinstance(self.y_array, np.ndarray) or isinstance(
-            self.y_array, list), 'y_array must be a numpy array or list'
+        assert isinstance(
+            self.y_array,
+            (np.ndarray, list,
+             WKBArray)), 'y_array must be a numpy array, list or WKBArray'
         assert isinstance(self.metadata_array,
                           torch.Tensor), 'metadata_array must be a torch tensor'
 
@@ -288,6 +663,60 @@ class MillionTreesDataset:
         """
         return getattr(self, '_metadata_map', None)
 
+    @property
+    def image_dtype(self):
+        """dtype of the images returned by get_input, 'float32' or 'uint8'."""
+        return getattr(self, '_image_dtype', 'float32')
+
+    @property
+    def decode_backend(self):
+        """Image decoding backend, one of 'pil', 'torchvision' or 'opencv'."""
+        return getattr(self, '_decode_backend', 'pil')
+
+    @property
+    def reduced_decode(self):
+        """Whether JPEGs are decoded at a reduced resolution close to image_size.
+
+        Targets returned by __getitem__ are rescaled to the decoded image.
+        """
+        return getattr(self, '_reduced_decode', False)
+
+    @property
+    def image_cache(self):
+        """The attached ImageCache, or None if images are decoded on every access."""
+        return getattr(self, '_image_cache', None)
+
+    @property
+    def shared_cache(self):
+        """The SharedImageCache of decoded images, or None."""
+        return getattr(self, '_shared_cache', None)
+
+    @property
+    def from_zip(self):
+        """Whether the split file and images are read directly from 'archive.zip'."""
+        return getattr(self, '_from_zip', False)
+
+    @property
+    def zip_archive(self):
+        """The ZipArchive read from when from_zip is set, otherwise None."""
+        return getattr(self, '_zip_archive', None)
+
+    @property
+    def sources(self):
+        """Names of the sources the dataset is restricted to, or None for all sources."""
+        sources = getattr(self, '_sources', None)
+        if isinstance(sources, str):
+            return [sources]
+        return None if sources is None else [str(s) for s in sources]
+
+    @property
+    def splits(self):
+        """Names of the splits the dataset is restricted to, or None for all splits."""
+        splits = getattr(self, '_splits', None)
+        if isinstance(splits, str):
+            return [splits]
+        return None if splits is None else list(splits)
+
     @property
     def original_resolution(self):
         """Original image resolution for image datasets."""
@@ -307,13 +736,84 @@ class MillionTreesDataset:
                                 f'{self.dataset_name}_v{self.version}')
         version_file = os.path.join(data_dir, f'RELEASE_v{self.version}.txt')
 
-        # If the dataset exists at root_dir, then don't download.
-        if not self.dataset_exists_locally(data_dir, version_file):
-            self.download_dataset(data_dir, download)
+        if self.from_zip:
+            # Keep the archive as downloaded and read members from it directly
+            archive = os.path.join(data_dir, 'archive.zip')
+            if not os.path.exists(archive) and download:
+                with self._download_lock(data_dir):
+                    # The archive is renamed into place once complete
+                    if not os.path.exists(archive):
+                        self.download_dataset(data_dir, download, extract=False)
+            if not os.path.exists(archive):
+                raise FileNotFoundError(
+                    f'{archive} could not be found. Initialize the dataset with download=True '
+                    f'to download it.')
+            self._zip_archive = ZipArchive(archive)
+            return data_dir
+
+        # If the dataset exists at root_dir, then don't download. Readers never lock.
+        if self.dataset_exists_locally(data_dir, version_file):
+            return data_dir
+        if not download:
+            self._check_download(data_dir, download)
+        with self._download_lock(data_dir):
+            # Another process may have installed it while this one waited
+            if not self.dataset_exists_locally(data_dir, version_file):
+                self._install(root_dir, data_dir, download)
         return data_dir
 
+    @contextlib.contextmanager
+    def _download_lock(self, data_dir):
+        """Holds the lock on downloads into data_dir, shared by every process."""
+        root_dir, name = os.path.split(os.path.normpath(data_dir))
+        lock = FileLock(os.path.join(root_dir, f'.{name}.lock'))
+        lock.acquire(on_wait=lambda: print(
+            f'Waiting for another process to download {data_dir}...'))
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _install(self, root_dir, data_dir, download):
+        """Downloads the dataset into data_dir. Only called with the download lock held.
+
+        A new data directory is downloaded under a temporary name and renamed into place
+        once the whole download succeeded, so other processes never see a partial copy; a
+        failed download is kept there, so rerunning resumes it. Partial installs grow in
+        place instead, one atomically
+        renamed file at a time, and their marker is only updated once the files it lists
+        are complete.
+        """
+        if self._selection() is not None or os.path.exists(data_dir):
+            if self._selection() is not None:
+                self.download_subset(data_dir, download)
+            elif not self.update_from_installed_version(root_dir, data_dir,
+                                                        download):
+                self.download_dataset(data_dir, download)
+            return
+
+        tmp_dir = os.path.join(root_dir,
+                               f'.{os.path.basename(data_dir)}.download')
+        if not self.update_from_installed_version(root_dir, tmp_dir, download):
+            self.download_dataset(tmp_dir, download)
+        if not os.path.exists(
+                os.path.join(tmp_dir, f'RELEASE_v{self.version}.txt')):
+            raise RuntimeError(
+                f'The download of {self.dataset_name} v{self.version} did not complete. '
+                f'Rerun this command to resume it.')
+        os.rename(tmp_dir, data_dir)
+
+    def _selection(self):
+        return make_selection(self.split_scheme, self.sources, self.splits)
+
     def dataset_exists_locally(self, data_dir, version_file):
         download_url = self.versions_dict[self.version]['download_url']
+        # A partial install only holds the images of the selections it lists
+        selections = read_partial_install(data_dir)
+        if selections is not None:
+            return any(
+                covers(selection, self._selection())
+                for selection in selections)
         # There are two ways to download a dataset:
         # 1. Automatically through the MillionTrees package
         # Datasets downloaded from a third party need not have a download_url and RELEASE text file.
@@ -321,10 +821,9 @@ class MillionTreesDataset:
                 (os.path.exists(version_file) or
                  (len(os.listdir(data_dir)) > 0 and download_url is None)))
 
-    def download_dataset(self, data_dir, download_flag):
-        version_dict = self.versions_dict[self.version]
-        download_url = version_dict['download_url']
-        compressed_size = version_dict['compressed_size']
+    def _check_download(self, data_dir, download_flag):
+        """The download url of the dataset, once downloading is known to be possible."""
+        download_url = self.versions_dict[self.version]['download_url']
 
         # Check that download_url exists.
         if download_url is None:
@@ -338,27 +837,116 @@ class MillionTreesDataset:
                 f'The {self.dataset_name} dataset could not be found in {data_dir}. Initialize the dataset with '
                 f'download=True to download the dataset. If you are using the example script, run with --download. '
                 f'This might take some time for large datasets.')
+        return download_url
+
+    def download_dataset(self, data_dir, download_flag, extract=True):
+        download_url = self._check_download(data_dir, download_flag)
+        compressed_size = self.versions_dict[self.version]['compressed_size']
 
-        from milliontrees.datasets.download_utils import download_and_extract_archive
+        from milliontrees.datasets.download_utils import download_and_extract_archive, download_url as download_file
 
         print(f'Downloading dataset to {data_dir}...')
 
         try:
             start_time = time.time()
-            download_and_extract_archive(url=download_url,
-                                         download_root=data_dir,
-                                         filename='archive.zip',
-                                         remove_finished=True,
-                                         size=compressed_size)
+            if extract:
+                download_and_extract_archive(url=download_url,
+                                             download_root=data_dir,
+                                             filename='archive.zip',
+                                             remove_finished=True,
+                                             size=compressed_size,
+                                             streaming=True)
+                clear_partial_install(data_dir)
+            else:
+                download_file(download_url,
+                              data_dir,
+                              filename='archive.zip',
+                              size=compressed_size)
             download_time_in_minutes = (time.time() - start_time) / 60
             print(
                 f"\nIt took {round(download_time_in_minutes, 2)} minutes to download and uncompress the dataset.\n"
             )
         except Exception as e:
+            archive = os.path.join(data_dir, 'archive.zip')
+            if os.path.exists(archive + '.part.json'):
+                print(
+                    f"\nThe download of {archive} was interrupted. Rerun this command to resume it.\n"
+                )
+            else:
+                print(
+                    f"\n{archive} may be corrupted. Please try deleting it and rerunning this command.\n"
+                )
+            print(f"Exception: ", e)
+            raise
+
+    def download_subset(self, data_dir, download_flag):
+        """Downloads the images of the selected sources and splits only.
+
+        Requires range requests. Without them, the whole dataset is downloaded.
+        """
+        download_url = self._check_download(data_dir, download_flag)
+
+        from milliontrees.datasets.download_utils import _probe
+
+        if not _probe(download_url)['accept_ranges']:
             print(
-                f"\n{os.path.join(data_dir, 'archive.zip')} may be corrupted. Please try deleting it and rerunning this command.\n"
+                f'{download_url} does not support range requests, downloading the whole dataset.'
             )
-            print(f"Exception: ", e)
+            self.download_dataset(data_dir, download_flag)
+            return
+        print(
+            f'Downloading sources {self.sources} and splits {self.splits} of the dataset to {data_dir}...'
+        )
+        download_subset(download_url, data_dir, self._selection())
+
+    def _installed_version_dir(self, root_dir):
+        """Data directory of the latest other version fully installed in root_dir, or None."""
+        installed = []
+        for version in self.versions_dict:
+            data_dir = os.path.join(root_dir, f'{self.dataset_name}_v{version}')
+            if (version != self.version and os.path.exists(
+                    os.path.join(data_dir, f'RELEASE_v{version}.txt')) and
+                    read_partial_install(data_dir) is None):
+                installed.append((tuple(map(int,
+                                            version.split('.'))), data_dir))
+        return max(installed)[1] if installed else None
+
+    def update_from_installed_version(self, root_dir, data_dir, download_flag):
+        """Builds data_dir from another installed version, fetching only the changed files.
+
+        Unchanged files are hard-linked from the installed version, see manifest.
+
+        Output:
+            - updated (bool): False if no other version is installed or the server does not
+              support range requests, in which case nothing was downloaded.
+        """
+        old_dir = self._installed_version_dir(root_dir)
+        if old_dir is None:
+            return False
+        download_url = self._check_download(data_dir, download_flag)
+
+        from milliontrees.datasets.download_utils import _probe
+
+        if not _probe(download_url)['accept_ranges']:
+            return False
+        print(f'Updating {old_dir} to version {self.version} in {data_dir}...')
+        stats = update_from_version(download_url, old_dir, data_dir)
+        print(
+            f"Reused {stats['linked']} unchanged files, downloaded {stats['fetched']}."
+        )
+        clear_partial_install(data_dir)
+        return True
+
+    def check_integrity(self, num_workers=8):
+        """Checks the data directory against the manifest of the release.
+
+        Files are hashed in parallel, and files unchanged since they were last hashed are
+        not read again.
+
+        Output:
+            - names (list of str): Relative paths of the missing or corrupted files
+        """
+        return verify_manifest(self._data_dir, num_workers=num_workers)
 
     def check_version(self):
         # Check that the version is valid.
@@ -424,30 +1012,13 @@ class MillionTreesDataset:
             - results (dict): Dictionary of results
             - results_str (str): Pretty print version of the results
         """
-        results, results_str = {}, ''
+        results = {}
         if aggregate:
             results.update(metric.compute(y_pred, y_true))
-            results_str += f"Average {metric.name}: {results[metric.agg_metric_field]:.3f}\n"
         g = grouper.metadata_to_group(metadata)
         group_results = metric.compute_group_wise(y_pred, y_true, g,
                                                   grouper.n_groups)
-        for group_idx in range(grouper.n_groups):
-            group_str = grouper.group_field_str(group_idx)
-            group_metric = group_results[metric.group_metric_field(group_idx)]
-            group_counts = group_results[metric.group_count_field(group_idx)]
-            results[f'{metric.name}_{group_str}'] = group_metric
-            results[f'count_{group_str}'] = group_counts
-            if group_results[metric.group_count_field(group_idx)] == 0:
-                continue
-            results_str += (
-                f'  {grouper.group_str(group_idx)}  '
-                f"[n = {group_results[metric.group_count_field(group_idx)]:6.0f}]:\t"
-                f"{metric.name} = {group_results[metric.group_metric_field(group_idx)]:5.3f}\n"
-            )
-        results[f'{metric.worst_group_metric_field}'] = group_results[
-            f'{metric.worst_group_metric_field}']
-        results_str += f"Worst-group {metric.name}: {group_results[metric.worst_group_metric_field]:.3f}\n"
-        return results, results_str
+        return group_eval_results(metric, grouper, results, group_results)
 
 
 class MillionTreesSubset(MillionTreesDataset):
@@ -478,54 +1049,8 @@ class MillionTreesSubset(MillionTreesDataset):
 
     def __getitem__(self, idx):
         metadata, x, targets = self.dataset[self.indices[idx]]
-
-        if self._dataset_name == 'TreeBoxes':
-            augmented = self.transform(image=x,
-                                       bboxes=targets[self.geometry_name],
-                                       labels=targets["labels"])
-            y = torch.from_numpy(augmented["bboxes"]).float()
-
-        elif self._dataset_name == 'TreePoints':
-            augmented = self.transform(
-                image=x,
-                keypoints=targets[self.geometry_name],
-                labels=targets["labels"],
-            )
-            y = torch.from_numpy(augmented["keypoints"]).float()
-
-        else:
-            masks = [mask for mask in targets[self.geometry_name]]
-            augmented = self.transform(image=x,
-                                       masks=masks,
-                                       bboxes=targets["bboxes"],
-                                       labels=targets["labels"])
-
-            y = augmented['masks']
-            y = torch.stack(y, dim=0)
-            bboxes = augmented['bboxes']
-
-        x = augmented['image']
-        labels = torch.from_numpy(np.array(augmented["labels"]))
-
-        # If image has no annotations, set zeros
-        if len(y) == 0:
-            if self._dataset_name == 'TreeBoxes':
-                y = torch.zeros(0, 4)
-            elif self._dataset_name == 'TreePoints':
-                y = torch.zeros(0, 2)
-            else:
-                bboxes = torch.zeros(0, 4)
-
-        if self._dataset_name == 'TreePolygons':
-            targets = {
-                self.geometry_name: y,
-                "labels": labels,
-                "bboxes": bboxes
-            }
-        else:
-            targets = {self.geometry_name: y, "labels": labels}
-
-        return metadata, x, targets
+        return apply_transform(self.transform, self._dataset_name,
+                               self.geometry_name, metadata, x, targets)
 
     def __len__(self):
         return len(self.indices)
@@ -544,3 +1069,65 @@ class MillionTreesSubset(MillionTreesDataset):
 
     def eval(self, y_pred, y_true, metadata):
         return self.dataset.eval(y_pred, y_true, metadata)
+
+    def get_eval_targets(self):
+        """Ground truth of the subset without decoding any image, see
+        MillionTreesDataset.get_eval_targets."""
+        return self.dataset._eval_targets(self.indices)
+
+
+def apply_transform(transform, dataset_name, geometry_name, metadata, x,
+                    targets):
+    """Applies an albumentations transform to a data point of a MillionTrees dataset.
+
+    Args:
+        - transform (A.Compose): Transform, e.g. dataset._transform_()
+        - dataset_name (str): 'TreeBoxes', 'TreePoints' or 'TreePolygons'
+        - geometry_name (str): Key of the geometries in targets
+        - metadata, x, targets: A data point as returned by the dataset's __getitem__
+    Output:
+        - metadata, x, targets: The transformed data point
+    """
+    if dataset_name == 'TreeBoxes':
+        augmented = transform(image=x,
+                              bboxes=targets[geometry_name],
+                              labels=targets["labels"])
+        y = torch.from_numpy(augmented["bboxes"]).float()
+
+    elif dataset_name == 'TreePoints':
+        augmented = transform(
+            image=x,
+            keypoints=targets[geometry_name],
+            labels=targets["labels"],
+        )
+        y = torch.from_numpy(augmented["keypoints"]).float()
+
+    else:
+        masks = [mask for mask in targets[geometry_name]]
+        augmented = transform(image=x,
+                              masks=masks,
+                              bboxes=targets["bboxes"],
+                              labels=targets["labels"])
+
+        y = augmented['masks']
+        y = torch.stack(y, dim=0)
+        bboxes = augmented['bboxes']
+
+    x = augmented['image']
+    labels = torch.from_numpy(np.array(augmented["labels"]))
+
+    # If image has no annotations, set zeros
+    if len(y) == 0:
+        if dataset_name == 'TreeBoxes':
+            y = torch.zeros(0, 4)
+        elif dataset_name == 'TreePoints':
+            y = torch.zeros(0, 2)
+        else:
+            bboxes = torch.zeros(0, 4)
+
+    if dataset_name == 'TreePolygons':
+        targets = {geometry_name: y, "labels": labels, "bboxes": bboxes}
+    else:
+        targets = {geometry_name: y, "labels": labels}
+
+    return metadata, x, targets
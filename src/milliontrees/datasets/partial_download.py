@@ -0,0 +1,114 @@
+"""Partial installs: downloading only some sources or splits of a dataset.
+
+The full archives of the larger datasets run to many gigabytes, while evaluating on
+one split or training on a handful of sources needs a fraction of the images.
+download_subset reads the central directory of the remote archive with range
+requests, extracts every member outside ``images/`` (the split files, release notes,
+...), then extracts only the images referenced by the selected rows of the split file.
+
+A partial install is marked by ``partial_install.json`` in the data directory, which
+lists the selections downloaded so far. A request covered by one of them loads without
+touching the network. Any other request downloads again, and since members that are
+already extracted are skipped, only the missing images are fetched. A full download
+removes the marker.
+"""
+import json
+import os
+
+import pandas as pd
+
+from milliontrees.datasets.download_utils import remote_zip_members, stream_extract_archive
+
+PARTIAL_INSTALL_FILE = 'partial_install.json'
+
+
+def make_selection(split_scheme, sources=None, splits=None):
+    """Normalized description of a subset, or None for the whole dataset."""
+    if sources is None and splits is None:
+        return None
+    return {
+        'split_scheme': split_scheme,
+        'sources': None if sources is None else sorted(map(str, sources)),
+        'splits': None if splits is None else sorted(splits),
+    }
+
+
+def covers(selection, request):
+    """Whether every image of the request is part of the selection."""
+    if selection is None:
+        return True
+    if request is None or selection['split_scheme'] != request['split_scheme']:
+        return False
+    for key in ('sources', 'splits'):
+        if selection[key] is not None and (request[key] is None or not set(
+                request[key]) <= set(selection[key])):
+            return False
+    return True
+
+
+def read_partial_install(data_dir):
+    """The selections of a partial install, or None if data_dir is not one."""
+    try:
+        with open(os.path.join(data_dir, PARTIAL_INSTALL_FILE)) as f:
+            return json.load(f)['selections']
+    except FileNotFoundError:
+        return None
+
+
+def _write_partial_install(data_dir, selections):
+    os.makedirs(data_dir, exist_ok=True)
+    marker = os.path.join(data_dir, PARTIAL_INSTALL_FILE)
+    with open(marker + '.tmp', 'w') as f:
+        json.dump({'selections': selections}, f, indent=1)
+    os.replace(marker + '.tmp', marker)
+
+
+def clear_partial_install(data_dir):
+    """Marks data_dir as a complete install."""
+    marker = os.path.join(data_dir, PARTIAL_INSTALL_FILE)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def download_subset(url, data_dir, selection, num_workers=8):
+    """Extracts the part of a remote dataset archive needed by a selection.
+
+    Args:
+        - url (str): URL of the dataset archive, on a server supporting range requests
+        - data_dir (str): Directory to extract to
+        - selection (dict): Subset to download, from make_selection
+        - num_workers (int): Number of concurrent range requests
+    """
+    members = remote_zip_members(url)
+    previous = read_partial_install(data_dir) or []
+    # Written before extraction, so an interrupted download is never taken as complete
+    _write_partial_install(data_dir, previous)
+
+    stream_extract_archive(
+        url,
+        data_dir,
+        members=[
+            info for info in members if not info.filename.startswith('images/')
+        ],
+        num_workers=num_workers)
+
+    split_file = os.path.join(data_dir, f"{selection['split_scheme']}.csv")
+    df = pd.read_csv(split_file, usecols=['filename', 'source', 'split'])
+    rows = pd.Series(True, index=df.index)
+    if selection['sources'] is not None:
+        rows &= df['source'].astype(str).isin(selection['sources'])
+    if selection['splits'] is not None:
+        rows &= df['split'].isin(selection['splits'])
+    if not rows.any():
+        raise ValueError(
+            f"No images of {os.path.basename(split_file)} match sources {selection['sources']} "
+            f"and splits {selection['splits']}.")
+    images = set('images/' + df.loc[rows, 'filename'].astype(str))
+    stream_extract_archive(
+        url,
+        data_dir,
+        members=[info for info in members if info.filename in images],
+        num_workers=num_workers)
+
+    selections = [s for s in previous if not covers(selection, s)]
+    _write_partial_install(data_dir, selections + [selection])
@@ -0,0 +1,280 @@
+"""Sequential tar shards of a MillionTrees split, and a dataset that streams them.
+
+Parallel filesystems serve millions of small random reads poorly. export_shards packs
+the images of one split into tar files of about shard_bytes each, in the WebDataset
+layout: every image is stored as two consecutive members sharing a key,
+``<key>.<ext>`` with the original encoded image bytes and ``<key>.json`` with its
+annotation record. A ``shards.json`` manifest lists the shards. ShardedDataset reads
+shards front to back and yields the same (metadata, x, targets) tuples as
+``dataset.get_subset(split)``, so the dataset's collate function and eval work unchanged.
+"""
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from milliontrees.datasets.image_io import decode_image
+from milliontrees.datasets.milliontrees_dataset import apply_transform
+
+# Bump when the record layout changes.
+SHARD_FORMAT_VERSION = 1
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _record(dataset, idx):
+    """The JSON-serializable annotation record of the idx-th image."""
+    record = {
+        'idx': int(idx),
+        'filename': str(dataset._input_array[idx]),
+        'metadata': dataset.metadata_array[idx].tolist(),
+    }
+    rows = dataset._annotation_slice(idx)
+    if dataset.dataset_name == 'TreePolygons':
+        y_array = dataset._y_array
+        record['wkb'] = [
+            y_array.wkb_at(i).hex() for i in range(rows.start, rows.stop)
+        ]
+    else:
+        record['y'] = np.asarray(dataset._y_array[rows]).tolist()
+    return record
+
+
+def export_shards(dataset, out_dir, split='train', shard_bytes=10**9):
+    """Packs the images of a split and their annotations into tar shards.
+
+    Args:
+        - dataset (MillionTreesDataset): Full dataset to export from
+        - out_dir (str): Directory receiving the shards and 'shards.json'
+        - split (str): Split to export, or None for every image
+        - shard_bytes (int): Approximate maximum size of a shard. A shard always holds
+          at least one image.
+    Output:
+        - manifest (dict): Contents of 'shards.json'
+    """
+    if split is None:
+        indices = np.arange(len(dataset))
+    else:
+        if split not in dataset.split_dict:
+            raise ValueError(
+                f"Split {split} not found in dataset's split_dict.")
+        indices = np.flatnonzero(
+            dataset.split_array == dataset.split_dict[split])
+    os.makedirs(out_dir, exist_ok=True)
+    name = split or 'all'
+
+    shards = []
+    tar, shard_file, shard_size, n_samples = None, None, 0, 0
+
+    def close_shard():
+        tar.close()
+        os.rename(shard_file + '.tmp', shard_file)
+        shards.append({
+            'name': os.path.basename(shard_file),
+            'n_samples': n_samples
+        })
+
+    for idx in indices.tolist():
+        img_path = dataset._image_path(idx)
+        image_bytes = dataset._image_source(idx)
+        if not isinstance(image_bytes, bytes):
+            with open(img_path, 'rb') as f:
+                image_bytes = f.read()
+        record = json.dumps(_record(dataset, idx)).encode()
+        # Tar headers and padding add up to 1.5 KB per member
+        sample_size = len(image_bytes) + len(record) + 3072
+        if tar is not None and shard_size + sample_size > shard_bytes:
+            close_shard()
+            tar = None
+        if tar is None:
+            shard_file = os.path.join(out_dir, f'{name}-{len(shards):06d}.tar')
+            tar = tarfile.open(shard_file + '.tmp',
+                               'w',
+                               format=tarfile.USTAR_FORMAT)
+            shard_size, n_samples = 0, 0
+        key = f'{idx:09d}'
+        ext = os.path.splitext(img_path)[1].lstrip('.').lower() or 'img'
+        _add_member(tar, f'{key}.json', record)
+        _add_member(tar, f'{key}.{ext}', image_bytes)
+        shard_size += sample_size
+        n_samples += 1
+    if tar is not None:
+        close_shard()
+
+    manifest = {
+        'format_version': SHARD_FORMAT_VERSION,
+        'dataset': dataset.dataset_name,
+        'version': dataset.version,
+        'split_scheme': dataset.split_scheme,
+        'split': split,
+        'n_samples': int(len(indices)),
+        'shards': shards,
+        'annotations': dataset._annotation_index.stamp,
+    }
+    with open(os.path.join(out_dir, 'shards.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def iterate_shard(shard_file):
+    """Streams the (record, image_bytes) pairs of a shard in storage order."""
+    record, image_bytes, key = None, None, None
+    with tarfile.open(shard_file, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, ext = member.name.rsplit('.', 1)
+            if member_key != key:
+                key, record, image_bytes = member_key, None, None
+            data = tar.extractfile(member).read()
+            if ext == 'json':
+                record = json.loads(data)
+            else:
+                image_bytes = data
+            if record is not None and image_bytes is not None:
+                yield record, image_bytes
+                key = None
+
+
+class ShardedDataset(IterableDataset):
+    """Streams the tar shards written by export_shards.
+
+    Every epoch, the shard list is optionally shuffled with a seed shared by all
+    processes, split between distributed ranks, then between the DataLoader workers of
+    each rank, so every sample is read exactly once per epoch. Samples are decoded and
+    transformed exactly like dataset.get_subset(split)[i].
+
+    Args:
+        - dataset (MillionTreesDataset): The dataset the shards were exported from. Only
+          its configuration (transforms, image dtype, decode backend, collate function
+          and eval) is used; no image is read from its data directory.
+        - shards_dir (str): Directory written by export_shards
+        - transform (function): Transform of the data points. Defaults to
+          dataset._transform_()
+        - shuffle (bool): Shuffle shards, and samples within a buffer, every epoch
+        - shuffle_buffer (int): Number of samples shuffled together when shuffle is set
+        - seed (int): Base seed of the shuffles. Use set_epoch to reshuffle
+        - rank (int): Distributed rank. Defaults to torch.distributed, or 0
+        - world_size (int): Number of ranks. Defaults to torch.distributed, or 1
+    """
+
+    def __init__(self,
+                 dataset,
+                 shards_dir,
+                 transform=None,
+                 shuffle=False,
+                 shuffle_buffer=100,
+                 seed=0,
+                 rank=None,
+                 world_size=None):
+        with open(os.path.join(shards_dir, 'shards.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['dataset'] != dataset.dataset_name:
+            raise ValueError(
+                f"The shards in {shards_dir} hold {self.manifest['dataset']}, not {dataset.dataset_name}."
+            )
+        self.dataset = dataset
+        self.shards_dir = shards_dir
+        self.shard_files = [
+            os.path.join(shards_dir, shard['name'])
+            for shard in self.manifest['shards']
+        ]
+        self.transform = dataset._transform_(
+        ) if transform is None else transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        if rank is None or world_size is None:
+            distributed = (torch.distributed.is_available() and
+                           torch.distributed.is_initialized())
+            if rank is None:
+                rank = torch.distributed.get_rank() if distributed else 0
+            if world_size is None:
+                world_size = torch.distributed.get_world_size(
+                ) if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self):
+        """Number of samples read by this rank in the current epoch."""
+        n_samples = {
+            os.path.join(self.shards_dir, shard['name']): shard['n_samples']
+            for shard in self.manifest['shards']
+        }
+        return sum(n_samples[shard_file]
+                   for shard_file in self._assigned_shards(all_workers=True))
+
+    def set_epoch(self, epoch):
+        """Sets the epoch used to seed the shuffles, as DistributedSampler.set_epoch."""
+        self.epoch = epoch
+
+    @property
+    def collate(self):
+        return self.dataset.collate
+
+    def eval(self, y_pred, y_true, metadata):
+        return self.dataset.eval(y_pred, y_true, metadata)
+
+    def _assigned_shards(self, all_workers=False):
+        """Shards read by this rank and DataLoader worker in the current epoch."""
+        shard_files = list(self.shard_files)
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(
+                len(shard_files))
+            shard_files = [shard_files[i] for i in order]
+        shard_files = shard_files[self.rank::self.world_size]
+        worker_info = get_worker_info()
+        if worker_info is not None and not all_workers:
+            shard_files = shard_files[worker_info.id::worker_info.num_workers]
+        return shard_files
+
+    def _samples(self):
+        for shard_file in self._assigned_shards():
+            yield from iterate_shard(shard_file)
+
+    def _shuffled(self, samples):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = np.random.default_rng(
+            (self.seed, self.epoch, self.rank, worker_id))
+        buffer = []
+        for sample in samples:
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                yield buffer.pop(rng.integers(len(buffer)))
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        samples = self._samples()
+        if self.shuffle and self.shuffle_buffer > 1:
+            samples = self._shuffled(samples)
+        for record, image_bytes in samples:
+            yield self._decode_sample(record, image_bytes)
+
+    def _decode_sample(self, record, image_bytes):
+        dataset = self.dataset
+        target_size = dataset.image_size if dataset.reduced_decode else None
+        img, scale = decode_image(image_bytes,
+                                  backend=dataset.decode_backend,
+                                  target_size=target_size)
+        x = dataset._convert_input(img)
+        metadata = torch.tensor(record['metadata'])
+        if 'wkb' in record:
+            from shapely import from_wkb
+            y = from_wkb([bytes.fromhex(wkb) for wkb in record['wkb']])
+        else:
+            y = np.array(record['y'], dtype=dataset._y_array.dtype).reshape(
+                -1, dataset._y_array.shape[1])
+        item = dataset._item_from_annotations(metadata, x, y, scale)
+        return apply_transform(self.transform, dataset.dataset_name,
+                               dataset.geometry_name, *item)
@@ -0,0 +1,219 @@
+"""Decoded-image cache shared by all DataLoader workers.
+
+With num_workers > 0 every worker holds its own copy of the dataset, so an image decoded
+by one worker is decoded again by the others, and again on every epoch. A
+SharedImageCache keeps decoded images in POSIX shared memory
+(multiprocessing.shared_memory), one segment per image, under a byte budget with
+least-recently-used eviction. The bookkeeping table (segment sizes, last use and the
+hit/miss counters) lives in one more shared segment, guarded by a multiprocessing lock,
+so every process that unpickles the dataset sees the same cache.
+
+The process that creates the cache owns it: its segments are unlinked when the cache is
+closed or garbage collected, or when that process exits. On Windows a segment is freed
+as soon as no process has it open, so cached images do not survive there.
+"""
+import multiprocessing
+import secrets
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Header fields of the shared table
+_CLOCK, _USED_BYTES, _HITS, _MISSES, _EVICTIONS, _ENTRIES = range(6)
+_HEADER_SIZE = 8
+# Per-image fields: segment size, last use, image shape and decode scale (as float64 bits)
+_SIZE, _LAST_USED, _HEIGHT, _WIDTH, _CHANNELS, _SCALE_X, _SCALE_Y = range(7)
+_ROW_SIZE = 7
+
+
+def _untrack(shm):
+    # Before Python 3.13 every process that opens a segment registers it with its
+    # resource tracker, which unlinks it when that process exits. Segments must outlive
+    # the worker that created them, so the owner unlinks them instead.
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _open(name, create=False, size=0):
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    _untrack(shm)
+    return shm
+
+
+def _destroy(shm):
+    # unlink() unregisters the segment again, so balance the _untrack call first
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _unlink(name):
+    try:
+        shm = _open(name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    _destroy(shm)
+
+
+def _release(prefix, table_shm, n_items):
+    """Unlinks every segment of a cache. Runs in the owning process only."""
+    table = np.ndarray((_HEADER_SIZE + n_items * _ROW_SIZE,),
+                       dtype=np.int64,
+                       buffer=table_shm.buf)
+    rows = table[_HEADER_SIZE:].reshape(n_items, _ROW_SIZE)
+    for idx in np.flatnonzero(rows[:, _SIZE]).tolist():
+        _unlink(f'{prefix}_{idx}')
+    del table, rows
+    _destroy(table_shm)
+    try:
+        table_shm.close()
+    except BufferError:
+        # The cache itself still holds views at interpreter exit
+        pass
+
+
+class SharedImageCache:
+    """LRU cache of decoded images keyed by dataset index, shared across processes.
+
+    Args:
+        n_items (int): Number of images in the dataset.
+        budget_bytes (int): Maximum total size of the cached images.
+    """
+
+    def __init__(self, n_items, budget_bytes):
+        self.n_items = int(n_items)
+        self.budget_bytes = int(budget_bytes)
+        self._prefix = 'mt_' + secrets.token_hex(6)
+        # A spawn-context lock can be sent to forked, forkserver and spawned workers
+        self._lock = multiprocessing.get_context('spawn').Lock()
+        table_shm = _open(self._prefix + '_t',
+                          create=True,
+                          size=8 * (_HEADER_SIZE + self.n_items * _ROW_SIZE))
+        self._attach(table_shm)
+        self._table[:] = 0
+        self._finalizer = weakref.finalize(self, _release, self._prefix,
+                                           table_shm, self.n_items)
+
+    def _attach(self, table_shm):
+        self._table_shm = table_shm
+        self._table = np.ndarray((_HEADER_SIZE + self.n_items * _ROW_SIZE,),
+                                 dtype=np.int64,
+                                 buffer=table_shm.buf)
+        self._header = self._table[:_HEADER_SIZE]
+        self._rows = self._table[_HEADER_SIZE:].reshape(self.n_items, _ROW_SIZE)
+        self._scales = self._rows.view(np.float64)
+
+    def __getstate__(self):
+        # Workers attach to the owner's segments and never unlink them
+        return {
+            'n_items': self.n_items,
+            'budget_bytes': self.budget_bytes,
+            '_prefix': self._prefix,
+            '_lock': self._lock,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach(_open(self._prefix + '_t'))
+        self._finalizer = None
+
+    def get(self, idx):
+        """
+        Args:
+            - idx (int): Index of an image
+        Output:
+            - (img, scale) as returned by decode_image, or None on a miss
+        """
+        with self._lock:
+            row = self._rows[idx]
+            if row[_SIZE] == 0:
+                self._header[_MISSES] += 1
+                return None
+            self._header[_HITS] += 1
+            self._header[_CLOCK] += 1
+            row[_LAST_USED] = self._header[_CLOCK]
+            shape = tuple(row[_HEIGHT:_CHANNELS + 1].tolist())
+            scale = tuple(self._scales[idx, _SCALE_X:_SCALE_Y + 1].tolist())
+            # An evicted segment stays readable until closed, so copy outside the lock
+            shm = _open(f'{self._prefix}_{idx}')
+        try:
+            img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+        return img, scale
+
+    def put(self, idx, img, scale):
+        """Caches a decoded uint8 image, evicting the least recently used ones as needed.
+
+        Images larger than the whole budget are not cached.
+        """
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        size = img.nbytes
+        if size == 0 or size > self.budget_bytes:
+            return
+        with self._lock:
+            if self._rows[idx, _SIZE] != 0:
+                return
+            self._evict(self.budget_bytes - size)
+            shm = _open(f'{self._prefix}_{idx}', create=True, size=size)
+            try:
+                np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[...] = img
+            finally:
+                shm.close()
+            self._header[_CLOCK] += 1
+            self._header[_USED_BYTES] += size
+            self._header[_ENTRIES] += 1
+            row = self._rows[idx]
+            row[_SIZE] = size
+            row[_LAST_USED] = self._header[_CLOCK]
+            row[_HEIGHT:_CHANNELS + 1] = img.shape
+            self._scales[idx, _SCALE_X:_SCALE_Y + 1] = scale
+
+    def _evict(self, max_bytes):
+        """Drops least recently used images until at most max_bytes are cached."""
+        if self._header[_USED_BYTES] <= max_bytes:
+            return
+        cached = np.flatnonzero(self._rows[:, _SIZE])
+        order = cached[np.argsort(self._rows[cached, _LAST_USED])]
+        for idx in order.tolist():
+            if self._header[_USED_BYTES] <= max_bytes:
+                break
+            _unlink(f'{self._prefix}_{idx}')
+            self._header[_USED_BYTES] -= self._rows[idx, _SIZE]
+            self._header[_ENTRIES] -= 1
+            self._header[_EVICTIONS] += 1
+            self._rows[idx] = 0
+
+    def stats(self):
+        """Hit/miss counts and usage, summed over every process using the cache.
+
+        Output:
+            - stats (dict): hits, misses, hit_rate, evictions, entries, bytes and
+              budget_bytes
+        """
+        with self._lock:
+            hits, misses = int(self._header[_HITS]), int(self._header[_MISSES])
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'evictions': int(self._header[_EVICTIONS]),
+                'entries': int(self._header[_ENTRIES]),
+                'bytes': int(self._header[_USED_BYTES]),
+                'budget_bytes': self.budget_bytes,
+            }
+
+    def reset_stats(self):
+        """Zeroes the hit, miss and eviction counters."""
+        with self._lock:
+            self._header[[_HITS, _MISSES, _EVICTIONS]] = 0
+
+    def close(self):
+        """Frees the shared memory. Only has an effect in the owning process."""
+        if self._finalizer is not None:
+            # Views into the table must be dropped before the segment is closed
+            self._table = self._header = self._rows = self._scales = None
+            self._finalizer()
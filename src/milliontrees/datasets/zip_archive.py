@@ -0,0 +1,194 @@
+"""Random access to the members of a dataset archive without extracting it.
+
+Extracting ``archive.zip`` doubles disk use and takes hours for the largest datasets.
+A ZipArchive parses the central directory once and keeps the offset, sizes and
+compression method of every member in a memory-mapped index next to the archive
+(``archive.index/``). Reading a member is then a single positioned read of its local
+header and data, plus inflating it if it is deflated. Images are already compressed, so
+this costs little more than reading the extracted file.
+
+File handles are opened lazily and reused. They are not pickled, so every DataLoader
+worker opens its own handle on first use. Reads use os.pread where available, so
+threads can share a handle.
+"""
+import io
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+
+from milliontrees.datasets.annotation_index import load_arrays, load_or_build_arrays
+
+# Bump when the on-disk layout changes.
+ZIP_INDEX_FORMAT_VERSION = 1
+
+_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+class ZipArchive:
+    """Read-only, random access view of a zip archive.
+
+    Args:
+        zip_file (str): Path of the archive.
+        index_dir (str): Where to cache the central directory index. Defaults to the
+            archive path with an '.index' suffix. If it cannot be written, the index is
+            kept in memory.
+    """
+
+    _array_names = [
+        'names', 'header_offsets', 'compress_sizes', 'file_sizes',
+        'compress_types', 'crcs'
+    ]
+
+    def __init__(self, zip_file, index_dir=None):
+        self.zip_file = str(zip_file)
+        if index_dir is None:
+            index_dir = os.path.splitext(self.zip_file)[0] + '.index'
+        self.index_dir = str(index_dir)
+        st = os.stat(self.zip_file)
+        self.stamp = {
+            'format_version': ZIP_INDEX_FORMAT_VERSION,
+            'zip_size': st.st_size,
+            'zip_mtime_ns': st.st_mtime_ns,
+        }
+        arrays = load_or_build_arrays(self.index_dir, self._array_names,
+                                      self.stamp, self._read_central_directory)
+        for name in self._array_names:
+            setattr(self, name, arrays[name])
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # Each process opens its own handle, and reopens the index memory maps
+        for name in self._array_names + ['_fd', '_pid', '_lock']:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        try:
+            arrays = load_arrays(self.index_dir, self._array_names)
+        except FileNotFoundError:
+            arrays = self._read_central_directory()
+        for name in self._array_names:
+            setattr(self, name, arrays[name])
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def _read_central_directory(self):
+        with zipfile.ZipFile(self.zip_file) as z:
+            infos = [info for info in z.infolist() if not info.is_dir()]
+        infos.sort(key=lambda info: info.filename)
+        return {
+            'names':
+                np.array([info.filename for info in infos], dtype=str),
+            'header_offsets':
+                np.array([info.header_offset for info in infos],
+                         dtype=np.int64),
+            'compress_sizes':
+                np.array([info.compress_size for info in infos],
+                         dtype=np.int64),
+            'file_sizes':
+                np.array([info.file_size for info in infos], dtype=np.int64),
+            'compress_types':
+                np.array([
+                    info.compress_type if not info.flag_bits & 0x1 else -1
+                    for info in infos
+                ],
+                         dtype=np.int64),
+            'crcs':
+                np.array([info.CRC for info in infos], dtype=np.int64),
+        }
+
+    def _find(self, name):
+        i = np.searchsorted(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            return None
+        return int(i)
+
+    def _index_of(self, name):
+        i = self._find(name)
+        if i is None:
+            raise KeyError(f'{name} is not in {self.zip_file}')
+        return i
+
+    def info(self, name):
+        """
+        Args:
+            - name (str): Member name, e.g. 'images/a.jpg'
+        Output:
+            - info (dict): file_size, compress_size and crc of the member
+        """
+        i = self._index_of(name)
+        return {
+            'file_size': int(self.file_sizes[i]),
+            'compress_size': int(self.compress_sizes[i]),
+            'crc': int(self.crcs[i]),
+        }
+
+    def _pread(self, size, offset):
+        if self._fd is None or self._pid != os.getpid():
+            # Handles are not shared with forked DataLoader workers
+            self._fd = os.open(self.zip_file,
+                               os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self._pid = os.getpid()
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, size, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, size)
+
+    def read(self, name):
+        """Reads and decompresses a member.
+
+        Args:
+            - name (str): Member name, e.g. 'images/a.jpg'
+        Output:
+            - data (bytes): Contents of the member
+        """
+        i = self._index_of(name)
+        compress_type = int(self.compress_types[i])
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # Encrypted members and other compression methods go through zipfile
+            with zipfile.ZipFile(self.zip_file) as z:
+                return z.read(name)
+        offset = int(self.header_offsets[i])
+        header = self._pread(_LOCAL_HEADER.size, offset)
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f'Bad local file header for {name}')
+        name_length, extra_length = fields[-2:]
+        data = self._pread(
+            int(self.compress_sizes[i]),
+            offset + _LOCAL_HEADER.size + name_length + extra_length)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(data) != self.file_sizes[i]:
+            raise zipfile.BadZipFile(f'Truncated member {name}')
+        return data
+
+    def open(self, name):
+        """A file object over the contents of a member, e.g. for pandas.read_csv."""
+        return io.BytesIO(self.read(name))
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    def __del__(self):
+        if getattr(self, '_fd', None) is not None:
+            self.close()
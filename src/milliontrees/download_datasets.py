@@ -1,6 +1,127 @@
 import os, sys
 import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.model_zoo import tqdm
+
 import milliontrees
+from milliontrees.datasets.download_utils import TransferLimits, transfer_settings
+
+
+class ProgressDisplay:
+    """A single progress bar for concurrent downloads, with the state of each dataset.
+
+    Args:
+        totals (dict): Dataset name to expected number of bytes, or None if unknown.
+    """
+
+    def __init__(self, totals):
+        self._totals = dict(totals)
+        self._done = {name: 0 for name in totals}
+        self._states = {name: 'queued' for name in totals}
+        self._lock = threading.Lock()
+        known = [total for total in totals.values() if total]
+        self._bar = tqdm(total=sum(known) if known else None,
+                         unit='B',
+                         unit_scale=True)
+
+    def progress(self, name):
+        """The progress callback of a dataset's downloads."""
+
+        def update(n_bytes):
+            with self._lock:
+                self._done[name] += n_bytes
+                self._bar.update(n_bytes)
+                self._refresh()
+
+        return update
+
+    def set_state(self, name, state):
+        with self._lock:
+            self._states[name] = state
+            if state != 'downloading' and self._totals[name]:
+                # Datasets already installed, or smaller than announced, shrink the total
+                self._bar.total -= max(0, self._totals[name] - self._done[name])
+                self._totals[name] = self._done[name]
+            self._refresh()
+
+    def _refresh(self):
+        states = []
+        for name, state in self._states.items():
+            if state == 'downloading' and self._totals[name]:
+                state = f'{100 * self._done[name] / self._totals[name]:.0f}%'
+            states.append(f'{name}: {state}')
+        self._bar.set_postfix_str(', '.join(states))
+
+    def close(self):
+        self._bar.close()
+
+
+def _compressed_size(dataset):
+    """Size of the archive of the latest version of a dataset, if known."""
+    module = importlib.import_module(f'milliontrees.datasets.{dataset}')
+    versions = getattr(module, f'{dataset}Dataset')._versions_dict
+    latest = max(versions, key=lambda v: tuple(map(int, v.split('.'))))
+    return versions[latest].get('compressed_size')
+
+
+def download_datasets(datasets,
+                      root_dir,
+                      unlabeled=False,
+                      jobs=1,
+                      max_bytes_per_second=None,
+                      disk_jobs=None):
+    """Downloads several datasets concurrently.
+
+    Up to jobs datasets are downloaded at once, so the extraction of one overlaps with
+    the downloads of the others. All of them share one bandwidth budget and disk_jobs
+    extraction slots, and report to a single progress display.
+
+    Args:
+        - datasets (list of str): Dataset names
+        - root_dir (str): Directory the datasets are downloaded to
+        - unlabeled (bool): Download the unlabeled datasets instead
+        - jobs (int): Number of datasets downloaded at the same time
+        - max_bytes_per_second (float): Combined download rate, or None for no limit
+        - disk_jobs (int): Number of concurrent extractions, or None for no limit
+    """
+    limits = TransferLimits(max_bytes_per_second, disk_jobs)
+    display = ProgressDisplay(
+        {dataset: _compressed_size(dataset) for dataset in datasets})
+
+    def download(dataset):
+        display.set_state(dataset, 'downloading')
+        try:
+            with transfer_settings(limits=limits,
+                                   progress=display.progress(dataset)):
+                milliontrees.get_dataset(dataset=dataset,
+                                         root_dir=root_dir,
+                                         unlabeled=unlabeled,
+                                         download=True)
+        except Exception:
+            display.set_state(dataset, 'failed')
+            raise
+        display.set_state(dataset, 'done')
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                dataset: executor.submit(download, dataset)
+                for dataset in datasets
+            }
+    finally:
+        display.close()
+    # Every dataset is attempted before reporting failures
+    failed = {
+        dataset: future.exception()
+        for dataset, future in futures.items()
+        if future.exception() is not None
+    }
+    if failed:
+        raise RuntimeError(f'Failed to download {list(failed)}: ' + '; '.join(
+            f'{dataset}: {error}' for dataset, error in failed.items()))
 
 
 def main():
@@ -26,6 +147,24 @@ def main():
         help=
         f'If this flag is set, the unlabeled dataset will be downloaded instead of the labeled.'
     )
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help='Number of datasets downloaded at the same time.')
+    parser.add_argument(
+        '--max_bandwidth',
+        default=None,
+        type=float,
+        help=
+        'Combined download rate of all datasets, in MB/s. Unlimited by default.'
+    )
+    parser.add_argument(
+        '--disk_jobs',
+        default=None,
+        type=int,
+        help=
+        'Number of archives or files extracted at the same time across all datasets. Unlimited by default.'
+    )
     config = parser.parse_args()
 
     if config.datasets is None:
@@ -38,12 +177,13 @@ def main():
             )
 
     print(f'Downloading the following datasets: {config.datasets}')
-    for dataset in config.datasets:
-        print(f'=== {dataset} ===')
-        milliontrees.get_dataset(dataset=dataset,
-                                 root_dir=config.root_dir,
-                                 unlabeled=config.unlabeled,
-                                 download=True)
+    download_datasets(config.datasets,
+                      config.root_dir,
+                      unlabeled=config.unlabeled,
+                      jobs=config.jobs,
+                      max_bytes_per_second=None if config.max_bandwidth is None
+                      else config.max_bandwidth * 1e6,
+                      disk_jobs=config.disk_jobs)
 
 
 if __name__ == '__main__':
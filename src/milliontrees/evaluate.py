@@ -0,0 +1,287 @@
+"""Offline evaluation of prediction files.
+
+Evaluating a model by collecting every prediction and target of the test set in Python
+lists, then calling dataset.eval, holds the whole split in memory in one process. This
+module instead reads predictions from a columnar file in chunks, joins them to the
+ground-truth annotations by filename_id (see join_predictions, which
+MillionTreesDataset.eval_predictions uses as well), and computes the element-wise metrics of the
+dataset a batch of images at a time. Only one value per image and metric is kept; the
+per-source aggregation is then done by dataset.eval, so the results are the same as
+those of evaluating in memory.
+
+Prediction files have one row per predicted geometry, with
+    - filename_id (int), the image id of the metadata, or filename (str)
+    - the geometry, in the columns of the split file: xmin, ymin, xmax, ymax for boxes;
+      x, y for points; polygon, as WKT, for polygons. Coordinates are those of the images
+      resized to image_size, as in the outputs of a model run on the eval loader.
+    - score (float)
+The rows of an image must be contiguous, as when predictions are written image by image.
+Images of the split without any row are evaluated as having no predictions.
+
+A DetectionSweep, from dataset.sweep(), can be updated in the same pass, to also get the
+metrics over a grid of score and IoU thresholds and the average precision of each source.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+
+import numpy as np
+import pandas as pd
+import torch
+
+import milliontrees
+from milliontrees.common.metrics.metric import ElementValues
+
+
+def read_predictions(pred_file, chunk_size=100000):
+    """Yields the rows of a prediction file in chunks.
+
+    Args:
+        - pred_file (str): Parquet (.parquet), Arrow IPC (.arrow, .feather, .ipc) or csv file
+        - chunk_size (int): Maximum number of rows per chunk. Arrow IPC files are read one
+          record batch at a time instead.
+    Output:
+        - chunks (iterator of pd.DataFrame): The rows of the file
+    """
+    pred_file = str(pred_file)
+    extension = pred_file.rsplit('.', 1)[-1].lower()
+    if extension == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(pred_file).iter_batches(
+                batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif extension in ('arrow', 'feather', 'ipc'):
+        import pyarrow as pa
+        with pa.memory_map(pred_file) as source:
+            try:
+                reader = pa.ipc.open_file(source)
+                batches = (reader.get_batch(i)
+                           for i in range(reader.num_record_batches))
+            except pa.ArrowInvalid:
+                source.seek(0)
+                batches = pa.ipc.open_stream(source)
+            for batch in batches:
+                yield batch.to_pandas()
+    elif extension == 'csv':
+        yield from pd.read_csv(pred_file, chunksize=chunk_size)
+    else:
+        raise ValueError(
+            f'{pred_file} is not a parquet, arrow or csv prediction file.')
+
+
+def _eval_metrics(dataset):
+    """The distinct metrics computed by dataset.eval."""
+    metrics = getattr(dataset, 'metrics', None)
+    metrics = list(metrics.values()) if metrics else [dataset._metric]
+    return list({id(metric): metric for metric in metrics}.values())
+
+
+def _image_runs(chunks, filename_ids):
+    """Groups the rows of a prediction file by image.
+
+    Args:
+        - chunks (iterator of pd.DataFrame): Rows of the prediction file
+        - filename_ids (pd.Series): Ids of the images of the split, by their filenames
+    Output:
+        - runs (iterator): (filename_id, rows) for each image, in file order
+    """
+    pending_id, pending = None, []
+    for chunk in chunks:
+        if 'filename_id' not in chunk.columns:
+            if 'filename' not in chunk.columns:
+                raise ValueError(
+                    "Prediction files need a 'filename_id' or 'filename' column."
+                )
+            chunk = chunk.assign(filename_id=filename_ids.reindex(
+                chunk['filename'].to_numpy()).to_numpy())
+            unknown = chunk['filename_id'].isna()
+            if unknown.any():
+                raise ValueError(
+                    f"{chunk.loc[unknown, 'filename'].iloc[0]} is not an image of the evaluated split."
+                )
+        ids = chunk['filename_id'].to_numpy().astype(np.int64)
+        # Boundaries of the runs of rows of the same image
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        ends = np.r_[starts[1:], len(ids)]
+        for start, end in zip(starts, ends):
+            if ids[start] != pending_id:
+                if pending:
+                    yield pending_id, pd.concat(pending)
+                pending_id, pending = ids[start], []
+            pending.append(chunk.iloc[start:end])
+    if pending:
+        yield pending_id, pd.concat(pending)
+
+
+def join_predictions(dataset, pred_file, split='test', chunk_size=100000):
+    """Joins the rows of a prediction file to the images of a split.
+
+    Args:
+        - dataset (MillionTreesDataset): Dataset the predictions were made on
+        - pred_file (str): Prediction file, see the module documentation
+        - split (str): Split the predictions were made on
+        - chunk_size (int): Number of rows read from the prediction file at a time
+    Output:
+        - no_predictions (pd.DataFrame): No rows, with the columns of the file; the rows
+          of the images without predictions
+        - runs (iterator): (position, rows) for each image with predictions, in file
+          order, position being the index of the image in get_subset(split)
+    """
+    metadata = dataset.get_subset(split).metadata_array
+    # Position in the split of each image, by filename_id
+    position = pd.Series(np.arange(len(metadata)), index=metadata[:, 0].numpy())
+    filename_ids = pd.Series(
+        metadata[:, 0].numpy(),
+        index=[dataset._filename_id_to_code[int(i)] for i in metadata[:, 0]])
+
+    chunks = read_predictions(pred_file, chunk_size)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError(f'{pred_file} has no columns.')
+    if 'score' not in first.columns:
+        raise ValueError(f"{pred_file} must have a 'score' column.")
+
+    def runs():
+        seen = np.zeros(len(metadata), dtype=bool)
+        for filename_id, rows in _image_runs(itertools.chain([first], chunks),
+                                             filename_ids):
+            if filename_id not in position.index:
+                raise ValueError(
+                    f'Image {filename_id} of {pred_file} is not an image of the {split} split.'
+                )
+            i = position[filename_id]
+            if seen[i]:
+                raise ValueError(
+                    f'The rows of image {filename_id} are not contiguous in {pred_file}; '
+                    f'sort the file by filename_id.')
+            seen[i] = True
+            yield i, rows
+
+    return first.iloc[:0], runs()
+
+
+def evaluate(dataset,
+             pred_file,
+             split='test',
+             chunk_size=100000,
+             batch_size=64,
+             sweep=None):
+    """Evaluates a prediction file on a split of a dataset, with bounded memory.
+
+    Args:
+        - dataset (MillionTreesDataset): Dataset the predictions were made on
+        - pred_file (str): Prediction file, see the module documentation
+        - split (str): Split the predictions were made on
+        - chunk_size (int): Number of rows read from the prediction file at a time
+        - batch_size (int): Number of images whose metrics are computed at a time
+        - sweep (DetectionSweep): Updated with every image of the split, if given
+    Output:
+        - results (dict), results_str (str): As returned by dataset.eval
+    """
+    subset = dataset.get_subset(split)
+    indices = np.asarray(subset.indices)
+    metadata = subset.metadata_array
+
+    metrics = _eval_metrics(dataset)
+    values = {metric: torch.zeros(len(indices)) for metric in metrics}
+    seen = np.zeros(len(indices), dtype=bool)
+
+    matches = getattr(dataset, '_matches', None)
+
+    def evaluate_batch(positions, y_pred):
+        y_true, _ = dataset._eval_targets(indices[positions])
+        # The metrics share the matching of each image of the batch
+        with (contextlib.nullcontext() if matches is None else matches.reuse()):
+            for metric in metrics:
+                values[metric][positions] = metric._compute_element_wise(
+                    y_pred, y_true).float()
+        if sweep is not None:
+            sweep.update(y_pred, y_true, metadata[torch.as_tensor(positions)])
+
+    no_predictions, runs = join_predictions(dataset, pred_file, split,
+                                            chunk_size)
+    positions, y_pred = [], []
+    for i, rows in runs:
+        seen[i] = True
+        positions.append(i)
+        y_pred.append(dataset._prediction_from_rows(rows))
+        if len(positions) == batch_size:
+            evaluate_batch(positions, y_pred)
+            positions, y_pred = [], []
+    if positions:
+        evaluate_batch(positions, y_pred)
+
+    # Images without predictions
+    missing = np.flatnonzero(~seen)
+    for start in range(0, len(missing), batch_size):
+        positions = missing[start:start + batch_size]
+        evaluate_batch(
+            positions,
+            [dataset._prediction_from_rows(no_predictions) for _ in positions])
+
+    element_values = ElementValues(values)
+    return dataset.eval(element_values, element_values, metadata)
+
+
+def main():
+    """Evaluates a prediction file on a MillionTrees dataset and prints the results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--dataset',
+        required=True,
+        help=
+        f'Dataset name. Available choices are {milliontrees.supported_datasets}.'
+    )
+    parser.add_argument('--root_dir',
+                        required=True,
+                        help='The directory where [dataset]/data can be found.')
+    parser.add_argument(
+        '--predictions',
+        required=True,
+        help='Parquet, arrow or csv file of predictions, one row per geometry.')
+    parser.add_argument('--split', default='test', help='Split to evaluate.')
+    parser.add_argument('--split_scheme',
+                        default='official',
+                        help='Split scheme of the dataset.')
+    parser.add_argument('--version', default=None, help='Dataset version.')
+    parser.add_argument('--chunk_size',
+                        default=100000,
+                        type=int,
+                        help='Number of prediction rows read at a time.')
+    parser.add_argument(
+        '--sweep',
+        action='store_true',
+        help=
+        'Also computes the metrics over a grid of score and IoU thresholds, and the '
+        'average precision of each source.')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Writes the results dictionary to this json file.')
+    config = parser.parse_args()
+
+    dataset = milliontrees.get_dataset(config.dataset,
+                                       version=config.version,
+                                       root_dir=config.root_dir,
+                                       split_scheme=config.split_scheme)
+    sweep = dataset.sweep() if config.sweep else None
+    results, results_str = evaluate(dataset,
+                                    config.predictions,
+                                    split=config.split,
+                                    chunk_size=config.chunk_size,
+                                    sweep=sweep)
+    if sweep is not None:
+        results['sweep'], sweep_str = sweep.compute()
+        results_str += sweep_str
+    print(results_str)
+    if config.output is not None:
+        with open(config.output, 'w') as f:
+            json.dump(results,
+                      f,
+                      indent=1,
+                      default=lambda value: value.tolist()
+                      if torch.is_tensor(value) else float(value))
+
+
+if __name__ == '__main__':
+    main()
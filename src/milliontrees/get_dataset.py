@@ -1,11 +1,13 @@
 """Module for retrieving MillionTrees dataset instances."""
-from typing import Optional
+from typing import List, Optional
 import milliontrees
 
 
 def get_dataset(dataset: str,
                 version: Optional[str] = None,
                 unlabeled: bool = False,
+                sources: Optional[List[str]] = None,
+                splits: Optional[List[str]] = None,
                 **dataset_kwargs):
     """Brief description of the function.
 
@@ -13,6 +15,8 @@ def get_dataset(dataset: str,
         dataset: Description of dataset.
         version: Description of version.
         unlabeled: Description of unlabeled.
+        sources: Names of the sources to load. Only their images are downloaded.
+        splits: Names of the splits to load, e.g. ['test']. Only their images are downloaded.
     """
     if version is not None:
         version = str(version)
@@ -50,5 +54,9 @@ def get_dataset(dataset: str,
         module_name, class_name = module_path.rsplit('.', 1)
         module = __import__(module_name, fromlist=[class_name])
         dataset_class = getattr(module, class_name)
+        if sources is not None:
+            dataset_kwargs['sources'] = sources
+        if splits is not None:
+            dataset_kwargs['splits'] = splits
         return dataset_class(version=version, **dataset_kwargs)
     raise ValueError(f'Dataset {dataset} is not supported.')
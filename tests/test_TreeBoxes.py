@@ -1,10 +1,13 @@
 from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
 from milliontrees.common.data_loaders import get_train_loader, get_eval_loader
+from milliontrees.datasets.annotation_index import AnnotationIndex, load_arrays
 
 import torch
 import pytest
 import os
+import shutil
 import numpy as np
+import pandas as pd
 
 # Check if running on hipergator
 if os.path.exists("/orange"):
@@ -147,4 +150,272 @@ def test_TreeBoxes_download(tmpdir):
         assert image.min() >= 0.0 and image.max() <= 1.0
         assert boxes.shape[1] == 4
         assert metadata.shape[0] == 2
-        break
\ No newline at end of file
+        break
+
+
+def test_TreeBoxes_annotation_index(dataset, tmpdir):
+    root_dir = os.path.join(tmpdir, "data")
+    shutil.copytree(dataset, root_dir)
+    ds = TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0")
+    index_dir = os.path.join(root_dir, "TreeBoxes_v0.0", "official.index")
+    assert os.path.exists(os.path.join(index_dir, "y.npy"))
+    assert isinstance(ds._y_array, np.memmap)
+    assert ds._y_array.shape == (6, 4)
+
+    # Changing the csv invalidates the compiled index
+    csv_file = os.path.join(root_dir, "TreeBoxes_v0.0", "official.csv")
+    df = pd.read_csv(csv_file)
+    df = df[df.filename != "image4.jpg"]
+    df.to_csv(csv_file)
+    ds = TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0")
+    assert ds._y_array.shape == (5, 4)
+    assert len(ds._input_array) == 3
+
+    # A current index is never rewritten
+    index_json = os.path.join(index_dir, "index.json")
+    mtime = os.stat(index_json).st_mtime_ns
+    TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0")
+    assert os.stat(index_json).st_mtime_ns == mtime
+
+    # An index with a missing array is an error, and is rebuilt
+    os.remove(os.path.join(index_dir, "y.npy"))
+    with pytest.raises(FileNotFoundError):
+        load_arrays(index_dir, AnnotationIndex._array_names)
+    ds = TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0")
+    assert ds._y_array.shape == (5, 4)
+
+
+def test_TreeBoxes_uint8_images(dataset):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", image_dtype="uint8")
+    metadata, image, targets = ds[0]
+    assert image.dtype == np.uint8
+    assert image.shape == (100, 100, 3)
+
+    train_dataset = ds.get_subset("train")
+    metadata, image, targets = train_dataset[0]
+    assert image.dtype == torch.uint8
+
+    # Normalization happens once per batch in the collate function
+    train_loader = get_train_loader('standard', train_dataset, batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert x.dtype == torch.float32
+    assert x.shape == (2, 3, 448, 448)
+    assert x.min() >= 0.0 and x.max() <= 1.0
+
+    with pytest.raises(ValueError):
+        TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", image_dtype="float16")
+
+@pytest.mark.parametrize("decode_backend", ["pil", "torchvision", "opencv"])
+def test_TreeBoxes_decode_backend(dataset, decode_backend):
+    if decode_backend == "opencv":
+        pytest.importorskip("cv2")
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", decode_backend=decode_backend)
+    metadata, image, targets = ds[0]
+    assert image.shape == (100, 100, 3)
+    assert image.dtype == np.float32
+    assert targets["y"].tolist() == [[10, 15, 50, 55], [15, 20, 55, 60]]
+
+    # JPEGs are decoded at half resolution, the smallest size >= image_size
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", decode_backend=decode_backend,
+                          reduced_decode=True, image_size=40)
+    metadata, image, targets = ds[0]
+    if decode_backend == "torchvision":
+        assert image.shape == (100, 100, 3)
+    else:
+        assert image.shape == (50, 50, 3)
+        assert targets["y"].tolist() == [[5, 7.5, 25, 27.5], [7.5, 10, 27.5, 30]]
+
+    metadata, image, targets = ds.get_subset("train")[0]
+    assert image.shape == (3, 40, 40)
+
+def test_TreeBoxes_image_cache(dataset, tmpdir):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    cache_dir = ds.materialize_cache(image_size=200, dir=os.path.join(tmpdir, "cache"))
+
+    cached = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", image_cache=cache_dir)
+    decoded = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    assert cached.image_cache.images.shape == (len(cached), 200, 200, 3)
+    for idx in range(len(cached)):
+        _, image, targets = cached[idx]
+        _, expected_image, expected = decoded[idx]
+        assert image.shape == (200, 200, 3)
+        assert image.dtype == np.float32
+        # Test images are 100 x 100, so targets double
+        torch.testing.assert_close(targets["y"], expected["y"] * 2)
+
+    train_loader = get_train_loader('standard', cached.get_subset("train"), batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert x.shape == (2, 3, 448, 448)
+
+    with pytest.raises(FileNotFoundError):
+        TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", image_cache=os.path.join(tmpdir, "missing"))
+
+def test_TreeBoxes_shared_cache(dataset):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", shared_cache_bytes=10**6)
+    expected = [ds.get_input(idx) for idx in range(len(ds))]
+    np.testing.assert_array_equal(ds.get_input(0), expected[0])
+    stats = ds.shared_cache.stats()
+    assert stats["misses"] == len(ds)
+    assert stats["hits"] == 1
+    assert stats["entries"] == len(ds)
+
+    # Workers share the cache of the main process
+    ds.shared_cache.reset_stats()
+    train_loader = get_train_loader('standard', ds.get_subset("train"), batch_size=2, num_workers=2)
+    for _ in range(2):
+        for metadata, x, targets in train_loader:
+            assert x.shape == (2, 3, 448, 448)
+    stats = ds.shared_cache.stats()
+    assert stats["misses"] == 0
+    assert stats["hits"] == 2 * len(ds.get_subset("train"))
+
+    # Least recently used images are evicted to stay within the budget
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", shared_cache_bytes=100 * 100 * 3)
+    for idx in range(len(ds)):
+        ds.get_input(idx)
+    stats = ds.shared_cache.stats()
+    assert stats["entries"] == 1
+    assert stats["evictions"] == len(ds) - 1
+    assert ds.shared_cache.get(len(ds) - 1) is not None
+    ds.shared_cache.close()
+
+def test_TreeBoxes_shards(dataset, tmpdir):
+    from milliontrees.datasets.shards import export_shards, ShardedDataset
+
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    # Tiny shards hold one image each
+    manifest = export_shards(ds, os.path.join(tmpdir, "shards"), split="test", shard_bytes=1)
+    assert len(manifest["shards"]) == manifest["n_samples"] == 2
+
+    test_dataset = ds.get_subset("test")
+    streamed = ShardedDataset(ds, os.path.join(tmpdir, "shards"))
+    assert len(streamed) == len(test_dataset)
+    for (metadata, image, targets), idx in zip(streamed, range(len(test_dataset))):
+        expected_metadata, expected_image, expected = test_dataset[idx]
+        assert torch.equal(metadata, expected_metadata)
+        assert torch.equal(image, expected_image)
+        assert torch.equal(targets["y"], expected["y"])
+
+    # Each worker reads its own shards, so every sample is seen once
+    loader = get_eval_loader('standard', streamed, batch_size=1, num_workers=2)
+    seen = []
+    all_y_true, all_y_pred, all_metadata = [], [], []
+    for metadata, x, targets in loader:
+        seen.extend(metadata[:, 0].tolist())
+        for image_metadata, image_targets in zip(metadata, targets):
+            all_y_true.append(image_targets)
+            all_y_pred.append({"y": image_targets["y"], "labels": image_targets["labels"], "scores": torch.ones(len(image_targets["y"]))})
+            all_metadata.append(image_metadata)
+    assert sorted(seen) == sorted(test_dataset.metadata_array[:, 0].tolist())
+    results, results_str = streamed.eval(all_y_pred, all_y_true, torch.stack(all_metadata))
+    assert results["accuracy"]["detection_accuracy_avg"] == 1.0
+
+    # Ranks split the shards between them
+    ranks = [ShardedDataset(ds, os.path.join(tmpdir, "shards"), shuffle=True, rank=rank, world_size=2) for rank in range(2)]
+    assert sum(len(list(rank)) for rank in ranks) == len(test_dataset)
+
+def test_TreeBoxes_from_zip(dataset, tmpdir):
+    import zipfile
+
+    # Package the dataset like data_prep/package_datasets.py, without extracting it again
+    data_dir = os.path.join(tmpdir, "TreeBoxes_v0.0")
+    os.makedirs(data_dir)
+    source_dir = os.path.join(dataset, "TreeBoxes_v0.0")
+    with zipfile.ZipFile(os.path.join(data_dir, "archive.zip"), "w", zipfile.ZIP_DEFLATED) as z:
+        for root, _, files in os.walk(source_dir):
+            for file in files:
+                if file.endswith(".csv") or root.endswith("images"):
+                    # Mix stored and deflated members
+                    compress_type = zipfile.ZIP_STORED if file.endswith("3.jpg") else zipfile.ZIP_DEFLATED
+                    file_path = os.path.join(root, file)
+                    z.write(file_path, os.path.relpath(file_path, source_dir), compress_type=compress_type)
+
+    zipped = TreeBoxesDataset(download=False, root_dir=str(tmpdir), version="0.0", from_zip=True)
+    extracted = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    assert not os.path.exists(os.path.join(data_dir, "images"))
+    assert len(zipped) == len(extracted)
+    for idx in range(len(zipped)):
+        _, image, targets = zipped[idx]
+        _, expected_image, expected = extracted[idx]
+        np.testing.assert_array_equal(image, expected_image)
+        assert torch.equal(targets["y"], expected["y"])
+    assert zipped.df.equals(extracted.df)
+
+    # Workers open their own handles on the archive
+    train_loader = get_train_loader('standard', zipped.get_subset("train"), batch_size=2, num_workers=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert x.shape == (2, 3, 448, 448)
+
+    with pytest.raises(FileNotFoundError):
+        TreeBoxesDataset(download=False, root_dir=os.path.join(tmpdir, "missing"), version="0.0", from_zip=True)
+
+def test_TreeBoxes_sources_and_splits(dataset):
+    full = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", splits="test")
+    assert sorted(ds._input_array) == ["image3.jpg", "image4.jpg"]
+    assert ds._y_array.shape == (3, 4)
+    assert len(ds.df) == 3
+    metadata, image, targets = ds[ds.get_image_index("image4.jpg")]
+    assert torch.equal(targets["y"], full[full.get_image_index("image4.jpg")][2]["y"])
+    # Ids match the full dataset
+    assert torch.equal(metadata, full.metadata_array[full.get_image_index("image4.jpg")])
+
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", sources=[0], splits=["train"])
+    assert sorted(ds._input_array) == ["image1.jpg", "image2.jpg"]
+    assert len(ds.get_subset("test")) == 0
+
+    with pytest.raises(ValueError):
+        TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", sources=["missing"])
+    with pytest.raises(ValueError):
+        TreeBoxesDataset(download=False, root_dir=dataset, version="0.0", splits=["validation"])
+
+def test_TreeBoxes_eval_targets(dataset, tmpdir):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    test_dataset = ds.get_subset("test")
+    y_true, metadata = ds.get_eval_targets("test")
+    assert torch.equal(metadata, test_dataset.metadata_array)
+    for i, (_, _, targets) in enumerate(test_dataset):
+        assert torch.allclose(y_true[i]["y"], targets["y"])
+        assert torch.equal(y_true[i]["labels"], targets["labels"])
+
+    # Predict the ground truth of image3.jpg and nothing for image4.jpg
+    rows = [[ "image3.jpg", *box.tolist(), 0.9] for box in y_true[0]["y"]]
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename", "xmin", "ymin", "xmax", "ymax", "score"]).to_csv(pred_file)
+    results, _ = ds.eval_predictions(pred_file)
+    assert results["accuracy"]["detection_accuracy_avg"] == 0.5
+
+    pd.DataFrame([["image1.jpg", 0, 0, 10, 10, 0.9]], columns=["filename", "xmin", "ymin", "xmax", "ymax", "score"]).to_csv(pred_file)
+    with pytest.raises(ValueError):
+        ds.eval_predictions(pred_file)
+
+def test_TreeBoxes_shared_matching(dataset):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    y_true, metadata = ds.get_eval_targets("test")
+    # Predict the first box of each image and a false positive
+    y_pred = [{"y": torch.cat([t["y"][:1], torch.tensor([[0., 0., 5., 5.]])]), "scores": torch.tensor([0.9, 0.9])} for t in y_true]
+
+    calls = []
+    quality_fn = ds._matches.quality_fn
+    ds._matches.quality_fn = lambda *args: calls.append(1) or quality_fn(*args)
+    results, _ = ds.eval(y_pred, y_true, metadata)
+    # One match-quality matrix per image, for all of accuracy, recall and precision
+    assert len(calls) == len(y_true)
+    # image3.jpg has 2 boxes, image4.jpg 1 box
+    assert results["recall"]["detection_recall_avg"] == pytest.approx((1 / 2 + 1) / 2)
+    assert results["precision"]["detection_precision_avg"] == 0.5
+    assert results["accuracy"]["detection_accuracy_avg"] == pytest.approx((1 / 3 + 1 / 2) / 2)
+    # Single images, as in the notebook examples
+    recall = ds.metrics["recall"]._recall(y_true[0]["y"], y_pred[0]["y"], iou_threshold=0.3)
+    assert recall.item() == 0.5
+    accuracy = ds.metrics["accuracy"]._accuracy(y_true[0]["y"], y_pred[0]["y"], iou_threshold=0.3)
+    assert accuracy.item() == pytest.approx(1 / 3)
+
+    # Nothing is kept after eval, and standalone metrics see in-place edits
+    assert ds._matches._last is None
+    metric = ds.metrics["precision"]
+    assert metric.compute(y_pred, y_true, return_dict=False).item() == 0.5
+    for pred in y_pred:
+        pred["y"] = pred["y"][:1]
+        pred["scores"] = pred["scores"][:1]
+    assert metric.compute(y_pred, y_true, return_dict=False).item() == 1.0
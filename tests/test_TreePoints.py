@@ -4,6 +4,7 @@ from milliontrees.common.data_loaders import get_train_loader, get_eval_loader
 import torch
 import pytest
 import os
+import pickle
 import pandas as pd
 import numpy as np
 
@@ -114,4 +115,30 @@ def test_TreePoints_download(tmpdir):
         assert image.min() >= 0.0 and image.max() <= 1.0
         assert points.shape[1] == 2
         assert metadata.shape[0] == 2
-        break
\ No newline at end of file
+        break
+
+
+def test_TreePoints_annotation_offsets(dataset):
+    ds = TreePointsDataset(download=False, root_dir=dataset, version="0.0")
+    assert len(ds) == 4
+    assert ds._offsets.tolist() == [0, 2, 3, 5, 6]
+    points = ds.get_annotation_from_filename("image1.jpg")
+    assert points.tolist() == [[10, 15], [15, 20]]
+    with pytest.raises(KeyError):
+        ds.get_annotation_from_filename("missing.jpg")
+
+    # Workers receive the memory-mapped arrays as file paths, not copies
+    clone = pickle.loads(pickle.dumps(ds))
+    assert isinstance(clone._y_array, np.memmap)
+    np.testing.assert_array_equal(clone._y_array, ds._y_array)
+    points = clone.get_annotation_from_filename("image3.jpg")
+    assert points.tolist() == [[30, 35], [35, 40]]
+
+
+def test_TreePoints_eval_targets(dataset):
+    ds = TreePointsDataset(download=False, root_dir=dataset, version="0.0")
+    test_dataset = ds.get_subset("test")
+    y_true, metadata = test_dataset.get_eval_targets()
+    assert torch.equal(metadata, test_dataset.metadata_array)
+    for i, (_, _, targets) in enumerate(test_dataset):
+        assert torch.allclose(y_true[i]["y"], targets["y"])
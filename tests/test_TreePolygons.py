@@ -7,6 +7,10 @@ import os
 import pandas as pd
 import numpy as np
 from shapely import from_wkt
+from shapely.affinity import scale
+from torchvision.ops import masks_to_boxes
+from milliontrees.common.mask_utils import RLEMasks
+from milliontrees.common.metrics.all_metrics import mask_iou
 
 # Check if running on hipergator
 if os.path.exists("/orange"):
@@ -135,4 +139,162 @@ def test_TreePolygons_download(tmpdir):
         assert image.min() >= 0.0 and image.max() <= 1.0
         assert masks[0].shape == (448, 448)
         assert metadata.shape[0] == 2
-        break
\ No newline at end of file
+        break
+def test_TreePolygons_lazy_geometries(dataset):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", geometry_cache_size=2)
+    polygons = ds._y_array
+    assert len(polygons) == 3
+    # Nothing is decoded until an image is requested
+    assert len(polygons._cache) == 0
+
+    metadata, image, targets = ds[0]
+    assert polygons[0].equals(from_wkt("POLYGON((10 15, 50 15, 50 55, 10 55, 10 15))"))
+    assert len(polygons._cache) == 1
+
+    # Bulk access decodes in one call and the cache stays bounded
+    geometries = polygons.take([0, 1, 2])
+    assert [g.bounds for g in geometries] == [(10, 15, 50, 55), (20, 25, 60, 65), (30, 35, 70, 75)]
+    assert len(polygons._cache) == 2
+    assert list(polygons._cache) == [1, 2]
+
+def test_TreePolygons_mask_store(dataset, tmpdir):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0")
+    store_dir = ds.build_mask_store(os.path.join(tmpdir, "masks"))
+
+    stored = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", mask_store=store_dir)
+    rasterized = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0")
+    for idx in range(len(stored)):
+        _, image, targets = stored[idx]
+        _, expected_image, expected = rasterized[idx]
+        np.testing.assert_array_equal(targets["y"], expected["y"])
+        assert targets["y"].dtype == expected["y"].dtype
+        assert torch.equal(targets["bboxes"], expected["bboxes"])
+
+    # Subsets and loaders work unchanged on top of the store
+    train_loader = get_train_loader('standard', stored.get_subset("train"), batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert targets["y"].shape == (2, 1, 448, 448)
+
+    with pytest.raises(FileNotFoundError):
+        TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", mask_store=os.path.join(tmpdir, "missing"))
+
+def test_TreePolygons_uint8_images(dataset):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", image_dtype="uint8")
+    train_loader = get_train_loader('standard', ds.get_subset("train"), batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert x.dtype == torch.float32
+    assert x.min() >= 0.0 and x.max() <= 1.0
+    assert targets["y"].shape == (2, 1, 448, 448)
+
+def test_TreePolygons_reduced_decode(dataset):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", reduced_decode=True, image_size=40)
+    metadata, image, targets = ds[0]
+    assert image.shape == (50, 50, 3)
+    assert targets["y"].shape == (1, 50, 50)
+    assert targets["bboxes"].tolist() == [[5, 7, 25, 27]]
+
+def test_TreePolygons_image_cache(dataset, tmpdir):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", image_dtype="uint8")
+    cache_dir = ds.materialize_cache(image_size=448, dir=os.path.join(tmpdir, "cache"))
+
+    cached = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", image_dtype="uint8", image_cache=cache_dir)
+    for idx in range(len(cached)):
+        _, image, targets = cached[idx]
+        assert image.dtype == np.uint8
+        assert image.shape == (448, 448, 3)
+        assert targets["y"].shape[1:] == (448, 448)
+        assert len(targets["y"]) == len(targets["bboxes"])
+
+    train_loader = get_train_loader('standard', cached.get_subset("train"), batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert x.dtype == torch.float32
+    assert targets["y"].shape == (2, 1, 448, 448)
+
+def test_TreePolygons_shards(dataset, tmpdir):
+    from milliontrees.datasets.shards import export_shards, ShardedDataset
+
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0")
+    export_shards(ds, os.path.join(tmpdir, "shards"), split="train")
+    streamed = ShardedDataset(ds, os.path.join(tmpdir, "shards"))
+    train_dataset = ds.get_subset("train")
+    items = list(streamed)
+    assert len(items) == len(train_dataset)
+    for idx, (metadata, image, targets) in enumerate(items):
+        _, expected_image, expected = train_dataset[idx]
+        assert torch.equal(image, expected_image)
+        assert torch.equal(targets["y"], expected["y"])
+        assert torch.equal(torch.as_tensor(targets["bboxes"]), torch.as_tensor(expected["bboxes"]))
+
+    train_loader = get_train_loader('standard', streamed, batch_size=2)
+    metadata, x, targets = next(iter(train_loader))
+    assert targets["y"].shape == (2, 1, 448, 448)
+
+def test_TreePolygons_eval_targets(dataset, tmpdir):
+    ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0")
+    test_dataset = ds.get_subset("test")
+    y_true, metadata = ds.get_eval_targets("test")
+    assert torch.equal(metadata, test_dataset.metadata_array)
+    assert len(y_true) == len(test_dataset)
+    assert y_true[0]["y"].shape[1:] == (448, 448)
+
+    filename = ds._filename_id_to_code[int(metadata[0][0])]
+    polygons = ds.df[ds.df.filename == filename].polygon
+    # Predictions are in the coordinates of the 448px eval images
+    rows = [[filename, scale(from_wkt(polygon), 4.48, 4.48, origin=(0, 0)).wkt, 0.9] for polygon in polygons]
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename", "polygon", "score"]).to_csv(pred_file)
+    results, _ = ds.eval_predictions(pred_file)
+    assert results["accuracy"]["mask_acc_avg"] == 1.0
+
+def test_rle_mask_iou():
+    rng = np.random.default_rng(0)
+    masks = np.zeros((50, 37, 53), dtype=np.uint8)
+    for mask in masks:
+        y, x = rng.integers(0, 37), rng.integers(0, 53)
+        mask[y:y + rng.integers(1, 20), x:x + rng.integers(1, 20)] = 1
+        mask |= (rng.random(mask.shape) < 0.02).astype(np.uint8)
+    src, pred = torch.from_numpy(masks[:30]), torch.from_numpy(masks[30:])
+    pred[3] = 0
+
+    # Dense reference
+    a, b = src.reshape(30, -1).float(), pred.reshape(20, -1).float()
+    intersection = a @ b.T
+    expected = intersection / (a.sum(1)[:, None] + b.sum(1)[None] - intersection)
+    rle = RLEMasks.from_masks(pred)
+    assert torch.equal(mask_iou(src, rle), expected)
+    assert np.array_equal(RLEMasks.from_masks(src).boxes(), masks_to_boxes(src).numpy())
+    assert np.array_equal(rle[torch.arange(20) > 9].decode(), pred[10:].numpy())
+
+def test_TreePolygons_polygon_eval(dataset, tmpdir):
+    masks_ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0")
+    polygons_ds = TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", eval_geometry="polygons")
+    y_true, _ = polygons_ds.get_eval_targets("test")
+    assert y_true[0]["y"].dtype == object
+
+    metadata = masks_ds.get_subset("test").metadata_array
+    filename = masks_ds._filename_id_to_code[int(metadata[0][0])]
+    polygons = masks_ds.df[masks_ds.df.filename == filename].polygon
+    # Matching crowns, grown crowns below the IoU threshold, and a false positive
+    crowns = [scale(from_wkt(polygon), 4.48, 4.48, origin=(0, 0)) for polygon in polygons]
+    rows = [[filename, crown.wkt, 0.9] for crown in crowns]
+    rows += [[filename, crown.buffer(30).wkt, 0.7] for crown in crowns]
+    rows.append([filename, "POLYGON ((400 400, 440 400, 440 440, 400 440, 400 400))", 0.8])
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename", "polygon", "score"]).to_csv(pred_file)
+
+    mask_results, _ = masks_ds.eval_predictions(pred_file)
+    polygon_results, _ = polygons_ds.eval_predictions(pred_file)
+    for metric, name in [("accuracy", "acc"), ("recall", "recall"), ("precision", "precision")]:
+        assert polygon_results[metric][f"polygon_{name}_avg"] == pytest.approx(
+            mask_results[metric][f"mask_{name}_avg"])
+
+    with pytest.raises(ValueError):
+        TreePolygonsDataset(download=False, root_dir=dataset, version="0.0", eval_geometry="rasters")
+
+def test_polygon_iou():
+    from shapely import box
+    from milliontrees.common.metrics.all_metrics import polygon_iou
+    src = np.array([box(0, 0, 10, 10), box(20, 20, 30, 30)], dtype=object)
+    pred = np.array([box(5, 0, 15, 10), box(100, 100, 110, 110)], dtype=object)
+    expected = torch.tensor([[50 / 150, 0], [0, 0]], dtype=torch.float64)
+    assert torch.allclose(polygon_iou(src, pred), expected)
@@ -0,0 +1,393 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import pytest
+
+import zipfile
+
+from milliontrees.datasets.download_utils import download_file_parallel, download_url, download_and_extract_archive, stream_extract_archive
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files from the server's directory, with single-range requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        self.server.requests.append(self.headers.get("Range"))
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range") or "")
+        if match and self.server.accept_ranges:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            start, body = 0, data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        if self.server.fail_at is not None and start <= self.server.fail_at < start + len(body):
+            # Drop the connection in the middle of this range
+            self.wfile.write(body[:self.server.fail_at - start])
+            if self.server.fail_once:
+                self.server.fail_at = None
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmpdir):
+    serve_dir = os.path.join(tmpdir, "remote")
+    os.makedirs(serve_dir)
+    with open(os.path.join(serve_dir, "archive.zip"), "wb") as f:
+        f.write(os.urandom(1000 * 1000 + 123))
+
+    def handler(*args, **kwargs):
+        return RangeRequestHandler(*args, directory=serve_dir, **kwargs)
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.requests, httpd.accept_ranges, httpd.fail_at = [], True, None
+    httpd.fail_once = False
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.serve_dir = serve_dir
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/archive.zip"
+    with open(os.path.join(serve_dir, "archive.zip"), "rb") as f:
+        httpd.md5 = hashlib.md5(f.read()).hexdigest()
+    yield httpd
+    httpd.shutdown()
+
+
+def md5_of(path):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def test_parallel_ranged_fetch(server, tmpdir):
+    fpath = os.path.join(tmpdir, "archive.zip")
+    download_file_parallel(server.url, fpath, num_workers=4, chunk_size=100 * 1000, progress=lambda n: None)
+    assert md5_of(fpath) == server.md5
+    assert not os.path.exists(fpath + ".part")
+    assert not os.path.exists(fpath + ".part.json")
+    # One probe plus one request per chunk
+    assert len(server.requests) == 1 + 11
+
+
+def test_resume_after_dropped_connection(server, tmpdir):
+    fpath = os.path.join(tmpdir, "archive.zip")
+    server.fail_at = 550 * 1000
+    with pytest.raises(Exception):
+        download_file_parallel(server.url, fpath, num_workers=2, chunk_size=100 * 1000, max_retries=1, progress=lambda n: None)
+    assert not os.path.exists(fpath)
+    with open(fpath + ".part.json") as f:
+        completed = set(json.load(f)["chunks"])
+    assert "5" not in completed and len(completed) > 0
+
+    server.fail_at = None
+    server.requests.clear()
+    download_file_parallel(server.url, fpath, num_workers=2, chunk_size=100 * 1000, progress=lambda n: None)
+    assert md5_of(fpath) == server.md5
+    # Completed chunks are not fetched again
+    fetched = {int(re.match(r"bytes=(\d+)", r).group(1)) // (100 * 1000) for r in server.requests[1:]}
+    assert not fetched & {int(i) for i in completed}
+
+
+def test_fetch_without_range_support(server, tmpdir):
+    server.accept_ranges = False
+    download_url(server.url, str(tmpdir), filename="archive.zip", md5=server.md5)
+    assert md5_of(os.path.join(tmpdir, "archive.zip")) == server.md5
+
+
+def make_zip(path):
+    """A zip with stored and deflated members, in nested folders."""
+    contents = {f"images/image{i}.jpg": os.urandom(5000 + i) for i in range(20)}
+    contents["official.csv"] = b"filename,split\n" * 500
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("images/", b"")
+        for name, data in contents.items():
+            compress_type = zipfile.ZIP_DEFLATED if name.endswith(".csv") else zipfile.ZIP_STORED
+            z.writestr(name, data, compress_type=compress_type)
+    return contents
+
+
+def test_stream_extract_archive(server, tmpdir):
+    contents = make_zip(os.path.join(server.serve_dir, "archive.zip"))
+    extract_root = os.path.join(tmpdir, "extracted")
+    progressed = []
+    stream_extract_archive(server.url, extract_root, num_workers=3, chunk_size=20000, progress=progressed.append)
+    for name, data in contents.items():
+        with open(os.path.join(extract_root, name), "rb") as f:
+            assert f.read() == data
+    with zipfile.ZipFile(os.path.join(server.serve_dir, "archive.zip")) as z:
+        assert sum(progressed) == sum(info.compress_size for info in z.infolist())
+    # Members are fetched in groups rather than one request each
+    assert len(server.requests) < len(contents)
+
+    # Extracted members are skipped when resuming
+    os.remove(os.path.join(extract_root, "images", "image3.jpg"))
+    server.requests.clear()
+    stream_extract_archive(server.url, extract_root, progress=lambda n: None)
+    with open(os.path.join(extract_root, "images", "image3.jpg"), "rb") as f:
+        assert f.read() == contents["images/image3.jpg"]
+
+
+def test_stream_extract_retries_and_writes_release_last(server, tmpdir):
+    # The RELEASE file comes first in the archive, far from the last image
+    contents = {"RELEASE_v0.0.txt": b"v0.0"}
+    contents.update({f"images/image{i}.jpg": os.urandom(5000 + i) for i in range(20)})
+    with zipfile.ZipFile(os.path.join(server.serve_dir, "archive.zip"), "w") as z:
+        for name, data in contents.items():
+            z.writestr(name, data)
+        last_image = z.getinfo("images/image19.jpg")
+
+    # A dropped range request is retried
+    extract_root = os.path.join(tmpdir, "retried")
+    server.fail_at, server.fail_once = last_image.header_offset + 100, True
+    stream_extract_archive(server.url, extract_root, chunk_size=20000, progress=lambda n: None)
+    with open(os.path.join(extract_root, "images", "image19.jpg"), "rb") as f:
+        assert f.read() == contents["images/image19.jpg"]
+
+    # The RELEASE file is not written when another member fails
+    extract_root = os.path.join(tmpdir, "failed")
+    server.fail_at, server.fail_once = last_image.header_offset + 100, False
+    with pytest.raises(Exception):
+        stream_extract_archive(server.url, extract_root, chunk_size=20000, max_retries=1,
+                               progress=lambda n: None)
+    assert os.path.exists(os.path.join(extract_root, "images", "image0.jpg"))
+    assert not os.path.exists(os.path.join(extract_root, "RELEASE_v0.0.txt"))
+
+
+def test_streaming_falls_back_without_range_support(server, tmpdir):
+    contents = make_zip(os.path.join(server.serve_dir, "archive.zip"))
+    server.accept_ranges = False
+    download_and_extract_archive(server.url, str(tmpdir), filename="archive.zip", remove_finished=True, streaming=True)
+    with open(os.path.join(tmpdir, "official.csv"), "rb") as f:
+        assert f.read() == contents["official.csv"]
+    assert not os.path.exists(os.path.join(tmpdir, "archive.zip"))
+
+
+def test_partial_install(dataset, server, tmpdir, monkeypatch):
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+
+    source_dir = os.path.join(dataset, "TreeBoxes_v0.0")
+    with zipfile.ZipFile(os.path.join(server.serve_dir, "archive.zip"), "w") as z:
+        for root, _, files in os.walk(source_dir):
+            for file in files:
+                if not file.endswith(".index") and ".index" not in root:
+                    file_path = os.path.join(root, file)
+                    z.write(file_path, os.path.relpath(file_path, source_dir))
+    versions = {"0.0": {"download_url": server.url, "compressed_size": None}}
+    monkeypatch.setattr(TreeBoxesDataset, "_versions_dict", versions)
+    root_dir = os.path.join(tmpdir, "data")
+    image_dir = os.path.join(root_dir, "TreeBoxes_v0.0", "images")
+    marker = os.path.join(root_dir, "TreeBoxes_v0.0", "partial_install.json")
+
+    ds = TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0", splits=["test"])
+    assert len(ds) == 2
+    assert sorted(f for f in os.listdir(image_dir) if f.endswith(".jpg")) == ["image3.jpg", "image4.jpg"]
+    assert os.path.exists(marker)
+
+    # Covered requests do not touch the network
+    server.requests.clear()
+    TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0", sources=["1"], splits="test")
+    assert server.requests == []
+    with pytest.raises(FileNotFoundError):
+        TreeBoxesDataset(download=False, root_dir=root_dir, version="0.0")
+
+    # A broader request only fetches the missing images
+    ds = TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0", sources=["0"])
+    assert sorted(ds._input_array) == ["image1.jpg", "image2.jpg"]
+    with open(marker) as f:
+        assert len(json.load(f)["selections"]) == 2
+
+    ds = TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0")
+    assert len(ds) == 4
+    assert not os.path.exists(marker)
+
+
+def test_update_from_installed_version(dataset, server, tmpdir, monkeypatch):
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+    from milliontrees.datasets.manifest import verify_manifest
+
+    root_dir = os.path.join(tmpdir, "data")
+    old_dir = os.path.join(root_dir, "TreeBoxes_v0.0")
+    shutil.copytree(os.path.join(dataset, "TreeBoxes_v0.0"), old_dir, ignore=shutil.ignore_patterns("*.index"))
+
+    # The new release changes one image and the release file
+    changed = os.urandom(2000)
+    with zipfile.ZipFile(os.path.join(server.serve_dir, "archive.zip"), "w") as z:
+        for root, _, files in os.walk(old_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                name = os.path.relpath(file_path, old_dir).replace(os.sep, "/")
+                if name == "images/image2.jpg":
+                    z.writestr(name, changed)
+                elif name == "RELEASE_v0.0.txt":
+                    z.writestr("RELEASE_v0.1.txt", "v0.1")
+                else:
+                    z.write(file_path, name)
+    versions = {
+        "0.0": {"download_url": None, "compressed_size": None},
+        "0.1": {"download_url": server.url, "compressed_size": None},
+    }
+    monkeypatch.setattr(TreeBoxesDataset, "_versions_dict", versions)
+
+    ds = TreeBoxesDataset(download=True, root_dir=root_dir, version="0.1")
+    new_dir = os.path.join(root_dir, "TreeBoxes_v0.1")
+    assert len(ds) == 4
+    assert os.path.samefile(os.path.join(old_dir, "images", "image1.jpg"), os.path.join(new_dir, "images", "image1.jpg"))
+    with open(os.path.join(new_dir, "images", "image2.jpg"), "rb") as f:
+        assert f.read() == changed
+    assert not os.path.samefile(os.path.join(old_dir, "images", "image2.jpg"), os.path.join(new_dir, "images", "image2.jpg"))
+    assert ds.check_integrity() == []
+
+    # Only files modified since they were last hashed are read again
+    with open(os.path.join(new_dir, "images", "image2.jpg"), "wb") as f:
+        f.write(b"corrupted")
+    assert ds.check_integrity() == ["images/image2.jpg"]
+    os.remove(os.path.join(new_dir, "images", "image3.jpg"))
+    assert verify_manifest(new_dir, num_workers=2) == ["images/image2.jpg", "images/image3.jpg"]
+
+
+def test_transfer_limits(server, tmpdir):
+    from milliontrees.datasets.download_utils import TransferLimits
+
+    limits = TransferLimits(max_bytes_per_second=2 * 1000 * 1000)
+    start = time.monotonic()
+    download_file_parallel(server.url, os.path.join(tmpdir, "archive.zip"), num_workers=4, chunk_size=100 * 1000, progress=lambda n: None, limits=limits)
+    # 1 MB at 2 MB/s, shared by all workers
+    assert time.monotonic() - start >= 0.4
+
+
+def test_download_datasets_concurrently(dataset, server, tmpdir, monkeypatch):
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+    from milliontrees.datasets.TreePoints import TreePointsDataset
+    from milliontrees.download_datasets import download_datasets
+
+    port = server.server_address[1]
+    for dataset_class in (TreeBoxesDataset, TreePointsDataset):
+        name = dataset_class._dataset_name
+        source_dir = os.path.join(dataset, f"{name}_v0.0")
+        with zipfile.ZipFile(os.path.join(server.serve_dir, f"{name}.zip"), "w") as z:
+            for root, _, files in os.walk(source_dir):
+                for file in files:
+                    if ".index" not in root:
+                        file_path = os.path.join(root, file)
+                        z.write(file_path, os.path.relpath(file_path, source_dir))
+        url = f"http://127.0.0.1:{port}/{name}.zip"
+        monkeypatch.setattr(dataset_class, "_versions_dict", {"0.0": {"download_url": url, "compressed_size": None}})
+
+    root_dir = os.path.join(tmpdir, "data")
+    download_datasets(["TreeBoxes", "TreePoints"], root_dir, jobs=2, max_bytes_per_second=10 * 1000 * 1000, disk_jobs=1)
+    assert os.path.exists(os.path.join(root_dir, "TreeBoxes_v0.0", "RELEASE_v0.0.txt"))
+    assert os.path.exists(os.path.join(root_dir, "TreePoints_v0.0", "RELEASE_v0.0.txt"))
+
+    # Failures are reported once every dataset was attempted
+    shutil.rmtree(os.path.join(root_dir, "TreePoints_v0.0"))
+    os.remove(os.path.join(server.serve_dir, "TreePoints.zip"))
+    with pytest.raises(RuntimeError, match="TreePoints"):
+        download_datasets(["TreePoints", "TreeBoxes"], root_dir, jobs=2)
+
+
+def test_file_lock(tmpdir):
+    from milliontrees.datasets.file_lock import FileLock
+
+    path = os.path.join(tmpdir, ".lock")
+    with FileLock(path):
+        with pytest.raises(TimeoutError):
+            FileLock(path, timeout=0.2, poll_interval=0.05).acquire()
+    with FileLock(path, timeout=0.2):
+        pass
+
+
+def _construct_boxes(root_dir):
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+    return len(TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0"))
+
+
+def test_concurrent_downloads_share_one_copy(dataset, server, tmpdir, monkeypatch):
+    import multiprocessing
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+
+    source_dir = os.path.join(dataset, "TreeBoxes_v0.0")
+    with zipfile.ZipFile(os.path.join(server.serve_dir, "archive.zip"), "w") as z:
+        for root, _, files in os.walk(source_dir):
+            for file in files:
+                if ".index" not in root:
+                    file_path = os.path.join(root, file)
+                    z.write(file_path, os.path.relpath(file_path, source_dir))
+    monkeypatch.setattr(TreeBoxesDataset, "_versions_dict", {"0.0": {"download_url": server.url, "compressed_size": None}})
+
+    # Requests made by a single download
+    _construct_boxes(os.path.join(tmpdir, "single"))
+    n_requests = len(server.requests)
+    server.requests.clear()
+
+    # Forked workers inherit the patched download url
+    root_dir = os.path.join(tmpdir, "shared")
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        assert pool.map(_construct_boxes, [root_dir] * 4) == [4] * 4
+    assert len(server.requests) == n_requests
+    assert sorted(os.listdir(root_dir)) == [".TreeBoxes_v0.0.lock", "TreeBoxes_v0.0"]
+
+
+def test_failed_download_is_resumed(dataset, server, tmpdir, monkeypatch):
+    from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+
+    source_dir = os.path.join(dataset, "TreeBoxes_v0.0")
+    archive = os.path.join(server.serve_dir, "archive.zip")
+    with zipfile.ZipFile(archive, "w") as z:
+        for root, _, files in os.walk(source_dir):
+            for file in files:
+                if ".index" not in root:
+                    file_path = os.path.join(root, file)
+                    z.write(file_path, os.path.relpath(file_path, source_dir))
+    with zipfile.ZipFile(archive) as z:
+        images = [info for info in z.infolist() if info.filename.startswith("images/")]
+    monkeypatch.setattr(TreeBoxesDataset, "_versions_dict",
+                        {"0.0": {"download_url": server.url, "compressed_size": None}})
+
+    # Small groups, so other members are written before the failing one
+    import functools
+    from milliontrees.datasets import download_utils
+    monkeypatch.setattr(download_utils, "stream_extract_archive",
+                        functools.partial(stream_extract_archive, chunk_size=1000))
+    # Drop the connection inside the last image, on every attempt
+    server.fail_at = max(info.header_offset for info in images) + 40
+    root_dir = os.path.join(tmpdir, "data")
+    with pytest.raises(Exception):
+        TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0")
+    # Nothing is installed, but the members written so far are kept
+    tmp_dir = os.path.join(root_dir, ".TreeBoxes_v0.0.download")
+    assert not os.path.exists(os.path.join(root_dir, "TreeBoxes_v0.0"))
+    assert not os.path.exists(os.path.join(tmp_dir, "RELEASE_v0.0.txt"))
+    extracted = {name for name in (info.filename for info in images)
+                 if os.path.exists(os.path.join(tmp_dir, name))}
+    assert extracted and len(extracted) < len(images)
+
+    # The rerun only fetches the rest
+    server.fail_at = None
+    del server.requests[:]
+    ds = TreeBoxesDataset(download=True, root_dir=root_dir, version="0.0")
+    assert len(ds) == 4
+    assert not os.path.exists(tmp_dir)
+    starts = {int(re.match(r"bytes=(\d+)-", r).group(1))
+              for r in server.requests if r}
+    assert starts
+    for info in images:
+        if info.filename in extracted:
+            assert info.header_offset not in starts
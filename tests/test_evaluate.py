@@ -0,0 +1,160 @@
+from milliontrees.datasets.TreeBoxes import TreeBoxesDataset
+from milliontrees.datasets.TreePoints import TreePointsDataset
+from milliontrees.evaluate import evaluate
+from milliontrees.common.data_loaders import get_eval_loader
+from milliontrees.common.metrics.metric import ElementValues
+from milliontrees.common.metrics.all_metrics import BoxMatches, DetectionMatches, point_nearness, sparse_box_match, sparse_point_match
+from torchvision.ops import box_iou
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+
+def test_evaluate_boxes(dataset, tmpdir):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    y_true, metadata = ds.get_eval_targets("test")
+    # A correct box and a false positive for image3.jpg, nothing for image4.jpg
+    box = y_true[0]["y"][0].tolist()
+    rows = [["image3.jpg", *box, 0.9], ["image3.jpg", 0, 0, 10, 10, 0.8]]
+    y_pred = [{"y": torch.tensor([box, [0., 0., 10., 10.]]), "scores": torch.tensor([0.9, 0.8])},
+              {"y": torch.zeros(0, 4), "scores": torch.zeros(0)}]
+    expected, expected_str = ds.eval(y_pred, y_true, metadata)
+
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename", "xmin", "ymin", "xmax", "ymax", "score"]).to_csv(pred_file, index=False)
+    # Rows of image3.jpg are split across chunks
+    results, results_str = evaluate(ds, pred_file, chunk_size=1, batch_size=1)
+    # Same values, NaN for the sources without images included
+    np.testing.assert_equal(results, expected)
+    assert results_str == expected_str
+    # The in-memory evaluation reads the same files
+    np.testing.assert_equal(ds.eval_predictions(pred_file), (expected, expected_str))
+
+    # Rows of an image must be contiguous
+    rows = [rows[0], ["image4.jpg", 0, 0, 10, 10, 0.8], rows[1]]
+    pd.DataFrame(rows, columns=["filename", "xmin", "ymin", "xmax", "ymax", "score"]).to_csv(pred_file, index=False)
+    with pytest.raises(ValueError):
+        evaluate(ds, pred_file)
+    with pytest.raises(ValueError):
+        ds.eval_predictions(pred_file)
+
+
+def test_evaluate_points_by_filename_id(dataset, tmpdir):
+    ds = TreePointsDataset(download=False, root_dir=dataset, version="0.0")
+    y_true, metadata = ds.get_eval_targets("test")
+    y_pred = [{"y": points, "scores": torch.full((len(points),), 0.9)} for points in [t["y"] for t in y_true]]
+    expected, _ = ds.eval(y_pred, y_true, metadata)
+
+    rows = [[int(m[0]), *point.tolist(), 0.9] for m, pred in zip(metadata, y_pred) for point in pred["y"]]
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename_id", "x", "y", "score"]).to_csv(pred_file, index=False)
+    results, _ = evaluate(ds, pred_file)
+    np.testing.assert_equal(results, expected)
+    np.testing.assert_equal(ds.eval_predictions(pred_file)[0], expected)
+
+
+def test_accumulators_match_standard_group_eval(dataset):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    test_dataset = ds.get_subset("test")
+    accumulators = {name: metric.accumulator(ds._eval_grouper) for name, metric in ds.metrics.items()}
+    all_y_pred, all_y_true = [], []
+    for metadata, x, y_true in get_eval_loader("standard", test_dataset, batch_size=1):
+        y_pred = [{"y": torch.tensor([[30., 70., 35., 75.]]), "scores": torch.tensor([0.9])} for _ in y_true]
+        for accumulator in accumulators.values():
+            accumulator.update(y_pred, y_true, metadata)
+        all_y_pred.extend(y_pred)
+        all_y_true.extend(y_true)
+
+    for name, metric in ds.metrics.items():
+        expected, expected_str = ds.standard_group_eval(metric, ds._eval_grouper, all_y_pred, all_y_true, test_dataset.metadata_array)
+        results, results_str = accumulators[name].compute()
+        assert results == pytest.approx(expected, rel=1e-6, nan_ok=True)
+        assert results_str == expected_str
+        accumulators[name].reset()
+        assert np.isnan(accumulators[name].compute()[0][metric.agg_metric_field])
+
+
+def test_accumulator_does_not_depend_on_batches(dataset):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    metric = ds.metrics["accuracy"]
+    values = torch.rand(1000)
+    metadata = torch.stack([torch.arange(1000), torch.randint(0, 2, (1000,))], dim=1)
+    expected, _ = ds.standard_group_eval(metric, ds._eval_grouper, ElementValues({metric: values}), ElementValues({metric: values}), metadata)
+
+    accumulator = metric.accumulator(ds._eval_grouper)
+    for batch in torch.randperm(1000).split(7):
+        batch_values = ElementValues({metric: values[batch]})
+        accumulator.update(batch_values, batch_values, metadata[batch])
+    # standard_group_eval averages in float32, the accumulator in float64
+    assert accumulator.compute()[0] == pytest.approx(expected, rel=1e-6, nan_ok=True)
+
+
+@pytest.mark.parametrize("iou_threshold", [0.3, 0.5])
+def test_sparse_box_match(iou_threshold):
+    torch.manual_seed(0)
+    xy = torch.randint(0, 300, (300, 2)).float()
+    src = torch.cat([xy, xy + torch.randint(1, 30, (300, 2))], dim=1)
+    # Duplicated ground truth boxes give ties
+    src = torch.cat([src, src[:20]])
+    xy = torch.randint(0, 300, (400, 2)).float()
+    pred = torch.cat([src[:200] + torch.randn(200, 4), torch.cat([xy, xy + 20], dim=1)])
+
+    dense = DetectionMatches(box_iou)._match(src, pred, iou_threshold)
+    assert torch.equal(sparse_box_match(src, pred, iou_threshold), dense)
+    assert torch.equal(BoxMatches(dense_max_pairs=0)._match(src, pred, iou_threshold), dense)
+
+@pytest.mark.parametrize("distance_threshold", [0.05, 0.1])
+def test_sparse_point_match(distance_threshold):
+    torch.manual_seed(0)
+    src = torch.randint(0, 200, (300, 2))
+    # Duplicated ground truth points give ties, and coincident predictions
+    src = torch.cat([src, src[:20]])
+    pred = torch.cat([src[:150], src[150:300] + torch.randint(-15, 15, (150, 2)), torch.randint(0, 200, (100, 2))])
+
+    dense = DetectionMatches(point_nearness)._match(src, pred, distance_threshold)
+    assert torch.equal(sparse_point_match(src, pred, distance_threshold), dense)
+
+def test_sweep_matches_eval(dataset, tmpdir):
+    ds = TreeBoxesDataset(download=False, root_dir=dataset, version="0.0")
+    y_true, metadata = ds.get_eval_targets("test")
+    box = y_true[0]["y"][0].tolist()
+    y_pred = [{"y": torch.tensor([box, [0., 0., 10., 10.]]), "scores": torch.tensor([0.9, 0.8])},
+              {"y": torch.zeros(0, 4), "scores": torch.zeros(0)}]
+    expected, _ = ds.eval(y_pred, y_true, metadata)
+
+    iou_thresholds = [ds.metrics["accuracy"].iou_threshold, 0.95]
+    score_thresholds = [ds.eval_score_threshold, 0.85]
+    results, results_str = ds.eval_sweep(y_pred, y_true, metadata, iou_thresholds, score_thresholds)
+    for metric in ["accuracy", "recall", "precision"]:
+        assert results[f"{metric}_avg"][0, 0].item() == pytest.approx(expected[metric][f"detection_{metric}_avg"])
+    # The false positive is dropped at a score threshold of 0.85
+    ds.metrics["precision"].score_threshold = 0.85
+    expected, _ = ds.eval(y_pred, y_true, metadata)
+    assert results["precision_avg"][1, 0].item() == pytest.approx(expected["precision"]["detection_precision_avg"])
+    assert "Average precision" in results_str
+
+    # Same results from a prediction file
+    rows = [["image3.jpg", *box, 0.9], ["image3.jpg", 0, 0, 10, 10, 0.8]]
+    pred_file = str(tmpdir.join("predictions.csv"))
+    pd.DataFrame(rows, columns=["filename", "xmin", "ymin", "xmax", "ymax", "score"]).to_csv(pred_file, index=False)
+    sweep = ds.sweep(iou_thresholds, score_thresholds)
+    evaluate(ds, pred_file, sweep=sweep)
+    np.testing.assert_equal({k: np.asarray(v) for k, v in sweep.compute()[0].items()},
+                            {k: np.asarray(v) for k, v in results.items()})
+
+
+def test_sweep_average_precision(dataset):
+    ds = TreePointsDataset(download=False, root_dir=dataset, version="0.0")
+    y_true, metadata = ds.get_eval_targets("test")
+    # Perfect predictions, then the same points shifted by 8 pixels
+    y_pred = [{"y": t["y"], "scores": torch.full((len(t["y"]),), 0.9)} for t in y_true]
+    results, _ = ds.eval_sweep(y_pred, y_true, metadata)
+    assert results["map_avg"] == 1.0
+
+    y_pred = [{"y": t["y"] + torch.tensor([8., 0.]), "scores": torch.full((len(t["y"]),), 0.9)} for t in y_true]
+    results, _ = ds.eval_sweep(y_pred, y_true, metadata)
+    # Matched within 10 pixels or more, missed within 5 and 2
+    assert results["ap_avg"].tolist() == [1.0] * 5 + [0.0] * 2
+    assert results["recall_avg"][0].tolist() == [1.0] * 5 + [0.0] * 2